@@ -0,0 +1,119 @@
+'''
+Compares the SciPy and OpenCV filter backends of the Harris detector and the
+MOPS descriptor (see imagefilters) in speed and output:
+
+    python backendbench.py [IMAGE...] [--repeat 5]
+
+By default all images of the datasets in resources/ are used. For every
+stage the fastest of --repeat runs is reported, summed over the images, with
+the largest differences between the backends' outputs.
+'''
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import features
+
+
+def fastest(repeat, function, *args):
+    '''Output: the result of function(*args) and its fastest run time.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+
+def compareImage(image, repeat):
+    '''
+    Output:
+        dict of stage -> (scipy time, opencv time), and dict of the
+        differences between the backends
+    '''
+    gray = cv2.cvtColor(image.astype(np.float32) / 255., cv2.COLOR_BGR2GRAY)
+    times, outputs = {}, {}
+    for backend in ('scipy', 'opencv'):
+        detector = features.HarrisKeypointDetector(backend)
+        descriptor = features.MOPSFeatureDescriptor(backend)
+        (harris, orientation), t1 = fastest(repeat,
+            detector.computeHarrisValues, gray)
+        maxima, t2 = fastest(repeat, detector.computeLocalMaxima, harris)
+        keypoints, t3 = fastest(repeat, detector.detectKeypoints, image)
+        # Both backends describe the same keypoints
+        if backend == 'scipy':
+            reference = keypoints
+        desc, t4 = fastest(repeat, descriptor.describeFeatures, image,
+            reference)
+        for stage, t in (('harris values', t1), ('local maxima', t2),
+                         ('detect keypoints', t3), ('describe (MOPS)', t4)):
+            times.setdefault(stage, []).append(t)
+        outputs[backend] = (harris, orientation, maxima, keypoints, desc)
+
+    h1, o1, m1, k1, d1 = outputs['scipy']
+    h2, o2, m2, k2, d2 = outputs['opencv']
+    angles1 = dict((kp.pt, kp.angle) for kp in k1)
+    angles2 = dict((kp.pt, kp.angle) for kp in k2)
+    # Orientations of the keypoints found by both backends. (Pixel-wise,
+    # the orientation of a vanishing gradient is arbitrary.)
+    common = set(angles1) & set(angles2)
+    angles = np.array([abs(angles1[pt] - angles2[pt]) % 360 for pt in common])
+    diffs = {'harris (relative)': np.abs(h1 - h2).max() /
+                 max(np.abs(h1).max(), 1e-12),
+             'keypoint angles [deg]': np.minimum(angles, 360 - angles).max()
+                 if len(angles) else 0.0,
+             'maxima pixels differing': int((m1 != m2).sum()),
+             'keypoints differing': len(set(angles1) ^ set(angles2)),
+             'descriptors': np.abs(d1 - d2).max() if len(d1) else 0.0}
+    return times, diffs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare filter backends.')
+    parser.add_argument('images', nargs='*')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = args.images or sorted(glob.glob(os.path.join(here, 'resources',
+        '*', 'img*.*')) + glob.glob(os.path.join(here, 'resources', '*',
+        '*[0-9].jpg')))
+
+    totals, worst = {}, {}
+    for path in paths:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        times, diffs = compareImage(image, args.repeat)
+        for stage, (t1, t2) in times.items():
+            total = totals.setdefault(stage, [0.0, 0.0])
+            total[0] += t1
+            total[1] += t2
+        for name, value in diffs.items():
+            # Counts are summed, differences are the largest over all images
+            if name.endswith('differing'):
+                worst[name] = worst.get(name, 0) + value
+            else:
+                worst[name] = max(worst.get(name, 0), value)
+
+    print('{} images, cv2 threads: {}'.format(len(paths),
+        cv2.getNumThreads()))
+    print('{:<18}{:>11}{:>11}{:>9}'.format('stage', 'scipy [s]', 'opencv [s]',
+        'speedup'))
+    for stage, (t1, t2) in totals.items():
+        print('{:<18}{:>11.3f}{:>11.3f}{:>8.1f}x'.format(stage, t1, t2,
+            t1 / t2))
+    print('\ndifferences between the backends')
+    for name, value in sorted(worst.items()):
+        print('  {:<25}{:.3g}'.format(name, value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,60 @@
+import argparse
+import concurrent.futures
+import functools
 import os
+import queue
 import re
+import sys
+import threading
+import time
 
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import pylab
 import cv2
-from PIL import Image
 
+import benchmarkreport
+import compact
+import featurecache
 import features
+import imagecache
+import imagecontext
 from features import *
 
 
 def plot_2D_arrays(title, arrs, xlabel='', xinterval=None, ylabel='', yinterval=None, line_names=[]):
+    '''
+        Plots the N x 2 arrays arrs as lines and returns the plot as a BGR
+        image. The figure is rendered by the Agg backend straight into
+        memory and does not touch pyplot's global state, so concurrent
+        benchmarks do not interfere with each other.
+    '''
+    # Matplotlib takes long to import, so it is only loaded for plotting
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
 
     for arr in arrs:
         if arr.ndim != 2 or arr.shape[1] != 2:
             raise ValueError('The array should be 2D and the second dimension should be 2!')
 
-        plt.plot(arr[:, 0], arr[:, 1])
+        ax.plot(arr[:, 0], arr[:, 1])
 
-    plt.title(title)
-    plt.xlabel(xlabel)
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
     if xinterval:
-        plt.xlim(xinterval)
+        ax.set_xlim(xinterval)
 
-    plt.ylabel(ylabel)
+    ax.set_ylabel(ylabel)
     if yinterval:
-        plt.ylim(yinterval)
+        ax.set_ylim(yinterval)
 
     if line_names:
-        plt.legend(line_names, loc='best')
-
-    pylab.savefig('__temp.png', bbox_inches='tight')
-    plt.clf()
+        ax.legend(line_names, loc='best')
 
-    img = cv2.imread('__temp.png')
-    os.remove('__temp.png')
-    return img
+    fig.tight_layout()
+    return cv2.cvtColor(fig2data(fig), cv2.COLOR_RGBA2BGR)
 
 
 def plot_2D_array(title, arr, xlabel='', xinterval=None, ylabel='', yinterval=None):
@@ -47,21 +63,18 @@ def plot_2D_array(title, arr, xlabel='', xinterval=None, ylabel='', yinterval=No
 
 def fig2data ( fig ):
     """
-    @brief Convert a Matplotlib figure to a 4D numpy array with RGBA channels and return it
-    @param fig a matplotlib figure
-    @return a numpy 3D array of RGBA values
+    @brief Convert a Matplotlib figure to a 3D numpy array with RGBA channels and return it
+    @param fig a matplotlib figure with an Agg canvas
+    @return a numpy array of RGBA values, height x width x 4
     """
     # draw the renderer
     fig.canvas.draw ( )
 
-    # Get the RGBA buffer from the figure
-    w,h = fig.canvas.get_width_height()
-    buf = np.fromstring ( fig.canvas.tostring_argb(), dtype=np.uint8 )
-    buf.shape = ( w, h,4 )
-
-    # canvas.tostring_argb give pixmap in ARGB mode. Roll the ALPHA channel to have it in RGBA mode
-    buf = np.roll ( buf, 3, axis = 2 )
-    return buf
+    # Copy the RGBA buffer of the figure, which the next draw overwrites.
+    # Older matplotlib versions return it as flat bytes.
+    w, h = fig.canvas.get_width_height()
+    return np.frombuffer(fig.canvas.buffer_rgba(), np.uint8).reshape(
+        h, w, 4).copy()
 
 
 def fig2img ( fig ):
@@ -70,99 +83,116 @@ def fig2img ( fig ):
     @param fig a matplotlib figure
     @return a Python Imaging Library ( PIL ) image
     """
+    from PIL import Image
+
     # put the figure pixmap into a numpy array
     buf = fig2data ( fig )
-    w, h, d = buf.shape
     return Image.fromarray(buf, mode="RGBA").convert("RGB")
 
 
 
 def addROCData(f1, f2, matches, h, threshold):
-    isMatch = []
-    maxD = 0
+    queryIdx, trainIdx, distance = FeatureMatcher.fromDMatches(matches)
 
-    dists = []
-    for m in matches:
-        id1 = m.queryIdx
-        id2 = m.trainIdx
+    # Euclidean distance between the matched points and the ground truth
+    dists = FeatureMatcher.reprojectionErrors(f1, f2, queryIdx, trainIdx, h)
+    isMatch = (dists <= threshold).astype(int)
+    maxD = max(distance.max(), 0) if distance.size != 0 else 0
 
-        ptOld = np.array(f2[id2].pt)
-        ptNew = FeatureMatcher.applyHomography(f1[id1].pt, h)
-
-        #Ignore unmatched points.  There might be a better way to
-        #handle this.
-        # Euclidean distance
-        d = np.linalg.norm(ptNew - ptOld)
-        dists.append(d)
-        if d <= threshold:
-            isMatch.append(1)
-        else:
-            isMatch.append(0)
-
-        if m.distance > maxD:
-            maxD = m.distance
+    return isMatch, maxD
 
-    #plt.hist(dists)
-    #plt.show()
 
-    return isMatch, maxD
+# Number of evenly spaced distance thresholds the ROC curves of the
+# benchmarks are sampled at, like in earlier versions. rocSamples=None
+# computes the exact curves instead, whose AUCs differ slightly.
+ROC_SAMPLES = 500
 
 
-def computeROCCurve(matches, isMatch, thresholds):
-    dataPoints = []
+def computeROCCurve(matches, isMatch, thresholds=None):
+    '''
+        Input:
+            matches -- list of cv2.DMatch objects, or a numpy array with the
+                distance of each match
+            isMatch -- for each match, 1 if it is correct, 0 otherwise
+            thresholds -- optional list of distance thresholds. A match is
+                accepted at a threshold if its distance is below it.
+        Output:
+            numpy array of (false rate, true rate) points. Without
+            thresholds, this is the exact ROC curve: all operating points,
+            found by sorting the distances once and accumulating true and
+            false positives. With thresholds, one point per threshold, as
+            sampled by earlier versions (e.g. 500 np.linspace values).
+    '''
+    if isinstance(matches, np.ndarray):
+        distance = matches.astype(np.float64).ravel()
+    else:
+        distance = np.array([m.distance for m in matches], dtype=np.float64)
+    isMatch = np.asarray(isMatch, dtype=bool).ravel()
 
-    for threshold in thresholds:
-        tp = 0
-        actualCorrect = 0
-        fp = 0
-        actualError = 0
-        total = 0
+    actualCorrect = isMatch.sum()
+    actualError = isMatch.size - actualCorrect
 
-        for j in range(len(matches)):
-            if isMatch[j]:
-                actualCorrect += 1
-                if matches[j].distance < threshold:
-                    tp += 1
-            else:
-                actualError += 1
-                if matches[j].distance < threshold:
-                    fp += 1
+    if thresholds is None:
+        order = np.argsort(distance, kind='mergesort')
+        sortedDistance = distance[order]
+        tp = np.cumsum(isMatch[order])
+        fp = np.arange(1, distance.size + 1) - tp
+        # Matches with equal distances are accepted together, so only the
+        # last one of each run of ties is an operating point
+        last = np.ones(distance.size, bool)
+        last[:-1] = sortedDistance[1:] != sortedDistance[:-1]
+        tp = np.r_[0, tp[last]]
+        fp = np.r_[0, fp[last]]
+    else:
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        tp = np.searchsorted(np.sort(distance[isMatch]), thresholds, 'left')
+        fp = np.searchsorted(np.sort(distance[~isMatch]), thresholds, 'left')
 
-            total += 1
+    trueRate = tp / float(actualCorrect) if actualCorrect != 0 else 0 * tp
+    falseRate = fp / float(actualError) if actualError != 0 else 0 * fp
 
-        trueRate = (float(tp) / actualCorrect) if actualCorrect != 0 else 0
-        falseRate = (float(fp) / actualError) if actualError != 0 else 0
+    return np.column_stack((falseRate, trueRate)).astype(np.float64)
 
-        dataPoints.append((falseRate, trueRate))
 
-    return dataPoints
+# np.trapz is called np.trapezoid since NumPy 2.0
+trapezoid = getattr(np, 'trapezoid', None) or np.trapz
 
 
 def computeAUC(results):
-    auc = 0
-
-    for i in range(1, len(results)):
-        falseRate, trueRate = results[i]
-        falseRatePrev, trueRatePrev = results[i - 1]
-        xdiff = falseRate - falseRatePrev
-        ydiff = trueRate - trueRatePrev
-        auc += xdiff * trueRatePrev + xdiff * ydiff / 2
+    results = np.asarray(results, dtype=np.float64).reshape(-1, 2)
+    if results.shape[0] < 2:
+        return 0
 
-    return auc
+    falseRate, trueRate = results[:, 0], results[:, 1]
+    return float(trapezoid(trueRate, falseRate))
 
 
 def load_homography(filename):
-    with open(filename) as f:
-        content = f.readlines()
-        homography = [float(n) for c in content for n in c.split()]
+    '''
+        Output:
+            The 3x3 homography stored in filename, as a numpy array of its 9
+            entries in row-major order
+    '''
+    return np.loadtxt(filename, dtype=np.float64).ravel()
 
-    return homography
 
+## Datasets ####################################################################
 
-def benchmark_dir(dirpath, keypointDetector, featureDescriptor, featureMatcher,
-    kpThreshold, matchThreshold):
-    image_pattern = '^.+(\\d+)(?:(?:\\.ppm)|(?:\\.png)|(?:\\.jpg))$'
-    homography_pattern = '^H(\\d+)to(\\d+)p$'
+IMAGE_PATTERN = '^.+(\\d+)(?:(?:\\.ppm)|(?:\\.png)|(?:\\.jpg))$'
+HOMOGRAPHY_PATTERN = '^H(\\d+)to(\\d+)p$'
+
+
+def list_dataset(dirpath):
+    '''
+        Input:
+            dirpath -- A benchmark dataset directory, containing images
+                numbered 1..N and the homographies H1toKp from image 1 to
+                image K
+        Output:
+            origImagePath -- The path of image 1
+            pairs -- List of (imgNum, imagePath, homographyPath), sorted by
+                image number
+    '''
     filenames = os.listdir(dirpath)
 
     origImageName = ''
@@ -170,7 +200,7 @@ def benchmark_dir(dirpath, keypointDetector, featureDescriptor, featureMatcher,
     homographyNames = {}
 
     for fn in filenames:
-        match = re.match(image_pattern, fn)
+        match = re.match(IMAGE_PATTERN, fn)
         if match:
             imgNum = int(match.group(1))
             if imgNum == 1:
@@ -178,7 +208,7 @@ def benchmark_dir(dirpath, keypointDetector, featureDescriptor, featureMatcher,
             else:
                 trafoImageNames[imgNum] = fn
 
-        match = re.match(homography_pattern, fn)
+        match = re.match(HOMOGRAPHY_PATTERN, fn)
         if match:
             fromImgNum = int(match.group(1))
             toImgNum = int(match.group(2))
@@ -191,25 +221,237 @@ def benchmark_dir(dirpath, keypointDetector, featureDescriptor, featureMatcher,
     #print 'Original image name: {}'.format(origImageName)
     #print 'Trasformed image names: {}'.format(trafoImageNames)
     #print 'Homography file names: {}'.format(homographyNames)
-    origImage = cv2.imread(os.path.join(dirpath, origImageName))
+    pairs = [(imgNum, os.path.join(dirpath, trafoImageNames[imgNum]),
+              os.path.join(dirpath, homographyNames[imgNum]))
+             for imgNum in sortedkeys]
 
-    trafoImages = []
-    homographies = []
-    for imgNum in sortedkeys:
-        trafoImage = cv2.imread(os.path.join(dirpath, trafoImageNames[imgNum]))
-        h = load_homography(os.path.join(dirpath, homographyNames[imgNum]))
+    return os.path.join(dirpath, origImageName), pairs
 
-        trafoImages.append(trafoImage)
-        homographies.append(h)
 
-    return benchmark(origImage, trafoImages, homographies,
-              keypointDetector, featureDescriptor,
-              featureMatcher, kpThreshold, matchThreshold)
+def find_datasets(root):
+    '''
+        Input:
+            root -- A dataset directory, or a directory with dataset
+                directories at any depth below it
+        Output:
+            Sorted list of the dataset directories (the ones containing
+            homography files H1toKp), see list_dataset
+    '''
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if any(re.match(HOMOGRAPHY_PATTERN, fn) for fn in filenames):
+            found.append(dirpath)
+    return found
+
+
+class PrefetchLoader(object):
+    '''
+        Iterates over load(item) for every item, in order, while a
+        background thread loads the next `depth` items ahead. cv2.imread
+        decodes images outside of the GIL, so decoding the next images
+        overlaps with the computation on the current one. The thread starts when the loader is created.
+        Exceptions raised by load are raised by the iteration, at the item
+        that caused them.
+    '''
+    def __init__(self, items, load, depth=2):
+        '''
+            Input:
+                items -- List of the items to load
+                load -- Function loading one item
+                depth -- Number of items loaded ahead, 0 to load every item
+                    when it is requested, without a thread
+        '''
+        self.items = list(items)
+        self.load = load
+        self.depth = depth
+        self.next = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        if depth > 0:
+            self.loaded = queue.Queue(depth)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        for item in self.items:
+            try:
+                result = (True, self.load(item))
+            except Exception as e:
+                result = (False, e)
+            # Wait for room in the queue, unless the loader is closed
+            while not self.stopped.is_set():
+                try:
+                    self.loaded.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self.stopped.is_set() or not result[0]:
+                return
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next >= len(self.items):
+            raise StopIteration
+        self.next += 1
+        if self.thread is None:
+            return self.load(self.items[self.next - 1])
+        ok, result = self.loaded.get()
+        if not ok:
+            self.next = len(self.items)
+            raise result
+        return result
+
+    def close(self):
+        '''Stops the background thread, dropping the items loaded ahead.'''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_image(path, imageCache=None):
+    '''
+        Same as cv2.imread(path). Through an imagecache.ImageCache, if
+        given, the read-only cached image comes as an
+        imagecontext.ImageContext with its cached grayscale version, so
+        compute_features skips the conversion.
+    '''
+    if imageCache is not None:
+        image, gray = imageCache.readImages(path)
+        if image is None:
+            return None
+        return imagecontext.ImageContext(image, gray)
+    return cv2.imread(path)
+
+
+def load_pair(pair, imageCache=None):
+    '''
+        Loads the (image, homography) of a (imgNum, imagePath,
+        homographyPath) entry of list_dataset, see read_image.
+    '''
+    _, imagePath, homographyPath = pair
+    return read_image(imagePath, imageCache), load_homography(homographyPath)
+
+
+def benchmark_dir(dirpath, keypointDetector, featureDescriptor, featureMatcher,
+    kpThreshold, matchThreshold, rocSamples=ROC_SAMPLES, cache=None,
+    report=None, prefetch=2, imageCache=None):
+    '''
+        Runs benchmark on a dataset directory, see list_dataset. The images
+        and homographies are loaded by a PrefetchLoader while the previous
+        pairs are benchmarked, prefetch items ahead (0 to load them in
+        turn). imageCache is an optional imagecache.ImageCache, which skips
+        decoding the images and converting them to grayscale on later
+        runs, see read_image.
+    '''
+    origImagePath, pairs = list_dataset(dirpath)
+    load = functools.partial(load_pair, imageCache=imageCache)
+    # Start loading the pairs before image 1 is decoded
+    with PrefetchLoader(pairs, load, prefetch) as loader:
+        origImage = read_image(origImagePath, imageCache)
+
+        if report is not None:
+            report.dataset = os.path.basename(os.path.normpath(dirpath))
+        return benchmark_stream(origImage, loader,
+                  keypointDetector, featureDescriptor,
+                  featureMatcher, kpThreshold, matchThreshold, rocSamples,
+                  cache, report)
+
+
+def compute_features(image, keypointDetector, featureDescriptor, kpThreshold,
+                     cache=None, report=None, pair=''):
+    '''
+        Detects, thresholds and describes the keypoints of one image. If
+        cache is a featurecache.FeatureCache, features computed before for
+        the same image and configuration are reused. The detector and the
+        descriptor share one imagecontext.ImageContext of the image, so
+        its grayscale and filtered versions are computed once. The stages
+        are recorded in report (a benchmarkreport.BenchmarkReport) under
+        pair.
+    '''
+    image = imagecontext.ImageContext.of(image)
+    if cache is not None:
+        with benchmarkreport.stage(report, 'features', pair) as s:
+            kps, desc = cache.computeFeatures(image, keypointDetector,
+                featureDescriptor, kpThreshold)
+            s.count(keypoints=len(kps), descriptors=len(desc))
+        return kps, desc
+
+    with benchmarkreport.stage(report, 'detect', pair) as s:
+        kps = keypointDetector.detectKeypoints(image)
+        s.count(keypoints=len(kps))
+    kps = [kp for kp in kps if kp.response >= kpThreshold]
+    with benchmarkreport.stage(report, 'describe', pair) as s:
+        desc = featureDescriptor.describeFeatures(image, kps)
+        s.count(keypoints=len(kps), descriptors=len(desc))
+    return kps, desc
+
+
+def benchmark_pair(okps, odesc, timg, h, keypointDetector, featureDescriptor,
+                   featureMatcher, kpThreshold, matchThreshold,
+                   rocSamples=ROC_SAMPLES, cache=None, report=None, pair=''):
+    '''
+        Matches the features of the original image (okps, odesc) with the
+        ones of the transformed image timg and evaluates them with the
+        ground truth homography h, see benchmark. The stages are recorded
+        in report under pair.
+        Output:
+            d -- Average distance between true and actual matches
+            auc -- Area under the ROC curve
+            dataPoints -- The ROC curve, see computeROCCurve
+    '''
+    tkps, tdesc = compute_features(timg, keypointDetector, featureDescriptor,
+        kpThreshold, cache, report, pair)
+
+    with benchmarkreport.stage(report, 'match', pair) as s:
+        matches = featureMatcher.matchFeatures(odesc, tdesc)
+        matches = sorted(matches, key = lambda x:x.distance)
+        s.count(descriptors=len(odesc) + len(tdesc), matches=len(matches))
+
+    return evaluate_matches(okps, tkps, matches, h, matchThreshold,
+        rocSamples, report, pair)
+
+
+def evaluate_matches(okps, tkps, matches, h, matchThreshold,
+                     rocSamples=ROC_SAMPLES, report=None, pair=''):
+    '''
+        Evaluates the matches (sorted by distance) between the keypoints
+        okps and tkps of an image pair with the ground truth homography h.
+        Output:
+            d, auc, dataPoints -- see benchmark_pair
+    '''
+    with benchmarkreport.stage(report, 'evaluate', pair) as s:
+        d = features.FeatureMatcher.evaluateMatch(okps, tkps, matches, h)
+        isMatch, maxD = addROCData(okps, tkps, matches, h, matchThreshold)
+        s.count(matches=len(matches))
+
+    with benchmarkreport.stage(report, 'roc', pair) as s:
+        thresholdList = None
+        if rocSamples is not None:
+            thresholdList = np.linspace(0.0, maxD+1, num=rocSamples)
+        dataPoints = computeROCCurve(matches, isMatch, thresholdList)
+        auc = computeAUC(dataPoints)
+        s.count(matches=len(matches))
+
+    return d, auc, dataPoints
 
 
 def benchmark(origImage, trafoImages, homographies,
               keypointDetector, featureDescriptor,
-              featureMatcher, kpThreshold, matchThreshold):
+              featureMatcher, kpThreshold, matchThreshold,
+              rocSamples=ROC_SAMPLES, cache=None, report=None):
     '''
         Input:
             origImage -- The original image which is transformed
@@ -222,39 +464,49 @@ def benchmark(origImage, trafoImages, homographies,
             featureMatcher -- The selected feature matcher algorithm
             kpThreshold -- The threshold used for keypoint detection
             matchThreshold -- The threshold used to determine if a match is valid
+            rocSamples -- The number of evenly spaced distance thresholds
+                the ROC curve is sampled at, ROC_SAMPLES by default. If
+                None, the exact ROC curve is computed, which changes the
+                AUCs slightly.
+            cache -- Optional featurecache.FeatureCache. Re-running a
+                benchmark with only a different matcher or threshold then
+                skips detection (and description) entirely.
+            report -- Optional benchmarkreport.BenchmarkReport, in which the
+                time, memory and counts of every stage of every image pair
+                are recorded
     '''
     assert len(trafoImages) == len(homographies)
-    okps = keypointDetector.detectKeypoints(origImage)
-    okps = [kp for kp in okps if kp.response >= kpThreshold]
-    odesc = featureDescriptor.describeFeatures(origImage, okps)
+    return benchmark_stream(origImage, zip(trafoImages, homographies),
+              keypointDetector, featureDescriptor,
+              featureMatcher, kpThreshold, matchThreshold, rocSamples, cache,
+              report)
+
+
+def benchmark_stream(origImage, pairs, keypointDetector, featureDescriptor,
+                     featureMatcher, kpThreshold, matchThreshold,
+                     rocSamples=ROC_SAMPLES, cache=None, report=None):
+    '''
+        Same as benchmark, but with an iterable of (trafoImage, homography)
+        pairs, which are only requested when they are benchmarked, e.g.
+        from a PrefetchLoader.
+    '''
+    okps, odesc = compute_features(origImage, keypointDetector,
+        featureDescriptor, kpThreshold, cache, report, '1')
 
     ds = []
     aucs = []
     data_point_list = []
     line_legends = []
     # go through each transformed image and perform feature matching
-    for i, timg in enumerate(trafoImages):
+    for i, (timg, h) in enumerate(pairs):
         #print 'Matching image 1 with image {}'.format(i+2)
-        tkps = keypointDetector.detectKeypoints(timg)
-        tkps = [kp for kp in tkps if kp.response >= kpThreshold]
-        tdesc = featureDescriptor.describeFeatures(timg, tkps)
-        matches = featureMatcher.matchFeatures(odesc, tdesc)
-        matches = sorted(matches, key = lambda x:x.distance)
-
-        d = features.FeatureMatcher.evaluateMatch(
-            okps, tkps, matches,
-            homographies[i])
+        d, auc, dataPoints = benchmark_pair(okps, odesc, timg,
+            h, keypointDetector, featureDescriptor,
+            featureMatcher, kpThreshold, matchThreshold, rocSamples, cache,
+            report, '1 vs {}'.format(i+2))
         ds.append(d)
-
-        isMatch, maxD = addROCData(
-            okps, tkps, matches,
-            homographies[i], matchThreshold)
-
-        thresholdList = np.linspace(0.0, maxD+1, num=500)
-        dataPoints = computeROCCurve(matches, isMatch, thresholdList)
-        auc = computeAUC(dataPoints)
         aucs.append(auc)
-        data_point_list.append(np.array(dataPoints))
+        data_point_list.append(dataPoints)
         line_legends.append('1 vs {}'.format(i+2))
 
     roc_img = plot_2D_arrays(
@@ -263,3 +515,319 @@ def benchmark(origImage, trafoImages, homographies,
 
     return ds, aucs, roc_img
 
+
+## Compact descriptors #########################################################
+
+def benchmark_compression(origImage, trafoImages, homographies,
+                          keypointDetector, featureDescriptor, compressors,
+                          featureMatcher, kpThreshold, matchThreshold,
+                          rocSamples=ROC_SAMPLES):
+    '''
+        Measures the accuracy cost of compact descriptors, see compact.py.
+        The features of every image are detected and described once. The
+        descriptors are then matched and evaluated like in benchmark, as
+        they are and compressed by each of compressors.
+        Input:
+            compressors -- List of fitted compact.DescriptorCompressor
+            The other arguments are the ones of benchmark.
+        Output:
+            List of one dict per representation, the uncompressed
+            descriptors first, with
+                name -- The dtype of the descriptors, or the compressor name
+                bytes -- Bytes per descriptor
+                distance -- Average distance between true and actual matches
+                auc -- Average AUC
+                aucLoss -- AUC of the uncompressed descriptors minus auc
+                matchTime -- Total seconds spent matching
+    '''
+    assert len(trafoImages) == len(homographies)
+    okps, odesc = compute_features(origImage, keypointDetector,
+        featureDescriptor, kpThreshold)
+    odesc = np.asarray(odesc)
+    trafoFeatures = [compute_features(timg, keypointDetector,
+        featureDescriptor, kpThreshold) for timg in trafoImages]
+
+    rows = []
+    for compressor in [None] + list(compressors):
+        compress = np.asarray if compressor is None else compressor.compress
+        codesc = compress(odesc)
+        ds, aucs, matchTime = [], [], 0.0
+        for (tkps, tdesc), h in zip(trafoFeatures, homographies):
+            ctdesc = compress(tdesc)
+            start = time.perf_counter()
+            matches = featureMatcher.matchFeatures(codesc, ctdesc)
+            matchTime += time.perf_counter() - start
+            matches = sorted(matches, key = lambda x:x.distance)
+            d, auc, _ = evaluate_matches(okps, tkps, matches, h,
+                matchThreshold, rocSamples)
+            ds.append(d)
+            aucs.append(auc)
+        rows.append({'name': codesc.dtype.name if compressor is None
+                         else compressor.name,
+                     'bytes': codesc.itemsize * codesc.shape[1],
+                     'distance': float(np.mean(ds)),
+                     'auc': float(np.mean(aucs)),
+                     'matchTime': matchTime})
+
+    for row in rows:
+        row['aucLoss'] = rows[0]['auc'] - row['auc']
+    return rows
+
+
+def format_compression(rows):
+    '''Formats the output of benchmark_compression as a text table.'''
+    lines = [('descriptors', 'bytes', 'distance', 'AUC', 'AUC loss',
+              'match [s]')]
+    for r in rows:
+        lines.append((r['name'], str(r['bytes']),
+            '{:.4f}'.format(r['distance']), '{:.4f}'.format(r['auc']),
+            '{:+.4f}'.format(r['aucLoss']), '{:.3f}'.format(r['matchTime'])))
+    widths = [max(len(line[i]) for line in lines)
+              for i in range(len(lines[0]))]
+    return '\n'.join('  '.join(s.rjust(w) for s, w in zip(line, widths))
+                     for line in lines)
+
+
+def load_compressor(spec):
+    '''
+        A compact.DescriptorCompressor from a file saved by its save method,
+        or an untrained one from the name of a float dtype.
+    '''
+    if spec in compact.DTYPES:
+        return compact.DescriptorCompressor(spec)
+    return compact.DescriptorCompressor.load(spec)
+
+
+## Parallel benchmarks #########################################################
+
+def make_component(config):
+    '''
+        Creates a detector, descriptor or matcher from a picklable config,
+        so that worker processes build their own instances instead of
+        receiving pickled objects.
+        Input:
+            config -- The name of a class in the features module, or a
+                (name, kwargs) tuple with the arguments of its constructor
+    '''
+    if isinstance(config, str):
+        name, kwargs = config, {}
+    else:
+        name, kwargs = config
+    return getattr(features, name)(**kwargs)
+
+
+# Feature cache of a worker process. It keeps image 1 of each dataset in
+# memory, so it is computed once per worker rather than once per pair.
+worker_cache = None
+# Decoded image cache of a worker process, if one is used
+worker_images = None
+
+
+def run_pair_task(task):
+    '''
+        Benchmarks one image pair in a worker process.
+        Input:
+            task -- (origImagePath, imagePath, homographyPath, configs,
+                kpThreshold, matchThreshold, rocSamples, cacheDirectory,
+                pair, trackMemory, imageCacheDirectory), where configs are
+                the detector, descriptor and matcher configs, pair is the
+                label of the pair in the report and trackMemory is None if
+                no report is made, see benchmarkreport.BenchmarkReport
+        Output:
+            (d, auc, dataPoints, rows), see benchmark_pair. rows are the
+            report rows of the pair.
+    '''
+    global worker_cache, worker_images
+    (origImagePath, imagePath, homographyPath, configs, kpThreshold,
+        matchThreshold, rocSamples, cacheDirectory, pair, trackMemory,
+        imageCacheDirectory) = task
+    detector, descriptor, matcher = [make_component(c) for c in configs]
+
+    report = None
+    if trackMemory is not None:
+        report = benchmarkreport.BenchmarkReport(trackMemory)
+
+    if worker_cache is None or worker_cache.directory != cacheDirectory:
+        worker_cache = featurecache.FeatureCache(cacheDirectory)
+    if imageCacheDirectory is None:
+        worker_images = None
+    elif worker_images is None or \
+            worker_images.directory != imageCacheDirectory:
+        worker_images = imagecache.ImageCache(imageCacheDirectory)
+    try:
+        okps, odesc = compute_features(read_image(origImagePath,
+            worker_images), detector, descriptor, kpThreshold, worker_cache,
+            report, '1')
+
+        d, auc, dataPoints = benchmark_pair(okps, odesc,
+            read_image(imagePath, worker_images),
+            load_homography(homographyPath), detector, descriptor, matcher,
+            kpThreshold, matchThreshold, rocSamples, worker_cache, report,
+            pair)
+    finally:
+        if report is not None:
+            report.finish()
+    return d, auc, dataPoints, report.rows if report is not None else []
+
+
+def benchmark_parallel(dirpaths, detectorConfig, descriptorConfig,
+                       matcherConfig, kpThreshold, matchThreshold,
+                       rocSamples=ROC_SAMPLES, workers=None,
+                       cacheDirectory=None, report=None,
+                       imageCacheDirectory=None):
+    '''
+        Runs benchmark_dir on several datasets, with every image pair of
+        every dataset benchmarked in a pool of worker processes.
+        Input:
+            dirpaths -- List of dataset directories
+            detectorConfig, descriptorConfig, matcherConfig -- Configs of
+                the detector, descriptor and matcher, see make_component
+            workers -- Number of worker processes, None for one per CPU and
+                1 to run everything in this process
+            cacheDirectory -- Optional directory of a feature cache shared by
+                all workers and runs, see featurecache.FeatureCache
+            report -- Optional benchmarkreport.BenchmarkReport, to which
+                the rows recorded by the workers are added. The features of
+                image 1 are reported by every pair that needs them, which
+                with the feature cache is usually only the first pair of
+                each worker.
+            imageCacheDirectory -- Optional directory of a decoded image
+                cache shared by all workers and runs, see
+                imagecache.ImageCache
+            The other arguments are the ones of benchmark.
+        Output:
+            List with the (ds, aucs, roc_img) result of each dataset, in the
+            order of dirpaths. The results do not depend on the number of
+            workers or on the order in which the pairs finish.
+    '''
+    configs = (detectorConfig, descriptorConfig, matcherConfig)
+    trackMemory = report.trackMemory if report is not None else None
+    tasks = []
+    legends = []
+    for dirpath in dirpaths:
+        origImagePath, pairs = list_dataset(dirpath)
+        legends.append(['1 vs {}'.format(imgNum) for imgNum, _, _ in pairs])
+        tasks.extend((origImagePath, imagePath, homographyPath, configs,
+                      kpThreshold, matchThreshold, rocSamples, cacheDirectory,
+                      '1 vs {}'.format(imgNum), trackMemory,
+                      imageCacheDirectory)
+                     for imgNum, imagePath, homographyPath in pairs)
+
+    # Tasks are ordered by dataset and image number. map() returns results
+    # in task order, which keeps the merge deterministic.
+    if workers == 1:
+        results = [run_pair_task(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(run_pair_task, tasks))
+
+    merged = []
+    start = 0
+    for dirpath, line_legends in zip(dirpaths, legends):
+        pairResults = results[start:start + len(line_legends)]
+        start += len(line_legends)
+        if report is not None:
+            for r in pairResults:
+                report.extend(r[3],
+                    dataset=os.path.basename(os.path.normpath(dirpath)))
+        ds = [r[0] for r in pairResults]
+        aucs = [r[1] for r in pairResults]
+        roc_img = plot_2D_arrays(
+            'All plots', [r[2] for r in pairResults], xlabel='False rate',
+            ylabel = 'True rate', line_names=line_legends)
+        merged.append((ds, aucs, roc_img))
+
+    return merged
+
+
+## Headless runner #############################################################
+
+def main(argv=None):
+    '''
+        Runs benchmark_parallel from the command line, without the UI:
+
+            python benchmark.py resources/yosemite resources/graf \\
+                --detector HarrisKeypointDetector --matcher RatioFeatureMatcher
+
+        Prints the average distance and AUC of every dataset, and optionally
+        writes the stage report and the ROC plots.
+    '''
+    parser = argparse.ArgumentParser(description='Benchmark feature '
+        'detection, description and matching on datasets of images related '
+        'by known homographies.')
+    parser.add_argument('datasets', nargs='+',
+        help='dataset directories, or directories with datasets below '
+        'them, see find_datasets')
+    parser.add_argument('--detector', default='HarrisKeypointDetector',
+        help='keypoint detector class in features.py')
+    parser.add_argument('--descriptor', default='MOPSFeatureDescriptor',
+        help='feature descriptor class in features.py')
+    parser.add_argument('--matcher', default='RatioFeatureMatcher',
+        help='feature matcher class in features.py')
+    parser.add_argument('--kp-threshold', type=float, default=1e-2,
+        help='minimum keypoint response')
+    parser.add_argument('--match-threshold', type=float, default=5,
+        help='maximum reprojection error of a correct match')
+    parser.add_argument('--roc-samples', type=int, default=ROC_SAMPLES,
+        help='sample the ROC curves at this many thresholds')
+    parser.add_argument('--exact-roc', dest='roc_samples',
+        action='store_const', const=None,
+        help='compute the exact ROC curves instead of sampling them')
+    parser.add_argument('--workers', type=int, default=None,
+        help='worker processes, 1 to run in this process')
+    parser.add_argument('--cache-dir', default=None,
+        help='directory of a feature cache shared between runs')
+    parser.add_argument('--image-cache', default=None,
+        help='directory of a decoded image cache shared between runs')
+    parser.add_argument('--report', default=None,
+        help='write the stage report to this .csv or .json file')
+    parser.add_argument('--roc-dir', default=None,
+        help='write the ROC plot of every dataset to this directory')
+    parser.add_argument('--compressors', nargs='+', default=None,
+        help='instead of the benchmark, compare the descriptors with '
+        'compact versions of them: float32, float16 or compressor files '
+        'written by compact.py, see benchmark_compression')
+    args = parser.parse_args(argv)
+
+    datasets = [d for root in args.datasets for d in find_datasets(root)]
+    if args.compressors:
+        compressors = [load_compressor(c) for c in args.compressors]
+        for dirpath in datasets:
+            origImagePath, pairs = list_dataset(dirpath)
+            loaded = [load_pair(pair) for pair in pairs]
+            rows = benchmark_compression(read_image(origImagePath),
+                [image for image, _ in loaded], [h for _, h in loaded],
+                make_component(args.detector),
+                make_component(args.descriptor), compressors,
+                make_component(args.matcher), args.kp_threshold,
+                args.match_threshold, args.roc_samples)
+            print(os.path.basename(os.path.normpath(dirpath)) + ':')
+            print(format_compression(rows))
+        return 0
+
+    report = None
+    if args.report:
+        report = benchmarkreport.BenchmarkReport()
+    results = benchmark_parallel(datasets, args.detector,
+        args.descriptor, args.matcher, args.kp_threshold,
+        args.match_threshold, args.roc_samples, args.workers, args.cache_dir,
+        report, args.image_cache)
+
+    for dirpath, (ds, aucs, roc_img) in zip(datasets, results):
+        name = os.path.basename(os.path.normpath(dirpath))
+        print('{}: average distance {:.4f}, average AUC {:.4f}'.format(
+            name, np.mean(ds), np.mean(aucs)))
+        if args.roc_dir:
+            if not os.path.isdir(args.roc_dir):
+                os.makedirs(args.roc_dir)
+            cv2.imwrite(os.path.join(args.roc_dir, name + '_roc.png'),
+                roc_img)
+
+    if report is not None:
+        report.save(args.report)
+        print(report.table())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+import collections
+import csv
+import json
+import time
+import tracemalloc
+
+
+## Benchmark reports ###########################################################
+# Stages of the benchmark pipeline, in order. With a feature cache, detection
+# and description run as one 'features' stage.
+STAGES = ('detect', 'describe', 'features', 'match', 'evaluate', 'roc')
+
+# Columns of a report row. wall and cpu are in seconds, peakMemory is the
+# peak of the memory allocated during the stage in bytes (None unless the
+# report tracks memory), and the counts are None where they do not apply.
+FIELDS = ('dataset', 'pair', 'stage', 'wall', 'cpu', 'peakMemory',
+          'keypoints', 'descriptors', 'matches')
+
+
+class Stage(object):
+    '''Measures one stage of one image pair, see BenchmarkReport.stage.'''
+    def __init__(self, report, name, pair):
+        self.report = report
+        self.row = dict.fromkeys(FIELDS)
+        self.row.update(dataset=report.dataset, pair=pair, stage=name)
+
+    def count(self, **counts):
+        '''Records keypoint, descriptor or match counts of the stage.'''
+        self.row.update(counts)
+
+    def __enter__(self):
+        if self.report.trackMemory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.row['wall'] = time.perf_counter() - self.wall
+        self.row['cpu'] = time.process_time() - self.cpu
+        if self.report.trackMemory:
+            self.row['peakMemory'] = max(0,
+                tracemalloc.get_traced_memory()[1] - self.memory)
+        self.report.rows.append(self.row)
+
+
+class NullStage(object):
+    '''Stands in for a Stage when nothing is recorded.'''
+    def count(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def stage(report, name, pair=''):
+    '''
+    Context manager measuring a stage in report, or doing nothing if report
+    is None:
+
+        with stage(report, 'match', '1 vs 2') as s:
+            matches = matcher.matchFeatures(desc1, desc2)
+            s.count(matches=len(matches))
+    '''
+    if report is None:
+        return NullStage()
+    return report.stage(name, pair)
+
+
+class BenchmarkReport(object):
+    '''
+    Collects the wall time, CPU time, peak memory and feature counts of every
+    stage of a benchmark run, one row per stage and image pair (see FIELDS).
+    A report that tracks memory stops the tracing it started when the run
+    is finished (finish, or the end of a with block); the rows stay
+    available.
+    '''
+    def __init__(self, trackMemory=False):
+        '''
+        Input:
+            trackMemory -- if True, the peak memory of every stage is
+                           measured with tracemalloc (which also sees NumPy
+                           allocations). Tracing slows down Python-heavy
+                           stages, so the times are less representative.
+                           Without tracemalloc.reset_peak (Python < 3.9), the
+                           peak is the one since tracing started.
+        '''
+        self.trackMemory = trackMemory
+        self.dataset = ''
+        self.rows = []
+        # Tracing slows down every allocation, it is only stopped by the
+        # report that started it
+        self.startedTracing = trackMemory and not tracemalloc.is_tracing()
+        if self.startedTracing:
+            tracemalloc.start()
+
+    def finish(self):
+        '''Ends the run, stopping memory tracing if this report started it.'''
+        if self.startedTracing:
+            tracemalloc.stop()
+            self.startedTracing = False
+            # Later stages cannot measure memory any more
+            self.trackMemory = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+    def stage(self, name, pair=''):
+        return Stage(self, name, pair)
+
+    def extend(self, rows, **fields):
+        '''Adds rows (e.g. of another process' report), updated by fields.'''
+        for row in rows:
+            row = dict(row)
+            row.update(fields)
+            self.rows.append(row)
+
+    def totals(self):
+        '''
+        Output:
+            list of one row per stage, in pipeline order, with the summed
+            times and counts over all pairs and the largest peak memory
+        '''
+        totals = collections.OrderedDict()
+        for name in STAGES + tuple(r['stage'] for r in self.rows):
+            rows = [r for r in self.rows if r['stage'] == name]
+            if not rows or name in totals:
+                continue
+            total = dict.fromkeys(FIELDS)
+            total.update(dataset='', pair='{} pairs'.format(len(rows)),
+                stage=name)
+            for field in FIELDS[3:]:
+                values = [r[field] for r in rows if r[field] is not None]
+                if values:
+                    total[field] = max(values) if field == 'peakMemory' \
+                        else sum(values)
+            totals[name] = total
+        return list(totals.values())
+
+    def table(self, rows=None):
+        '''Formats rows (by default the per-stage totals) as a text table.'''
+        if rows is None:
+            rows = self.totals()
+        header = ('stage', 'pair', 'wall [s]', 'cpu [s]', 'peak [MB]',
+                  'keypoints', 'descriptors', 'matches')
+        lines = [header]
+        for r in rows:
+            lines.append((r['stage'], r['pair'],
+                '{:.3f}'.format(r['wall']), '{:.3f}'.format(r['cpu']),
+                '-' if r['peakMemory'] is None else
+                    '{:.1f}'.format(r['peakMemory'] / 2.0**20),
+                '-' if r['keypoints'] is None else str(r['keypoints']),
+                '-' if r['descriptors'] is None else str(r['descriptors']),
+                '-' if r['matches'] is None else str(r['matches'])))
+        widths = [max(len(line[i]) for line in lines)
+                  for i in range(len(header))]
+        return '\n'.join('  '.join(s.rjust(w) for s, w in zip(line, widths))
+                         for line in lines)
+
+    def save(self, path):
+        '''Writes all rows to path, as JSON if it ends in .json, else CSV.'''
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({'rows': self.rows, 'totals': self.totals()}, f,
+                          indent=1)
+        else:
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, FIELDS)
+                writer.writeheader()
+                writer.writerows(self.rows)
@@ -0,0 +1,377 @@
+'''
+Matching of unordered image collections. Matching all N(N - 1) / 2 pairs
+fully is too slow for large collections, so the pairs are ranked cheaply
+first, and only the top k neighbours of every image are matched and
+verified with a RANSAC homography:
+
+    python collection.py FEATURES GRAPH.npz [--neighbors 5] [--workers N]
+
+FEATURES is a directory of feature files as written by extract.py. The
+result is a sparse MatchGraph with the verified matches and the inlier
+count of every edge.
+'''
+import argparse
+import os
+import sys
+
+import numpy as np
+from scipy import sparse
+
+import benchmark
+import extract
+import featureio
+import matchfilter
+import neighbors
+
+
+## Candidate pairs #############################################################
+def sampleFeatures(descriptors, responses=None, samples=256):
+    '''
+    Input:
+        descriptors -- N x D numpy array of the descriptors of one image
+        responses -- the detector responses of the keypoints, if given the
+                     strongest keypoints are sampled, otherwise evenly
+                     spaced ones
+        samples -- maximum number of descriptors to keep
+    Output:
+        the sampled rows of descriptors
+    '''
+    descriptors = np.asarray(descriptors)
+    if descriptors.shape[0] <= samples:
+        return descriptors
+    if responses is not None:
+        keep = np.argsort(-np.asarray(responses), kind='stable')[:samples]
+        return descriptors[np.sort(keep)]
+    return descriptors[np.linspace(0, descriptors.shape[0] - 1,
+        samples).astype(int)]
+
+
+def voteScores(descriptors, responses=None, samples=256, votesPerSample=4,
+               index=None):
+    '''
+    Scores all pairs of images by keypoint votes: the sampled descriptors of
+    all images go into one nearest neighbour index, and every sample votes
+    for the images of its votesPerSample nearest neighbours in other images
+    (see NearestNeighborIndex.queryExcluding, the samples of the own image
+    are skipped during the search).
+    Input:
+        descriptors -- list with the descriptor array of every image
+        responses -- optional list with the keypoint responses of every
+                     image, see sampleFeatures
+        index -- neighbors.NearestNeighborIndex over the samples of all
+                 images, BruteForceIndex by default. Use an approximate
+                 index (LSHIndex) or HammingIndex for binary descriptors as
+                 needed.
+    Output:
+        N x N symmetric scipy.sparse.csr_matrix with the number of votes of
+        every pair of images
+    '''
+    numImages = len(descriptors)
+    if responses is None:
+        responses = [None] * numImages
+    sampled = [sampleFeatures(d, r, samples)
+               for d, r in zip(descriptors, responses)]
+    labels = np.repeat(np.arange(numImages), [len(s) for s in sampled])
+    if labels.size == 0:
+        return sparse.csr_matrix((numImages, numImages))
+    points = np.concatenate(sampled)
+
+    if index is None:
+        index = neighbors.BruteForceIndex()
+    index.fit(points)
+    _, indices = index.queryExcluding(points, votesPerSample, labels, labels)
+
+    voted = np.where(indices >= 0, labels[np.maximum(indices, 0)], -1)
+    voted = voted.ravel()
+    # Every image at most once per sample
+    sample = np.repeat(np.arange(len(points)), votesPerSample)[voted >= 0]
+    pairs = np.unique(np.stack([sample, voted[voted >= 0]], 1), axis=0)
+    rows = labels[pairs[:, 0]]
+    votes = sparse.coo_matrix((np.ones(len(pairs)), (rows, pairs[:, 1])),
+        shape=(numImages, numImages)).tocsr()
+    return votes + votes.T
+
+
+def globalScores(globalDescriptors, neighborCount):
+    '''
+    Scores pairs of images by the cosine similarity of global (per image)
+    descriptors, such as bag of words histograms.
+    Input:
+        globalDescriptors -- N x D numpy array
+        neighborCount -- number of most similar images kept per image
+    Output:
+        N x N scipy.sparse.csr_matrix with the similarity of every image to
+        its neighborCount most similar images
+    '''
+    g = np.asarray(globalDescriptors, dtype=np.float32)
+    numImages = g.shape[0]
+    norms = np.sqrt((g**2).sum(1, keepdims=True))
+    g = g / np.maximum(norms, 1e-12)
+    # For unit vectors the nearest neighbours are the most similar ones
+    dists, indices = neighbors.BruteForceIndex().fit(g).query(g,
+        min(neighborCount + 1, numImages))
+    rows = np.repeat(np.arange(numImages), indices.shape[1])
+    cols = indices.ravel()
+    keep = (cols >= 0) & (cols != rows)
+    similarity = 1 - 0.5 * dists.ravel()**2
+    return sparse.csr_matrix((similarity[keep], (rows[keep], cols[keep])),
+        shape=(numImages, numImages))
+
+
+def topPairs(scores, neighborCount):
+    '''
+    Input:
+        scores -- N x N scipy.sparse matrix of pair scores, higher is better
+        neighborCount -- number of candidates per image
+    Output:
+        sorted list of (i, j, score) with i < j, the union of the
+        neighborCount best scoring partners of every image
+    '''
+    scores = sparse.csr_matrix(scores)
+    pairs = {}
+    for i in range(scores.shape[0]):
+        row = scores.getrow(i)
+        cols, values = row.indices, row.data
+        keep = (cols != i) & (values > 0)
+        cols, values = cols[keep], values[keep]
+        best = np.argsort(-values, kind='stable')[:neighborCount]
+        for j, score in zip(cols[best].tolist(), values[best].tolist()):
+            key = (min(i, j), max(i, j))
+            pairs[key] = max(pairs.get(key, 0), score)
+    return [(i, j, score) for (i, j), score in sorted(pairs.items())]
+
+
+## Match graph #################################################################
+class MatchGraph(object):
+    '''
+    Sparse graph of the verified matches of an image collection. Every edge
+    (i, j) with i < j holds the match arrays (queryIdx into image i,
+    trainIdx into image j, distance), its number of inliers and the score
+    that selected the pair.
+    '''
+    def __init__(self, numImages, names=None):
+        self.numImages = numImages
+        self.names = list(names) if names is not None else None
+        self.edges = {}
+
+    def addEdge(self, i, j, matches, inliers, score=0.0):
+        if i > j:
+            i, j = j, i
+            matches = (matches[1], matches[0]) + tuple(matches[2:])
+        self.edges[(i, j)] = (tuple(np.asarray(a) for a in matches[:3]),
+                              int(inliers), float(score))
+
+    def __len__(self):
+        return len(self.edges)
+
+    def __contains__(self, pair):
+        return (min(pair), max(pair)) in self.edges
+
+    def matches(self, i, j):
+        '''Match arrays from image i to image j.'''
+        m, _, _ = self.edges[(min(i, j), max(i, j))]
+        return m if i < j else (m[1], m[0], m[2])
+
+    def inliers(self, i, j):
+        return self.edges[(min(i, j), max(i, j))][1]
+
+    def neighbors(self, i):
+        '''Images connected to image i, by decreasing number of inliers.'''
+        found = [(j if a == i else a, inliers)
+                 for (a, j), (_, inliers, _) in self.edges.items()
+                 if i in (a, j)]
+        return [j for j, _ in sorted(found, key=lambda e: -e[1])]
+
+    def inlierMatrix(self, minInliers=0):
+        '''
+        N x N symmetric scipy.sparse.csr_matrix with the number of inliers
+        of every edge with at least minInliers of them.
+        '''
+        edges = [(i, j, n) for (i, j), (_, n, _) in self.edges.items()
+                 if n >= minInliers]
+        if not edges:
+            return sparse.csr_matrix((self.numImages, self.numImages))
+        i, j, n = np.array(edges).T
+        m = sparse.coo_matrix((n, (i, j)),
+            shape=(self.numImages, self.numImages)).tocsr()
+        return m + m.T
+
+    def save(self, path):
+        '''
+        Saves the graph as a feature file (see featureio.saveFeatures), with
+        the matches of all edges concatenated and their imgIdx set to the
+        edge number.
+        '''
+        keys = sorted(self.edges)
+        columns = [[], [], []]
+        for key in keys:
+            for c, a in zip(columns, self.edges[key][0]):
+                c.append(a)
+        counts = [len(self.edges[key][0][0]) for key in keys]
+        imgIdx = np.repeat(np.arange(len(keys)), counts)
+        matches = tuple(np.concatenate(c) if c else np.zeros(0)
+                        for c in columns) + (imgIdx,)
+        extra = {}
+        if self.names is not None:
+            extra['names'] = np.array(self.names)
+        featureio.saveFeatures(path, matches=matches,
+            numImages=np.array(self.numImages),
+            edges=np.array(keys, np.int64).reshape(-1, 2),
+            inliers=np.array([self.edges[k][1] for k in keys], np.int64),
+            scores=np.array([self.edges[k][2] for k in keys]), **extra)
+
+    @staticmethod
+    def load(path):
+        with featureio.loadFeatures(path, mmap=False) as f:
+            names = f['names'].tolist() if 'names' in f else None
+            graph = MatchGraph(int(f['numImages']), names)
+            queryIdx, trainIdx, distance, imgIdx = f.matchArrays()
+            edges, inliers, scores = f['edges'], f['inliers'], f['scores']
+        starts = np.searchsorted(imgIdx, np.arange(len(edges) + 1))
+        for e, (i, j) in enumerate(edges.tolist()):
+            rows = slice(starts[e], starts[e + 1])
+            graph.edges[(i, j)] = ((queryIdx[rows], trainIdx[rows],
+                distance[rows]), int(inliers[e]), float(scores[e]))
+        return graph
+
+
+## Collection matching #########################################################
+def matchPairTask(task):
+    '''
+    Matches and verifies one pair of images, in a worker process. Only the
+    best match of every feature of image 2 is verified.
+    Input:
+        task -- (points1, desc1, points2, desc2, matcherConfig, maxDistance,
+                 ransacThreshold)
+    Output:
+        match arrays of the inliers, and their number
+    '''
+    points1, desc1, points2, desc2, matcherConfig, maxDistance, \
+        ransacThreshold = task
+    matches = benchmark.make_component(matcherConfig).matchIndices(
+        desc1, desc2)
+    matches = matchfilter.selectMatches(matches,
+        matchfilter.oneToOneMask(matches[1], matches[2]))
+    matches = matchfilter.MatchFilter(maxDistance, verify=True,
+        ransacThreshold=ransacThreshold).filter(points1, points2, matches)
+    return matches, len(matches[0])
+
+
+class CollectionMatcher(object):
+    '''
+    Matches an image collection in two steps:
+        1. rankPairs scores all pairs cheaply, by keypoint votes or by the
+           similarity of global descriptors, and keeps the `neighbors` best
+           partners of every image
+        2. match matches the kept pairs fully, in worker processes, and
+           verifies them with a RANSAC homography
+    so only about N * neighbors pairs are matched instead of N(N - 1) / 2.
+    '''
+    def __init__(self, matcherConfig='RatioFeatureMatcher', neighbors=5,
+                 samples=256, votesPerSample=4, index=None, maxDistance=0.8,
+                 ransacThreshold=3.0, minInliers=10, workers=None):
+        '''
+        Input:
+            matcherConfig -- the matcher, see benchmark.make_component
+            neighbors -- number of candidate partners per image
+            samples, votesPerSample, index -- the keypoint voting, see
+                voteScores
+            maxDistance -- matches with a larger distance (or ratio) are
+                dropped before the verification, None to keep all
+            ransacThreshold -- maximum reprojection error of an inlier
+            minInliers -- edges with fewer inliers are left out of the graph
+            workers -- number of worker processes, None for one per CPU
+        '''
+        self.matcherConfig = matcherConfig
+        self.neighbors = neighbors
+        self.samples = samples
+        self.votesPerSample = votesPerSample
+        self.index = index
+        self.maxDistance = maxDistance
+        self.ransacThreshold = ransacThreshold
+        self.minInliers = minInliers
+        self.workers = workers
+
+    def rankPairs(self, descriptors, responses=None, globalDescriptors=None):
+        '''
+        Input:
+            descriptors -- list with the descriptor array of every image
+            responses -- optional list of keypoint responses, see voteScores
+            globalDescriptors -- optional N x D array of global descriptors,
+                                 which replace the keypoint votes
+        Output:
+            list of candidate pairs (i, j, score), see topPairs
+        '''
+        if globalDescriptors is not None:
+            scores = globalScores(globalDescriptors, self.neighbors)
+        else:
+            scores = voteScores(descriptors, responses, self.samples,
+                self.votesPerSample, self.index)
+        return topPairs(scores, self.neighbors)
+
+    def match(self, keypoints, descriptors, globalDescriptors=None,
+              names=None):
+        '''
+        Input:
+            keypoints -- list with the keypoints of every image, as lists of
+                         cv2.KeyPoint objects or KEYPOINT_DTYPE arrays
+            descriptors -- list with the descriptor array of every image
+            globalDescriptors -- see rankPairs
+            names -- optional image names stored in the graph
+        Output:
+            MatchGraph of the verified pairs
+        '''
+        arrays = [featureio.keypointArray(kps) for kps in keypoints]
+        points = [np.stack([a['x'], a['y']], 1).astype(np.float64)
+                  for a in arrays]
+        pairs = self.rankPairs(descriptors, [a['response'] for a in arrays],
+            globalDescriptors)
+
+        tasks = [(points[i], descriptors[i], points[j], descriptors[j],
+                  self.matcherConfig, self.maxDistance, self.ransacThreshold)
+                 for i, j, _ in pairs]
+        graph = MatchGraph(len(descriptors), names)
+        results = extract.runTasks(matchPairTask, tasks, self.workers)
+        for (i, j, score), (matches, inliers) in zip(pairs, results):
+            if inliers >= self.minInliers:
+                graph.addEdge(i, j, matches, inliers, score)
+        return graph
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Match an image collection '
+        'from its feature files.')
+    parser.add_argument('features', help='directory of feature files, see '
+        'extract.py')
+    parser.add_argument('output', help='match graph file (.npz)')
+    parser.add_argument('--matcher', default='RatioFeatureMatcher')
+    parser.add_argument('--matcher-args', default=None)
+    parser.add_argument('--neighbors', type=int, default=5)
+    parser.add_argument('--samples', type=int, default=256)
+    parser.add_argument('--min-inliers', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(args.features):
+        dirnames[:] = sorted(d for d in dirnames if d != 'matches')
+        paths.extend(os.path.join(dirpath, fn) for fn in sorted(filenames)
+                     if fn.endswith('.npz'))
+    keypoints, descriptors = [], []
+    for path in paths:
+        with featureio.loadFeatures(path, mmap=False) as f:
+            keypoints.append(f.keypointArray())
+            descriptors.append(f['descriptors'])
+
+    matcher = CollectionMatcher(extract.componentConfig(args.matcher,
+        args.matcher_args), args.neighbors, args.samples,
+        minInliers=args.min_inliers, workers=args.workers)
+    names = [os.path.relpath(p, args.features) for p in paths]
+    graph = matcher.match(keypoints, descriptors, names=names)
+    graph.save(args.output)
+    print('{} images, {} edges'.format(len(paths), len(graph)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+'''
+Compact descriptor representations. A DescriptorCompressor stores float
+descriptors (such as the float64 MOPS ones) as float32, float16 or int8,
+optionally after a PCA projection to fewer dimensions. The compact arrays
+are matched directly by the feature matchers (see
+neighbors.BruteForceIndex), and benchmark.benchmark_compression measures
+what they cost in accuracy.
+
+Compressors that quantize or project are learned from a training set:
+
+    python compact.py IMAGES MODEL.npz --dtype int8 --dimensions 32
+
+and used in a benchmark with features.CompactFeatureDescriptor, e.g.
+
+    python benchmark.py resources/yosemite --compressors MODEL.npz
+'''
+import argparse
+import hashlib
+import sys
+
+import cv2
+import numpy as np
+
+import featureio
+import imagecontext
+
+
+DTYPES = ('float64', 'float32', 'float16', 'int8')
+
+
+## Descriptor compression ######################################################
+class DescriptorCompressor(object):
+    '''
+    Converts N x D float descriptors to a compact N x d array:
+        - an optional PCA projection to d = dimensions components, learned
+          from training descriptors (fit). Euclidean distances between
+          projected descriptors approximate the original ones.
+        - storage as float32 or float16, or symmetric int8 quantization
+          round(x / scale), clipped to [-127, 127]. The scale is calibrated
+          on the training descriptors, so that the given percentile of
+          their absolute values maps to 127; the few larger values clip.
+    Distances between int8 descriptors are in units of scale, which does
+    not change nearest neighbours or ratio test scores.
+    '''
+    def __init__(self, dtype='float32', dimensions=None, percentile=99.9):
+        '''
+        Input:
+            dtype -- one of DTYPES, the type of the compact descriptors
+            dimensions -- number of PCA components, None to keep all
+                          dimensions without projecting
+            percentile -- percentile of the absolute training values that
+                          the int8 scale is calibrated to
+        '''
+        if dtype not in DTYPES:
+            raise ValueError('Unknown descriptor dtype ' + str(dtype))
+        self.dtype = dtype
+        self.dimensions = dimensions
+        self.percentile = percentile
+        self.mean = None
+        self.components = None
+        self.scale = 1.0
+        self.fitted = not self.needsTraining
+
+    @property
+    def needsTraining(self):
+        return self.dimensions is not None or self.dtype == 'int8'
+
+    @property
+    def name(self):
+        if self.dimensions is None:
+            return self.dtype
+        return '{} PCA-{}'.format(self.dtype, self.dimensions)
+
+    def __repr__(self):
+        # Stable, and different for different training results, see
+        # featurecache.componentSignature
+        h = hashlib.sha1(repr((self.dtype, self.dimensions, self.scale,
+                               self.fitted)).encode())
+        for array in (self.mean, self.components):
+            if array is not None:
+                h.update(np.ascontiguousarray(array).data)
+        return 'DescriptorCompressor({}, {}, {})'.format(self.dtype,
+            self.dimensions, h.hexdigest())
+
+    def fit(self, training):
+        '''
+        Learns the PCA projection and the int8 scale.
+        Input:
+            training -- N x D numpy array of descriptors
+        Output:
+            self, so that calls can be chained
+        '''
+        training = np.asarray(training, dtype=np.float64)
+        assert training.ndim == 2 and training.shape[0] > 0
+        if self.dimensions is not None:
+            if self.dimensions > training.shape[1]:
+                raise ValueError('Cannot project {}-D descriptors to {} '
+                    'dimensions'.format(training.shape[1], self.dimensions))
+            self.mean = training.mean(0)
+            # The right singular vectors are the principal axes, in order
+            # of decreasing variance
+            _, _, vt = np.linalg.svd(training - self.mean,
+                full_matrices=False)
+            self.components = vt[:self.dimensions].T.copy()
+        if self.dtype == 'int8':
+            values = np.abs(self.project(training))
+            limit = np.percentile(values, self.percentile)
+            self.scale = float(limit) / 127 if limit > 0 else 1.0
+        self.fitted = True
+        return self
+
+    def project(self, desc):
+        '''desc projected by the PCA, or unchanged without it.'''
+        if self.components is None:
+            return desc
+        return np.dot(desc - self.mean, self.components)
+
+    def compress(self, desc):
+        '''
+        Input:
+            desc -- N x D numpy array of float descriptors
+        Output:
+            N x d numpy array of the dtype of the compressor
+        '''
+        if not self.fitted:
+            raise ValueError('The compressor needs to be fit to training '
+                             'descriptors first')
+        desc = self.project(np.asarray(desc, dtype=np.float64))
+        if self.dtype == 'int8':
+            return np.clip(np.rint(desc / self.scale), -127,
+                           127).astype(np.int8)
+        return desc.astype(self.dtype)
+
+    def decompress(self, compact):
+        '''
+        The float64 descriptors (in the projected space) represented by a
+        compress output, e.g. to measure the quantization error.
+        '''
+        return np.asarray(compact, dtype=np.float64) * self.scale
+
+    def bytesPerDescriptor(self, dimensions):
+        '''Storage of one compact descriptor of dimensions values.'''
+        if self.dimensions is not None:
+            dimensions = self.dimensions
+        return dimensions * np.dtype(self.dtype).itemsize
+
+    def save(self, path):
+        '''Saves a fitted compressor as a feature file, see load.'''
+        arrays = {'dtype': np.array(self.dtype),
+                  'params': np.array([self.percentile, self.scale])}
+        if self.components is not None:
+            arrays.update(mean=self.mean, components=self.components)
+        featureio.saveFeatures(path, **arrays)
+
+    @staticmethod
+    def load(path):
+        with featureio.loadFeatures(path) as f:
+            percentile, scale = np.asarray(f['params']).tolist()
+            components = None
+            if 'components' in f:
+                components = np.asarray(f['components'])
+            compressor = DescriptorCompressor(str(f['dtype']),
+                None if components is None else components.shape[1],
+                percentile)
+            compressor.scale = scale
+            if components is not None:
+                compressor.mean = np.asarray(f['mean'])
+                compressor.components = components
+        compressor.fitted = True
+        return compressor
+
+
+def trainingDescriptors(images, keypointDetector, featureDescriptor,
+                        kpThreshold, maxDescriptors=100000, seed=0):
+    '''
+    Input:
+        images -- iterable of uint8 BGR images
+        keypointDetector, featureDescriptor -- the components whose
+                                               descriptors are compressed
+        kpThreshold -- minimum keypoint response
+        maxDescriptors -- the result is sampled down to this many rows
+    Output:
+        numpy array of the descriptors of all images
+    '''
+    descriptors = []
+    for image in images:
+        context = imagecontext.ImageContext(image)
+        keypoints = [kp for kp in keypointDetector.detectKeypoints(context)
+                     if kp.response >= kpThreshold]
+        desc = featureDescriptor.describeFeatures(context, keypoints)
+        if len(desc):
+            descriptors.append(np.asarray(desc))
+    if not descriptors:
+        raise ValueError('No training descriptors')
+    descriptors = np.concatenate(descriptors)
+    if descriptors.shape[0] > maxDescriptors:
+        rng = np.random.RandomState(seed)
+        rows = np.sort(rng.choice(descriptors.shape[0], maxDescriptors,
+                                  replace=False))
+        descriptors = descriptors[rows]
+    return descriptors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Learn a descriptor '
+        'compressor (PCA and int8 scale) from a directory or manifest of '
+        'images.')
+    parser.add_argument('images', help='image directory or manifest file')
+    parser.add_argument('output', help='compressor file (.npz)')
+    parser.add_argument('--recursive', action='store_true',
+        help='include images in subdirectories')
+    parser.add_argument('--dtype', choices=DTYPES, default='int8')
+    parser.add_argument('--dimensions', type=int, default=None,
+        help='number of PCA components, all dimensions if not given')
+    parser.add_argument('--percentile', type=float, default=99.9,
+        help='percentile of the values that the int8 scale maps to 127')
+    parser.add_argument('--detector', default='HarrisKeypointDetector')
+    parser.add_argument('--descriptor', default='MOPSFeatureDescriptor')
+    parser.add_argument('--kp-threshold', type=float, default=1e-2)
+    parser.add_argument('--max-descriptors', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    # Imported here, they import features, which imports this module
+    import benchmark
+    import extract
+    images = (cv2.imread(path) for _, path in
+              extract.listImages(args.images, args.recursive))
+    training = trainingDescriptors((image for image in images
+                                    if image is not None),
+        benchmark.make_component(args.detector),
+        benchmark.make_component(args.descriptor), args.kp_threshold,
+        args.max_descriptors)
+    compressor = DescriptorCompressor(args.dtype, args.dimensions,
+        args.percentile).fit(training)
+    compressor.save(args.output)
+    print('Trained on {} descriptors: {} bytes per descriptor instead of '
+          '{}'.format(training.shape[0],
+                      compressor.bytesPerDescriptor(training.shape[1]),
+                      training[0].nbytes))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+'''
+Headless feature extraction for directories of images:
+
+    python extract.py IMAGES OUTPUT [--detector HarrisKeypointDetector]
+        [--descriptor MOPSFeatureDescriptor] [--kp-threshold 0.01]
+        [--match consecutive|all --matcher RatioFeatureMatcher]
+
+IMAGES is a directory or a manifest (a text file with one image path per
+line, relative to the manifest; lines starting with # are ignored). The
+keypoints and descriptors of every image are written to OUTPUT as feature
+files (see featureio.saveFeatures), mirroring the input layout, e.g.
+OUTPUT/sub/img1.png.npz. Matches go to OUTPUT/matches/. Runs are resumable:
+outputs that are newer than their inputs and were computed with the same
+configuration are skipped, unless --force is given.
+'''
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import benchmark
+import featurecache
+import featureio
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.pgm', '.bmp', '.tif',
+                    '.tiff')
+
+
+## Inputs ######################################################################
+def listImages(source, recursive=False):
+    '''
+    Input:
+        source -- a directory or a manifest file
+        recursive -- if True, images in subdirectories are included
+    Output:
+        sorted list of (key, path) tuples, where key is the path relative to
+        the directory (or manifest) and names the outputs
+    '''
+    if os.path.isdir(source):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            paths.extend(os.path.join(dirpath, fn) for fn in filenames
+                         if fn.lower().endswith(IMAGE_EXTENSIONS))
+            if not recursive:
+                break
+        root = source
+    else:
+        root = os.path.dirname(os.path.abspath(source))
+        with open(source) as f:
+            paths = [os.path.join(root, line.strip()) for line in f
+                     if line.strip() and not line.startswith('#')]
+
+    images = []
+    for path in paths:
+        key = os.path.relpath(path, root)
+        if key.startswith(os.pardir):
+            # Outside of the manifest's directory, keep the name unique
+            key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8] \
+                + '_' + os.path.basename(path)
+        images.append((key.replace(os.sep, '/'), path))
+    return sorted(images)
+
+
+def configHash(*parts):
+    '''Hash of components (see featurecache.componentSignature) and values.'''
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, (str, int, float)):
+            part = featurecache.componentSignature(part)
+        h.update(repr(part).encode())
+    return h.hexdigest()
+
+
+def isUpToDate(output, inputs, config):
+    '''
+    True if the feature file output exists, is newer than all inputs and
+    was written with the given configuration hash.
+    '''
+    try:
+        mtime = os.path.getmtime(output)
+        if any(os.path.getmtime(path) > mtime for path in inputs):
+            return False
+        with featureio.loadFeatures(output) as f:
+            return 'config' in f and str(f['config']) == config
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+
+
+def saveAtomically(path, **arrays):
+    '''saveFeatures to a temporary file that replaces path when complete.'''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another worker meanwhile
+            if not os.path.isdir(directory):
+                raise
+    tmp = path + '.{}.tmp'.format(os.getpid())
+    featureio.saveFeatures(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+## Tasks #######################################################################
+def extractTask(task):
+    '''
+    Computes and saves the features of one image, in a worker process.
+    Input:
+        task -- (imagePath, output, detectorConfig, descriptorConfig,
+                 kpThreshold, config), see benchmark.make_component
+    Output:
+        number of keypoints
+    '''
+    imagePath, output, detectorConfig, descriptorConfig, kpThreshold, \
+        config = task
+    image = cv2.imread(imagePath)
+    if image is None:
+        raise IOError('Cannot read image ' + imagePath)
+    keypoints, descriptors = benchmark.compute_features(image,
+        benchmark.make_component(detectorConfig),
+        benchmark.make_component(descriptorConfig), kpThreshold)
+    saveAtomically(output, keypoints=keypoints, descriptors=descriptors,
+        config=np.array(config))
+    return len(keypoints)
+
+
+def matchTask(task):
+    '''
+    Matches the descriptors of two feature files and saves the matches.
+    Input:
+        task -- (features1, features2, output, matcherConfig, config)
+    Output:
+        number of matches
+    '''
+    features1, features2, output, matcherConfig, config = task
+    with featureio.loadFeatures(features1) as f1, \
+            featureio.loadFeatures(features2) as f2:
+        desc1 = np.asarray(f1['descriptors'])
+        desc2 = np.asarray(f2['descriptors'])
+    matcher = benchmark.make_component(matcherConfig)
+    matches = matcher.matchIndices(desc1, desc2)
+    saveAtomically(output, matches=matches, config=np.array(config))
+    return len(matches[0])
+
+
+def runTasks(function, tasks, workers):
+    '''Runs function on all tasks in a process pool, results in order.'''
+    if workers == 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(function, tasks))
+
+
+## Extraction ##################################################################
+def featurePath(outputDir, key):
+    return os.path.join(outputDir, *(key + '.npz').split('/'))
+
+
+def matchPath(outputDir, key1, key2):
+    name = '{}--{}.npz'.format(key1.replace('/', '__'),
+                               key2.replace('/', '__'))
+    return os.path.join(outputDir, 'matches', name)
+
+
+def selectPairs(count, mode):
+    '''
+    Input:
+        count -- number of images
+        mode -- 'consecutive', 'all' or None
+    Output:
+        list of (i, j) index pairs with i < j
+    '''
+    if mode == 'consecutive':
+        return [(i, i + 1) for i in range(count - 1)]
+    elif mode == 'all':
+        return [(i, j) for i in range(count) for j in range(i + 1, count)]
+    return []
+
+
+def extractFeatures(images, outputDir, detectorConfig, descriptorConfig,
+                    kpThreshold, workers=None, force=False):
+    '''
+    Input:
+        images -- list of (key, path), see listImages
+        outputDir -- directory of the feature files
+        detectorConfig, descriptorConfig -- see benchmark.make_component
+        kpThreshold -- minimum keypoint response
+        workers -- number of worker processes, None for one per CPU
+        force -- if True, up-to-date outputs are computed again
+    Output:
+        list of the feature file of every image, number of images computed
+    '''
+    config = configHash(benchmark.make_component(detectorConfig),
+        benchmark.make_component(descriptorConfig), float(kpThreshold))
+    outputs = [featurePath(outputDir, key) for key, _ in images]
+    tasks = [(path, output, detectorConfig, descriptorConfig, kpThreshold,
+              config)
+             for (_, path), output in zip(images, outputs)
+             if force or not isUpToDate(output, [path], config)]
+    runTasks(extractTask, tasks, workers)
+    return outputs, len(tasks)
+
+
+def matchFeatureFiles(keys, featureFiles, outputDir, matcherConfig, pairs,
+                      workers=None, force=False):
+    '''
+    Matches the feature files of the given (i, j) index pairs.
+    Output:
+        list of the match file of every pair, number of pairs computed
+    '''
+    config = configHash(benchmark.make_component(matcherConfig))
+    outputs = [matchPath(outputDir, keys[i], keys[j]) for i, j in pairs]
+    tasks = [(featureFiles[i], featureFiles[j], output, matcherConfig, config)
+             for (i, j), output in zip(pairs, outputs)
+             if force or not isUpToDate(output,
+                 [featureFiles[i], featureFiles[j]], config)]
+    runTasks(matchTask, tasks, workers)
+    return outputs, len(tasks)
+
+
+def componentConfig(name, args):
+    '''Config for benchmark.make_component from a name and JSON kwargs.'''
+    return (name, json.loads(args)) if args else name
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract (and match) '
+        'features of a directory or manifest of images.')
+    parser.add_argument('images', help='image directory or manifest file')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--recursive', action='store_true',
+        help='include images in subdirectories')
+    parser.add_argument('--detector', default='HarrisKeypointDetector')
+    parser.add_argument('--detector-args', default=None,
+        help='constructor arguments as JSON, e.g. \'{"backend": "opencv"}\'')
+    parser.add_argument('--descriptor', default='MOPSFeatureDescriptor')
+    parser.add_argument('--descriptor-args', default=None)
+    parser.add_argument('--kp-threshold', type=float, default=1e-2)
+    parser.add_argument('--match', choices=('consecutive', 'all'),
+        default=None, help='also match consecutive or all pairs of images')
+    parser.add_argument('--matcher', default='RatioFeatureMatcher')
+    parser.add_argument('--matcher-args', default=None)
+    parser.add_argument('--workers', type=int, default=None,
+        help='worker processes, 1 to run in this process')
+    parser.add_argument('--force', action='store_true',
+        help='recompute outputs that are up to date')
+    args = parser.parse_args(argv)
+
+    images = listImages(args.images, args.recursive)
+    featureFiles, computed = extractFeatures(images, args.output,
+        componentConfig(args.detector, args.detector_args),
+        componentConfig(args.descriptor, args.descriptor_args),
+        args.kp_threshold, args.workers, args.force)
+    print('Features: {} images, {} computed, {} up to date'.format(
+        len(images), computed, len(images) - computed))
+
+    if args.match:
+        pairs = selectPairs(len(images), args.match)
+        _, computed = matchFeatureFiles([key for key, _ in images],
+            featureFiles, args.output,
+            componentConfig(args.matcher, args.matcher_args), pairs,
+            args.workers, args.force)
+        print('Matches: {} pairs, {} computed, {} up to date'.format(
+            len(pairs), computed, len(pairs) - computed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
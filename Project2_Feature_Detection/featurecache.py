@@ -0,0 +1,203 @@
+import collections
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+import featureio
+import imagecontext
+
+
+## Feature cache ###############################################################
+def imageHash(image):
+    '''Content hash of an image (pixels, shape and dtype).'''
+    image = np.ascontiguousarray(image)
+    h = hashlib.sha1(str((image.shape, image.dtype.str)).encode())
+    h.update(image.data)
+    return h.hexdigest()
+
+
+def componentSignature(component):
+    '''
+    Identifies a detector or descriptor by its class and parameters (its
+    instance attributes), so that differently configured instances get
+    different cache entries.
+    '''
+    cls = type(component)
+    # Nested components (e.g. the index of a matcher) by their signature,
+    # their default repr contains their address
+    params = sorted((k, componentSignature(v) if hasattr(v, '__dict__') and
+                     type(v).__repr__ is object.__repr__ else repr(v))
+                    for k, v in vars(component).items())
+    return '{}.{}{}'.format(cls.__module__, cls.__name__, params)
+
+
+class FeatureCache(object):
+    '''
+    Caches keypoints and descriptors, keyed by the content hash of the image
+    and the signature of the detector and descriptor that computed them.
+    Recently used entries are kept in memory, and optionally on disk as
+    uncompressed .npz files, so that features survive across runs and can
+    be shared between processes. Both levels evict the least recently used
+    entries first.
+
+    The cache does not know about code changes: bump version (or clear the
+    directory) after changing a detector or descriptor implementation.
+    '''
+    def __init__(self, directory=None, maxMemoryEntries=32,
+                 maxDiskBytes=2**30, version=1):
+        '''
+        Input:
+            directory -- directory of the on-disk cache, None to only cache
+                         in memory
+            maxMemoryEntries -- number of entries kept in memory
+            maxDiskBytes -- size bound of the on-disk cache
+            version -- part of every key, change it to invalidate entries
+        '''
+        self.directory = directory
+        self.maxMemoryEntries = maxMemoryEntries
+        self.maxDiskBytes = maxDiskBytes
+        self.version = version
+        self.memory = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, image, *parts):
+        '''
+        Cache key of an image (an array, an imagecontext.ImageContext or
+        its imageHash) and any number of components or values.
+        '''
+        if isinstance(image, imagecontext.ImageContext):
+            image = image.image
+        if isinstance(image, np.ndarray):
+            image = imageHash(image)
+        h = hashlib.sha1(str(self.version).encode())
+        h.update(image.encode())
+        for part in parts:
+            if not isinstance(part, (str, int, float)):
+                part = componentSignature(part)
+            h.update(repr(part).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        '''
+        Output:
+            dict of the numpy arrays stored under key, or None on a miss
+        '''
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.directory is not None:
+            try:
+                with np.load(self.path(key)) as f:
+                    entry = dict(f.items())
+                # Mark the file as recently used for the disk eviction
+                os.utime(self.path(key), None)
+            except (IOError, OSError, ValueError):
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                self.remember(key, entry)
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, key, **arrays):
+        '''Stores the given numpy arrays under key.'''
+        self.remember(key, arrays)
+        if self.directory is None:
+            return
+
+        # Write to a temporary file first, so that concurrent readers never
+        # see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, self.path(key))
+        self.evictDisk()
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxMemoryEntries:
+            self.memory.popitem(last=False)
+
+    def evictDisk(self):
+        entries = []
+        for fn in os.listdir(self.directory):
+            if fn.endswith('.npz'):
+                path = os.path.join(self.directory, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxDiskBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.memory.clear()
+        if self.directory is not None:
+            for fn in os.listdir(self.directory):
+                if fn.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, fn))
+
+    def detectKeypoints(self, image, keypointDetector, digest=None):
+        '''
+        Same as keypointDetector.detectKeypoints(image), but cached. image
+        may be an imagecontext.ImageContext. digest is the imageHash of the
+        image, if it is already known.
+        '''
+        key = self.key(digest or image, 'detect', keypointDetector)
+        entry = self.get(key)
+        if entry is None:
+            keypoints = keypointDetector.detectKeypoints(image)
+            entry = {'keypoints': featureio.packKeypoints(keypoints)}
+            self.put(key, **entry)
+            return keypoints
+        return featureio.unpackKeypoints(entry['keypoints'])
+
+    def computeFeatures(self, image, keypointDetector, featureDescriptor,
+                        kpThreshold):
+        '''
+        Detects the keypoints of image, keeps the ones with a response of
+        at least kpThreshold and describes them. Both the detection and the
+        description are cached, so changing only kpThreshold skips the
+        detection. The detector and the descriptor share one
+        imagecontext.ImageContext of the image.
+        Output:
+            keypoints -- list of the thresholded cv2.KeyPoint objects
+            descriptors -- their descriptors
+        '''
+        context = imagecontext.ImageContext.of(image)
+        digest = imageHash(context.image)
+        key = self.key(digest, 'describe', keypointDetector,
+            featureDescriptor, float(kpThreshold))
+        entry = self.get(key)
+        if entry is not None:
+            return (featureio.unpackKeypoints(entry['keypoints']),
+                    entry['descriptors'])
+
+        keypoints = self.detectKeypoints(context, keypointDetector, digest)
+        keypoints = [kp for kp in keypoints if kp.response >= kpThreshold]
+        descriptors = featureDescriptor.describeFeatures(context, keypoints)
+        self.put(key, keypoints=featureio.packKeypoints(keypoints),
+            descriptors=np.asarray(descriptors))
+        return keypoints, descriptors
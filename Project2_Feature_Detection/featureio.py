@@ -0,0 +1,513 @@
+import base64
+import json
+import struct
+import zipfile
+
+import cv2
+import numpy as np
+
+
+## Keypoint arrays #############################################################
+# cv2.KeyPoint objects stored column-wise in a structured numpy array. All
+# fields have the precision OpenCV stores them with, so packing is lossless.
+KEYPOINT_DTYPE = np.dtype([('x', np.float32), ('y', np.float32),
+                           ('size', np.float32), ('angle', np.float32),
+                           ('response', np.float32), ('octave', np.int32),
+                           ('class_id', np.int32)])
+
+
+def packKeypoints(keypoints):
+    '''
+    Input:
+        keypoints -- list of cv2.KeyPoint objects
+    Output:
+        numpy array of KEYPOINT_DTYPE with one entry per keypoint
+    '''
+    packed = np.empty(len(keypoints), KEYPOINT_DTYPE)
+    if len(keypoints) == 0:
+        return packed
+    packed['x'], packed['y'] = np.array([kp.pt for kp in keypoints]).T
+    packed['size'] = [kp.size for kp in keypoints]
+    packed['angle'] = [kp.angle for kp in keypoints]
+    packed['response'] = [kp.response for kp in keypoints]
+    packed['octave'] = [kp.octave for kp in keypoints]
+    packed['class_id'] = [kp.class_id for kp in keypoints]
+    return packed
+
+
+def unpackKeypoints(packed):
+    '''
+    Input:
+        packed -- numpy array of KEYPOINT_DTYPE
+    Output:
+        list of cv2.KeyPoint objects
+    '''
+    columns = [packed[name].tolist() for name in KEYPOINT_DTYPE.names]
+    return [cv2.KeyPoint(*fields) for fields in zip(*columns)]
+
+
+def keypointArray(keypoints):
+    '''Packs keypoints, unless they already are a KEYPOINT_DTYPE array.'''
+    if isinstance(keypoints, np.ndarray) and keypoints.dtype == KEYPOINT_DTYPE:
+        return keypoints
+    return packKeypoints(keypoints)
+
+
+## Match arrays ################################################################
+MATCH_FIELDS = ('queryIdx', 'trainIdx', 'distance', 'imgIdx')
+MATCH_DTYPES = (np.int32, np.int32, np.float32, np.int32)
+
+
+def matchArrays(matches):
+    '''
+    Input:
+        matches -- list of cv2.DMatch objects, or a tuple of match arrays
+                   (queryIdx, trainIdx, distance[, imgIdx]) as returned by
+                   FeatureMatcher.matchIndices
+    Output:
+        tuple of the numpy arrays (queryIdx, trainIdx, distance, imgIdx)
+    '''
+    if isinstance(matches, tuple):
+        columns = list(matches)
+        if len(columns) == 3:
+            columns.append(np.zeros(len(columns[0]), np.int32))
+    else:
+        columns = [[getattr(m, name) for m in matches] for name in MATCH_FIELDS]
+    return tuple(np.asarray(c, dtype) for c, dtype in zip(columns, MATCH_DTYPES))
+
+
+def dmatches(queryIdx, trainIdx, distance, imgIdx=None):
+    '''Converts match arrays to a list of cv2.DMatch objects.'''
+    if imgIdx is None:
+        imgIdx = np.zeros(len(queryIdx), np.int32)
+    return [cv2.DMatch(q, t, i, d) for q, t, d, i in zip(queryIdx.tolist(),
+        trainIdx.tolist(), distance.tolist(), imgIdx.tolist())]
+
+
+## Binary feature files ########################################################
+# A feature file is a .npz archive with one .npy member per column:
+#     version             -- FORMAT_VERSION of the writer
+#     keypoints/<field>   -- one member per field of KEYPOINT_DTYPE
+#     descriptors         -- N x D descriptor array
+#     matches/<field>     -- one member per field of MATCH_FIELDS
+# plus any extra arrays. Every part is optional. Columns are only read when
+# accessed, and the members of uncompressed files are memory-mapped, so
+# reading e.g. the keypoint responses of a large file is cheap.
+FORMAT_VERSION = 1
+
+
+def saveFeatures(path, keypoints=None, descriptors=None, matches=None,
+                 compress=False, **extra):
+    '''
+    Input:
+        path -- output file, conventionally with the extension .npz
+        keypoints -- list of cv2.KeyPoint objects or a KEYPOINT_DTYPE array
+        descriptors -- numpy array of descriptors
+        matches -- list of cv2.DMatch objects or a tuple of match arrays
+        compress -- if True, the columns are zlib compressed, which makes
+                    the file smaller but cannot be memory-mapped
+        extra -- further numpy arrays to store
+    '''
+    arrays = dict(extra)
+    arrays['version'] = np.array(FORMAT_VERSION)
+    if keypoints is not None:
+        packed = keypointArray(keypoints)
+        for name in KEYPOINT_DTYPE.names:
+            arrays['keypoints/' + name] = packed[name]
+    if descriptors is not None:
+        arrays['descriptors'] = np.asarray(descriptors)
+    if matches is not None:
+        for name, column in zip(MATCH_FIELDS, matchArrays(matches)):
+            arrays['matches/' + name] = column
+
+    save = np.savez_compressed if compress else np.savez
+    with open(path, 'wb') as f:
+        save(f, **arrays)
+
+
+class FeatureFile(object):
+    '''
+    Read access to a feature file written by saveFeatures. Columns are
+    loaded lazily:
+        f['keypoints/response'] -- a single column (numpy array)
+        f['keypoints']          -- list of cv2.KeyPoint objects
+        f['descriptors']        -- the descriptor array
+        f['matches']            -- list of cv2.DMatch objects
+    keypointArray and matchArrays give the keypoints and matches as arrays
+    instead.
+    '''
+    def __init__(self, path, mmap=True):
+        '''
+        Input:
+            path -- the feature file
+            mmap -- if True, uncompressed columns are memory-mapped rather
+                    than read into memory
+        '''
+        self.path = path
+        self.mmap = mmap
+        self.archive = zipfile.ZipFile(path)
+        self.members = dict((info.filename[:-len('.npy')], info)
+            for info in self.archive.infolist()
+            if info.filename.endswith('.npy'))
+        self.columns = {}
+
+        version = int(self.column('version'))
+        if version > FORMAT_VERSION:
+            raise ValueError('{} has feature file version {}, newer than the '
+                'supported version {}'.format(path, version, FORMAT_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.archive.close()
+        self.columns.clear()
+
+    def keys(self):
+        return sorted(self.members)
+
+    def __contains__(self, name):
+        return name in self.members or \
+            any(key.startswith(name + '/') for key in self.members)
+
+    def __getitem__(self, name):
+        if name == 'keypoints':
+            return unpackKeypoints(self.keypointArray())
+        if name == 'matches':
+            return dmatches(*self.matchArrays())
+        return self.column(name)
+
+    def column(self, name):
+        if name not in self.columns:
+            if name not in self.members:
+                raise KeyError(name)
+            self.columns[name] = self.readMember(self.members[name])
+        return self.columns[name]
+
+    def keypointArray(self):
+        columns = [self.column('keypoints/' + name)
+                   for name in KEYPOINT_DTYPE.names]
+        packed = np.empty(len(columns[0]), KEYPOINT_DTYPE)
+        for name, column in zip(KEYPOINT_DTYPE.names, columns):
+            packed[name] = column
+        return packed
+
+    def matchArrays(self):
+        return tuple(self.column('matches/' + name) for name in MATCH_FIELDS)
+
+    def readMember(self, info):
+        if not self.mmap or info.compress_type != zipfile.ZIP_STORED:
+            with self.archive.open(info) as f:
+                return np.lib.format.read_array(f)
+
+        # The member is stored as is, so its array data can be mapped
+        # straight from the archive: skip the zip local file header and the
+        # .npy header
+        with open(self.path, 'rb') as f:
+            f.seek(info.header_offset)
+            header = f.read(30)
+            nameLength, extraLength = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + nameLength + extraLength)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+
+        if dtype.hasobject:
+            raise ValueError('{}: object arrays are not supported'.format(
+                info.filename))
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype)
+        return np.memmap(self.path, dtype, 'r', offset, shape,
+                         'F' if fortran else 'C')
+
+
+def loadFeatures(path, mmap=True):
+    '''Opens a feature file, see FeatureFile.'''
+    return FeatureFile(path, mmap)
+
+
+## JSON feature files ##########################################################
+# JSON is kept for interop with other tools. Keypoints and matches are
+# objects tagged with a '__type__', arrays store their raw bytes in base64:
+#     {"__type__": "numpy.ndarray", "__shape__": [2, 3], "__dtype__": "<f4",
+#      "__base64__": "..."}
+# Files written by earlier versions list the array values in '__array__'
+# instead, which can still be read. JSONFeatureWriter and JSONFeatureReader
+# stream documents whose top level is an object, one item, list element or
+# array chunk at a time, so memory stays flat for large feature sets.
+
+def encodeJSON(o):
+    '''
+    Converts a cv2.KeyPoint, cv2.DMatch or numpy array to a JSON-serializable
+    dict, for use as the default of json.dump. Raises TypeError for anything
+    else.
+    '''
+    if hasattr(o, 'pt') and hasattr(o, 'size') and hasattr(o, 'angle') and \
+       hasattr(o, 'response') and hasattr(o, 'octave') and \
+       hasattr(o, 'class_id'):
+        return {'__type__'  : 'cv2.KeyPoint',
+                'point'     : o.pt,
+                'size'      : o.size,
+                'angle'     : o.angle,
+                'response'  : o.response,
+                'octave'    : o.octave,
+                'class_id'  : o.class_id}
+
+    elif hasattr(o, 'distance') and hasattr(o, 'trainIdx') and \
+         hasattr(o, 'queryIdx') and hasattr(o, 'imgIdx'):
+        return {'__type__'  : 'cv2.DMatch',
+                'distance'  : o.distance,
+                'trainIdx'  : o.trainIdx,
+                'queryIdx'  : o.queryIdx,
+                'imgIdx'    : o.imgIdx}
+
+    elif isinstance(o, np.ndarray):
+        d = arrayHeader(o)
+        d['__base64__'] = ''.join(base64Chunks(o))
+        return d
+
+    elif isinstance(o, np.generic):
+        return o.item()
+
+    raise TypeError('{} is not JSON serializable'.format(type(o).__name__))
+
+
+def decodeJSON(d):
+    '''
+    Converts the dicts written by encodeJSON back, for use as the
+    object_hook of json.load.
+    '''
+    if d.get('__type__') == 'cv2.KeyPoint':
+        k = cv2.KeyPoint()
+        k.pt = (float(d['point'][0]), float(d['point'][1]))
+        k.size = float(d['size'])
+        k.angle = float(d['angle'])
+        k.response = float(d['response'])
+        k.octave = int(d['octave'])
+        k.class_id = int(d['class_id'])
+        return k
+    elif d.get('__type__') == 'cv2.DMatch':
+        dm = cv2.DMatch()
+        dm.distance = float(d['distance'])
+        dm.trainIdx = int(d['trainIdx'])
+        dm.queryIdx = int(d['queryIdx'])
+        dm.imgIdx = int(d['imgIdx'])
+        return dm
+    elif d.get('__type__') == 'numpy.ndarray':
+        shape = tuple([int(x) for x in d['__shape__']])
+        if '__base64__' in d:
+            data = bytearray(base64.b64decode(d['__base64__']))
+            return np.frombuffer(data, np.dtype(d['__dtype__'])).reshape(shape)
+        return np.array(d['__array__'], dtype=float).reshape(shape)
+    return d
+
+
+def arrayHeader(a):
+    return {'__type__'  : 'numpy.ndarray',
+            '__shape__' : a.shape,
+            '__dtype__' : a.dtype.str}
+
+
+def base64Chunks(a, chunkBytes=3 * 2**18):
+    '''
+    Yields the base64 encoding of the raw bytes of the array a in pieces.
+    chunkBytes is a multiple of 3, so the pieces concatenate to the base64
+    encoding of the whole buffer.
+    '''
+    if a.dtype.hasobject:
+        raise TypeError('object arrays cannot be written as raw buffers')
+    data = np.ascontiguousarray(a).reshape(-1).view(np.uint8)
+    for start in range(0, data.shape[0], chunkBytes):
+        yield base64.b64encode(data[start:start + chunkBytes].tobytes()) \
+            .decode('ascii')
+
+
+class JSONFeatureWriter(object):
+    '''
+    Writes a JSON object item by item. Lists (such as keypoints and matches)
+    are written one element per line and arrays in base64 chunks, so no part
+    of the document is built in memory as a whole:
+
+        with JSONFeatureWriter(open(path, 'w')) as writer:
+            writer.write('keypoints', keypoints)
+            writer.write('descriptors', descriptors)
+    '''
+    def __init__(self, f):
+        '''
+        Input:
+            f -- file object opened for writing text, closed by close()
+        '''
+        self.f = f
+        self.count = 0
+        self.f.write('{')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.f is not None:
+            self.f.write('\n}\n')
+            self.f.close()
+            self.f = None
+
+    def write(self, key, value):
+        f = self.f
+        f.write(',\n' if self.count else '\n')
+        f.write(json.dumps(str(key)) + ': ')
+        self.count += 1
+
+        if isinstance(value, (list, tuple)):
+            f.write('[')
+            for i, item in enumerate(value):
+                f.write(',\n' if i else '\n')
+                self.writeValue(item)
+            f.write('\n]' if len(value) else ']')
+        else:
+            self.writeValue(value)
+
+    def writeValue(self, value):
+        if isinstance(value, np.ndarray):
+            header = json.dumps(arrayHeader(value))
+            self.f.write(header[:-1] + ', "__base64__": "')
+            for chunk in base64Chunks(value):
+                self.f.write(chunk)
+            self.f.write('"}')
+        else:
+            self.f.write(json.dumps(value, default=encodeJSON))
+
+
+class JSONFeatureReader(object):
+    '''
+    Reads a JSON object written by JSONFeatureWriter (or any other JSON
+    object) incrementally. Only the file block being parsed and the value
+    being decoded are held in memory.
+    '''
+    def __init__(self, f, objectHook=decodeJSON, blockSize=2**20):
+        '''
+        Input:
+            f -- file object opened for reading text
+            objectHook -- applied to every decoded JSON object
+            blockSize -- number of characters read at a time
+        '''
+        self.f = f
+        self.decoder = json.JSONDecoder(object_hook=objectHook)
+        self.blockSize = blockSize
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        '''Reads at least size more characters, unless the file ends.'''
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        while size > 0 and not self.eof:
+            block = self.f.read(max(size, self.blockSize))
+            self.eof = not block
+            self.buffer += block
+            size -= len(block)
+
+    def peek(self):
+        '''Skips whitespace and returns the next character, '' at the end.'''
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in \
+                    ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.fill(self.blockSize)
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('Expected one of {!r} at {!r}'.format(chars,
+                self.buffer[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def decodeValue(self):
+        self.peek()
+        missing = self.blockSize
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the file
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # The value is incomplete; read more, doubling the amount each
+            # time so that large values are not re-parsed too often
+            self.fill(missing)
+            missing *= 2
+
+    def items(self, streamKeys=(), chunkSize=4096):
+        '''
+        Yields the (key, value) pairs of the top-level object. The lists of
+        the keys in streamKeys are not decoded as a whole; instead
+        (key, chunk) is yielded for every chunkSize elements.
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decodeValue()
+            self.expect(':')
+            if key in streamKeys and self.peek() == '[':
+                self.pos += 1
+                for chunk in self.listChunks(chunkSize):
+                    yield key, chunk
+            else:
+                yield key, self.decodeValue()
+            if self.expect(',}') == '}':
+                return
+
+    def listChunks(self, chunkSize):
+        chunk = []
+        if self.peek() == ']':
+            self.pos += 1
+        else:
+            while True:
+                chunk.append(self.decodeValue())
+                if len(chunk) == chunkSize:
+                    yield chunk
+                    chunk = []
+                if self.expect(',]') == ']':
+                    break
+        if chunk:
+            yield chunk
+
+    def read(self):
+        '''
+        Decodes the whole document, as json.load does. Top-level objects
+        are decoded one item at a time, anything else at once.
+        '''
+        if self.peek() != '{':
+            return self.decodeValue()
+        result = {}
+        for key, value in self.items():
+            result[key] = value
+        return result
+
+
+def iterKeypoints(path, chunkSize=4096, key='keypoints'):
+    '''
+    Yields the keypoints of a JSON feature file as lists of up to chunkSize
+    cv2.KeyPoint objects. The other items of the file are decoded one at a
+    time and dropped.
+    '''
+    with open(path, 'r') as f:
+        for k, chunk in JSONFeatureReader(f).items((key,), chunkSize):
+            if k == key:
+                yield chunk
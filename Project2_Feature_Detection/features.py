@@ -1,10 +1,12 @@
-import math
+import copy
 import cv2
 import numpy as np
-import scipy
-from scipy import ndimage, spatial
+import compact
+import imagecontext
+import imagefilters
+import neighbors
+import profiling
 import transformations
-import pdb
 
 def inbounds(shape, indices):
     assert len(shape) == len(indices)
@@ -13,12 +15,19 @@ def inbounds(shape, indices):
             return False
     return True
 
+# Collect the (x, y) coordinates of a list of cv2.KeyPoint objects into an
+# N x 2 numpy array.
+def keypointCoordinates(keypoints):
+    return np.array([kp.pt for kp in keypoints], dtype=np.float64).reshape(-1, 2)
+
 ## Keypoint detectors ##########################################################
-class KeypointDetector(object):
+class KeypointDetector(object, metaclass=profiling.Profiled):
     def detectKeypoints(self, image):
         '''
         Input:
-            image -- uint8 BGR image with values between [0, 255]
+            image -- uint8 BGR image with values between [0, 255], or an
+                     imagecontext.ImageContext of it, which shares its
+                     preprocessing with the descriptor
         Output:
             list of detected keypoints, fill the cv2.KeyPoint objects with the
             coordinates of the detected keypoints, the angle of the gradient
@@ -43,8 +52,7 @@ class DummyKeypointDetector(KeypointDetector):
             (in degrees), the detector response (Harris score for Harris detector)
             and set the size to 10.
         '''
-        image = image.astype(np.float32)
-        image /= 255.
+        image = imagecontext.ImageContext.of(image).normalized
         features = []
         height, width = image.shape[:2]
 
@@ -69,13 +77,22 @@ class DummyKeypointDetector(KeypointDetector):
 
 
 class HarrisKeypointDetector(KeypointDetector):
+    def __init__(self, backend='scipy'):
+        '''
+        Input:
+            backend -- 'scipy' or 'opencv', the implementation of the image
+                       filters, see imagefilters
+        '''
+        self.backend = backend
 
     # Compute harris values of an image.
-    def computeHarrisValues(self, srcImage):
+    def computeHarrisValues(self, srcImage, gradients=None):
         '''
         Input:
             srcImage -- Grayscale input image in a numpy array with
                         values in [0, 1]. The dimensions are (rows, cols).
+            gradients -- The Sobel derivatives (x, y) of srcImage, if they
+                         are already computed (see ImageContext.gradients)
         Output:
             harrisImage -- numpy array containing the Harris score at
                            each pixel.
@@ -93,16 +110,18 @@ class HarrisKeypointDetector(KeypointDetector):
         # for direction on how to do this. Also compute an orientation
         # for each pixel and store it in 'orientationImage.'
         # TODO-BLOCK-BEGIN
-        # Calculation of sobel image
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.sobel.html
-        index_x = scipy.ndimage.sobel(srcImage, axis=1, output=None, mode='reflect', cval=0.0)
-        index_y = scipy.ndimage.sobel(srcImage, axis=0, output=None, mode='reflect', cval=0.0)
+        filters = imagefilters.getFilters(self.backend)
+        # Calculation of sobel image (reflected borders)
+        if gradients is None:
+            index_x = filters.sobel(srcImage, 1)
+            index_y = filters.sobel(srcImage, 0)
+        else:
+            index_x, index_y = gradients
         # Implementation of Gaussian mask
-        # https://docs.scipy.org/doc/scipy-0.16.1/reference/generated/scipy.ndimage.filters.gaussian_filter.html
         # The elements will be used to derive the determinant, trace, and Harris image
-        A = scipy.ndimage.filters.gaussian_filter(index_x**2, sigma=.5)
-        B = scipy.ndimage.filters.gaussian_filter(index_y*index_x, sigma=.5)
-        C = scipy.ndimage.filters.gaussian_filter(index_y**2, sigma=.5)
+        A = filters.gaussian(index_x**2, .5)
+        B = filters.gaussian(index_y*index_x, .5)
+        C = filters.gaussian(index_y**2, .5)
         # Derive determinant of Gaussian filtered matrix
         det = A*C-B**2
         # Derive trace of Gaussian filtered matrix
@@ -126,16 +145,29 @@ class HarrisKeypointDetector(KeypointDetector):
                          its 7x7 neighborhood.
         '''
         # Creates an array of zeroes same shape as Harris image of type 'a'
-        destImage = np.zeros_like(harrisImage, np.bool)
+        destImage = np.zeros_like(harrisImage, bool)
         # TODO 2: Compute the local maxima image
         # TODO-BLOCK-BEGIN
         # Filters the input image wth the maximim fulter to find local maxima
         # 7x7 size specified in prompt
-        local_max = scipy.ndimage.filters.maximum_filter(harrisImage, size=(7,7))
+        local_max = imagefilters.getFilters(self.backend).maximum(harrisImage, 7)
         destImage = (harrisImage == local_max)
         # TODO-BLOCK-END
         return destImage
 
+    def contextHarrisValues(self, context):
+        '''
+        computeHarrisValues of the gray image of an
+        imagecontext.ImageContext, with the gradients of the context.
+        Overrides of computeHarrisValues with the original one argument
+        signature are called with the gray image only.
+        '''
+        if type(self).computeHarrisValues is not \
+                HarrisKeypointDetector.computeHarrisValues:
+            return self.computeHarrisValues(context.gray)
+        return self.computeHarrisValues(context.gray,
+            context.gradients(self.backend))
+
     def detectKeypoints(self, image):
         '''
         Input:
@@ -146,19 +178,16 @@ class HarrisKeypointDetector(KeypointDetector):
             (in degrees), the detector response (Harris score for Harris detector)
             and set the size to 10.
         '''
-        # Convert image matrix to float
-        image = image.astype(np.float32)
-        # Convert to BGR scale
-        image /= 255.
+        # The float, grayscale and gradient images are shared with the
+        # descriptor through the context
+        context = imagecontext.ImageContext.of(image)
         # Get dim parameters
-        height, width = image.shape[:2]
+        height, width = context.shape[:2]
         features = []
-        # Create grayscale image used for Harris detection
-        grayImage = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         # computeHarrisValues() computes the harris score at each pindex_xel
         # position, storing the result in harrisImage.
         # You will need to implement this function.
-        harrisImage, orientationImage = self.computeHarrisValues(grayImage)
+        harrisImage, orientationImage = self.contextHarrisValues(context)
         # Compute local maxima in the Harris image.  You will need to
         # implement this function. Create image to store local maximum harris
         # values as True, other pindex_xels False
@@ -195,17 +224,17 @@ class ORBKeypointDetector(KeypointDetector):
             (in degrees) and set the size to 10.
         '''
         detector = cv2.ORB_create()
-        # import pdb; pdb.set_trace()
-        pdb.set_trace()
-        return detector.detect(image)
+        return detector.detect(imagecontext.ImageContext.of(image).image)
 
 ## Feature descriptors #########################################################
-class FeatureDescriptor(object):
+class FeatureDescriptor(object, metaclass=profiling.Profiled):
     # Implement in child classes
     def describeFeatures(self, image, keypoints):
         '''
         Input:
-            image -- BGR image with values between [0, 255]
+            image -- BGR image with values between [0, 255], or an
+                     imagecontext.ImageContext of it, e.g. the one passed to
+                     the detector
             keypoints -- the detected features, we have to compute the feature
             descriptors at the specified coordinates
         Output:
@@ -225,12 +254,8 @@ class SimpleFeatureDescriptor(FeatureDescriptor):
         Output:
             desc -- K x 25 numpy array, where K is the number of keypoints
         '''
-        # Cast to float
-        image = image.astype(np.float32)
-        # Convert to BGR scale
-        image /= 255.
-        # Convert to gray scale
-        grayImage = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Gray scale image with values in [0, 1]
+        grayImage = imagecontext.ImageContext.of(image).gray
         desc = np.zeros((len(keypoints), 5 * 5))
 
         for i, f in enumerate(keypoints):
@@ -252,6 +277,14 @@ class SimpleFeatureDescriptor(FeatureDescriptor):
         return desc
 
 class MOPSFeatureDescriptor(FeatureDescriptor):
+    def __init__(self, backend='scipy'):
+        '''
+        Input:
+            backend -- 'scipy' or 'opencv', the implementation of the image
+                       filters, see imagefilters
+        '''
+        self.backend = backend
+
     # TODO: Implement parts of this function
     def describeFeatures(self, image, keypoints):
         '''
@@ -263,16 +296,21 @@ class MOPSFeatureDescriptor(FeatureDescriptor):
             desc -- K x W^2 numpy array, where K is the number of keypoints
                     and W is the window size
         '''
-        # Cast to float
-        image = image.astype(np.float32)
-        # Convert to BGR scale
-        image /= 255.
         # This image represents the window around the feature you need to
         # compute to store as the feature descriptor (row-major)
         windowSize = 8
         desc = np.zeros((len(keypoints), windowSize * windowSize))
-        grayImage = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        grayImage = ndimage.gaussian_filter(grayImage, 0.5)
+        # Blurred gray scale image with values in [0, 1]
+        grayImage = imagecontext.ImageContext.of(image).blurred(0.5,
+            self.backend)
+
+        # Build the transforms of all keypoints at once. Each one translates
+        # the feature to the origin, rotates by -angle, scales the 40x40
+        # window down to 8x8 and moves it to the center of the descriptor.
+        points = np.array([f.pt for f in keypoints]).reshape(-1, 2)
+        angles = np.radians([f.angle for f in keypoints])
+        transMxs = transformations.get_similarity_mx_2d(points[:, 0],
+            points[:, 1], angles, 0.2, offset=(windowSize / 2, windowSize / 2))
 
         for i, f in enumerate(keypoints):
             # TODO 5: Compute the transform as described by the feature
@@ -280,21 +318,8 @@ class MOPSFeatureDescriptor(FeatureDescriptor):
             # from each pindex_xel in the 40x40 rotated window surrounding
             # the feature to the appropriate pindex_xels in the 8x8 feature
             # descriptor image.
-            transMx = np.zeros((2, 3))
-
             # TODO-BLOCK-BEGIN
-            vector = np.array([-1*f.pt[0], -1*f.pt[1], 0])
-            # Inputs translation vector represented by 1D numpy array wand outputs 4x4 numpy array with 3D translation
-            translation_1 = transformations.get_trans_mx(vector)
-            # Inputs angles in x,y,z orientations and ouputs 4x4 numpy array with 3D rotation
-            rotation = transformations.get_rot_mx(0, 0, -f.angle/180*np.pi)
-            # Inputs scaling in x,y,z, directions and puts 4x4 numpy array with 3D scaling
-            scale = transformations.get_scale_mx(0.2, 0.2, 1) 
-            translation_2 = transformations.get_trans_mx(np.array([4,4,0]))
-            temp = np.dot(translation_2, np.dot(scale, np.dot(rotation, translation_1)))
-            transMx = np.array([[temp[0][0], temp[0][1], temp[0][3]],
-            				    [temp[1][0], temp[1][1], temp[1][3]]])
-
+            transMx = transMxs[i]
             # TODO-BLOCK-END
 
             # Call the warp affine function to do the mapping
@@ -328,7 +353,8 @@ class ORBFeatureDescriptor(KeypointDetector):
                 keypoint number x feature descriptor dimension
         '''
         descriptor = cv2.ORB_create()
-        kps, desc = descriptor.compute(image, keypoints)
+        kps, desc = descriptor.compute(
+            imagecontext.ImageContext.of(image).image, keypoints)
         if desc is None:
             desc = np.zeros((0, 128))
 
@@ -348,9 +374,52 @@ class CustomFeatureDescriptor(FeatureDescriptor):
         '''
         raise NotImplementedError('NOT IMPLEMENTED')
 
+class CompactFeatureDescriptor(FeatureDescriptor):
+    '''
+    The descriptors of another descriptor, stored as float32, float16 or
+    int8 and optionally projected to fewer dimensions by a PCA, see
+    compact.DescriptorCompressor. SSDFeatureMatcher and RatioFeatureMatcher
+    match the compact descriptors directly: their neighbors.BruteForceIndex
+    keeps them compact and only converts one block of them at a time to
+    float32, the type the distances are computed in.
+    '''
+    def __init__(self, descriptor='MOPSFeatureDescriptor', compressor=None,
+                 dtype='float32'):
+        '''
+        Input:
+            descriptor -- the descriptor that is compressed, an instance or
+                          the name of a class in this module
+            compressor -- a fitted compact.DescriptorCompressor, or the path
+                          of one saved by its save method (see compact.py).
+                          Defaults to a compressor to dtype, which needs no
+                          training for the float types
+            dtype -- see compressor
+        '''
+        if isinstance(descriptor, str):
+            descriptor = globals()[descriptor]()
+        if compressor is None:
+            compressor = compact.DescriptorCompressor(dtype)
+        elif isinstance(compressor, str):
+            compressor = compact.DescriptorCompressor.load(compressor)
+        self.descriptor = descriptor
+        self.compressor = compressor
+
+    def describeFeatures(self, image, keypoints):
+        '''
+        Input:
+            image -- BGR image with values between [0, 255], or an
+                     imagecontext.ImageContext of it
+            keypoints -- the detected features
+        Output:
+            compact descriptor numpy array, dimensions:
+                keypoint number x compressed descriptor dimension
+        '''
+        return self.compressor.compress(
+            self.descriptor.describeFeatures(image, keypoints))
+
 ## Feature matchers ############################################################
 
-class FeatureMatcher(object):
+class FeatureMatcher(object, metaclass=profiling.Profiled):
     def matchFeatures(self, desc1, desc2):
         '''
         Input:
@@ -369,24 +438,74 @@ class FeatureMatcher(object):
         '''
         raise NotImplementedError
 
+    def matchIndices(self, desc1, desc2):
+        '''
+        Same as matchFeatures, but returns the matches as arrays, which is
+        much cheaper than creating one cv2.DMatch per match.
+        Output:
+            queryIdx -- numpy array with the index of each matched feature
+                        in the first image
+            trainIdx -- numpy array with the index of the matching feature
+                        in the second image
+            distance -- numpy array with the distance of each match
+        '''
+        return self.fromDMatches(self.matchFeatures(desc1, desc2))
+
+    # Convert match arrays to a list of cv2.DMatch objects.
+    @staticmethod
+    def toDMatches(queryIdx, trainIdx, distance):
+        return [cv2.DMatch(q, t, d) for q, t, d in zip(
+            np.asarray(queryIdx).tolist(), np.asarray(trainIdx).tolist(),
+            np.asarray(distance).tolist())]
+
+    # Convert a list of cv2.DMatch objects to match arrays.
+    @staticmethod
+    def fromDMatches(matches):
+        queryIdx = np.array([m.queryIdx for m in matches], dtype=np.intp)
+        trainIdx = np.array([m.trainIdx for m in matches], dtype=np.intp)
+        distance = np.array([m.distance for m in matches], dtype=np.float64)
+        return queryIdx, trainIdx, distance
+
+    # Mark the matches whose features are mutual nearest neighbours, i.e.
+    # the query feature is also the best match of its train feature.
+    # reverseIdx holds the best match in the first image of every feature in
+    # the second image.
+    @staticmethod
+    def mutualMask(queryIdx, trainIdx, reverseIdx):
+        return np.asarray(reverseIdx)[trainIdx] == queryIdx
+
+    # Cross check matches by matching the features of image 2 back to image 1
+    # with a copy of a neighbors.NearestNeighborIndex, see mutualMask. The
+    # index itself stays fitted to the features of image 2.
+    @staticmethod
+    def crossCheckMask(index, desc1, desc2, queryIdx, trainIdx):
+        _, reverse = copy.copy(index).fit(desc1).query(desc2, k=1)
+        return FeatureMatcher.mutualMask(queryIdx, trainIdx, reverse[:, 0])
+
     # Evaluate a match using a ground truth homography.  This computes the
     # average SSD distance between the matched feature points and
     # the actual transformed positions.
     @staticmethod
     def evaluateMatch(features1, features2, matches, h):
-        d = 0
-        n = 0
-
-        for m in matches:
-            id1 = m.queryIdx
-            id2 = m.trainIdx
-            ptOld = np.array(features2[id2].pt)
-            ptNew = FeatureMatcher.applyHomography(features1[id1].pt, h)
-            # Euclidean distance
-            d += np.linalg.norm(ptNew - ptOld)
-            n += 1
-
-        return d / n if n != 0 else 0
+        queryIdx, trainIdx, _ = FeatureMatcher.fromDMatches(matches)
+        errors = FeatureMatcher.reprojectionErrors(features1, features2,
+            queryIdx, trainIdx, h)
+        return errors.mean() if errors.size != 0 else 0
+
+    # Compute the Euclidean distance between the matched feature points in
+    # the second image and the positions of the features of the first image
+    # transformed by h, for all matches at once. The features can be lists
+    # of cv2.KeyPoint objects or N x 2 arrays of coordinates, h is a
+    # homography (see applyHomographies) or a stack with one per match.
+    @staticmethod
+    def reprojectionErrors(features1, features2, queryIdx, trainIdx, h):
+        if not isinstance(features1, np.ndarray):
+            features1 = keypointCoordinates(features1)
+        if not isinstance(features2, np.ndarray):
+            features2 = keypointCoordinates(features2)
+        ptsNew = FeatureMatcher.applyHomographies(features1[queryIdx], h)
+        diff = ptsNew - features2[trainIdx]
+        return np.sqrt((diff**2).sum(1))
 
     # Transform point by homography.
     @staticmethod
@@ -397,8 +516,41 @@ class FeatureMatcher(object):
         return np.array([(h[0]*x + h[1]*y + h[2]) / d,
             (h[3]*x + h[4]*y + h[5]) / d])
 
+    # Transform an N x 2 array of points by a homography, given as a flat
+    # list of 9 numbers like in applyHomography or as a 3x3 array, or by a
+    # N x 3 x 3 stack of homographies, one per point.
+    @staticmethod
+    def applyHomographies(pts, h):
+        pts = np.asarray(pts, dtype=np.float64).reshape(-1, 2)
+        h = np.asarray(h, dtype=np.float64)
+        if h.ndim == 3:
+            assert h.shape == (pts.shape[0], 3, 3)
+            proj = np.einsum('nij,nj->ni', h[:, :, :2], pts) + h[:, :, 2]
+        else:
+            h = h.reshape(3, 3)
+            proj = np.dot(pts, h[:, :2].T) + h[:, 2]
+
+        return proj[:, :2] / proj[:, 2:]
+
 
 class SSDFeatureMatcher(FeatureMatcher):
+    def __init__(self, index=None, crossCheck=False):
+        '''
+        Input:
+            index -- the neighbors.NearestNeighborIndex used to find the
+                     closest feature. Defaults to an exact search that never
+                     materializes the full distance matrix
+                     (neighbors.BruteForceIndex). Pass a
+                     neighbors.KDTreeIndex or neighbors.LSHIndex to trade
+                     accuracy for speed on large feature sets.
+            crossCheck -- if True, only matches between mutual nearest
+                          neighbours are returned
+        '''
+        if index is None:
+            index = neighbors.BruteForceIndex()
+        self.index = index
+        self.crossCheck = crossCheck
+
     def matchFeatures(self, desc1, desc2):
         '''
         Input:
@@ -415,7 +567,9 @@ class SSDFeatureMatcher(FeatureMatcher):
                     trainIdx: The index of the feature in the second image
                     distance: The distance between the two features
         '''
-        matches = []
+        return self.toDMatches(*self.matchIndices(desc1, desc2))
+
+    def matchIndices(self, desc1, desc2):
         # feature count = n
         assert desc1.ndim == 2
         # feature count = m
@@ -424,7 +578,7 @@ class SSDFeatureMatcher(FeatureMatcher):
         assert desc1.shape[1] == desc2.shape[1]
 
         if desc1.shape[0] == 0 or desc2.shape[0] == 0:
-            return []
+            return self.fromDMatches([])
 
         # TODO 7: Perform simple feature matching.  This uses the SSD
         # distance between two feature vectors, and matches a feature in
@@ -432,21 +586,30 @@ class SSDFeatureMatcher(FeatureMatcher):
         # Note: multiple features from the first image may match the same
         # feature in the second image.
         # TODO-BLOCK-BEGIN
-        # Computes the distances between each pair of inputs
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.cdist.html
-        dist = scipy.spatial.distance.cdist(desc1, desc2,'euclidean')
-        indexes=dist.argmin(1)
-        for i in range(0, desc1.shape[0]):
-            # https://stackoverflow.com/questions/31690265/matching-features-with-orb-python-opencv
-        	matcher = cv2.DMatch()
-        	matcher.queryIdx = i
-        	matcher.trainIdx = indexes[i]
-        	matcher.distance = dist[i][matcher.trainIdx]
-        	matches.append(matcher)
+        dists, indexes = self.index.fit(desc2).query(desc1, k=1)
+        # Approximate indices may not find a neighbour for every feature
+        queryIdx = np.flatnonzero(indexes[:, 0] >= 0)
         # TODO-BLOCK-END
-        return matches
+        if self.crossCheck:
+            queryIdx = queryIdx[self.crossCheckMask(self.index, desc1, desc2,
+                queryIdx, indexes[queryIdx, 0])]
+        return queryIdx, indexes[queryIdx, 0], dists[queryIdx, 0]
 
 class RatioFeatureMatcher(FeatureMatcher):
+    def __init__(self, index=None, crossCheck=False):
+        '''
+        Input:
+            index -- the neighbors.NearestNeighborIndex used to find the two
+                     closest features, see SSDFeatureMatcher. The default
+                     exact search keeps memory bounded by its chunk size.
+            crossCheck -- if True, only matches between mutual nearest
+                          neighbours are returned
+        '''
+        if index is None:
+            index = neighbors.BruteForceIndex()
+        self.index = index
+        self.crossCheck = crossCheck
+
     def matchFeatures(self, desc1, desc2):
         '''
         Input:
@@ -463,7 +626,9 @@ class RatioFeatureMatcher(FeatureMatcher):
                     trainIdx: The index of the feature in the second image
                     distance: The ratio test score
         '''
-        matches = []
+        return self.toDMatches(*self.matchIndices(desc1, desc2))
+
+    def matchIndices(self, desc1, desc2):
         # feature count = n
         assert desc1.ndim == 2
         # feature count = m
@@ -471,7 +636,7 @@ class RatioFeatureMatcher(FeatureMatcher):
         # the two features should have the type
         assert desc1.shape[1] == desc2.shape[1]
         if desc1.shape[0] == 0 or desc2.shape[0] == 0:
-            return []
+            return self.fromDMatches([])
         # TODO 8: Perform ratio feature matching.
         # This uses the ratio of the SSD distance of the two best matches
         # and matches a feature in the first image with the closest feature in the
@@ -479,44 +644,91 @@ class RatioFeatureMatcher(FeatureMatcher):
         # Note: multiple features from the first image may match the same
         # feature in the second image.
         # You don't need to threshold matches in this function
-        # TODO-BLOCK-BEGIN 
-        # Computes the distances between each pair of inputs
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.cdist.html
-        dist = scipy.spatial.distance.cdist(desc1, desc2,'euclidean')
-
-        # Getting the first set of minimum distance arrays
-        # Setting up first minumum distance arrays
-        min_indexes_1 = dist.argmin(1)
-        dist_1 = np.zeros(desc1.shape[0])
-        train = np.empty_like(min_indexes_1)
-
-        # Getting the first set distance values and the array for training
-        for i in range(0,desc1.shape[0]):
-        	train[i] = min_indexes_1[i]
-        	dist_1[i] = dist[i][train[i]]
-        	dist[i][train[i]] = 1000
-
-		#Setting up second minimum distance matrices
-        second_min_indexes=dist.argmin(1)
-        second_dist = np.zeros(desc1.shape[0])
-
-		#Getting the second distance values
-        for i in range(0,desc1.shape[0]):
-        	second_min_index = second_min_indexes[i]
-        	second_dist[i] = dist[i][second_min_index]
-
-		#Creating the matches
-        for i in range(0,desc1.shape[0]):
-        	featurematch = cv2.DMatch()
-        	featurematch.queryIdx = i
-        	featurematch.trainIdx = train[i]
-        	if second_dist[i] != 0:
-        		featurematch.distance = dist_1[i]/second_dist[i]
-        	else:
-        		featurematch.distance = 1
-
-        	matches.append(featurematch)
-
+        # TODO-BLOCK-BEGIN
+        # Top-2 search, one chunk of rows at a time (see
+        # neighbors.smallestK)
+        dists, indexes = self.index.fit(desc2).query(desc1, k=2)
+        queryIdx = np.flatnonzero(indexes[:, 0] >= 0)
+        ratios = self.ratioScores(dists[queryIdx])
         # TODO-BLOCK-END
+        if self.crossCheck:
+            mutual = self.crossCheckMask(self.index, desc1, desc2,
+                queryIdx, indexes[queryIdx, 0])
+            queryIdx, ratios = queryIdx[mutual], ratios[mutual]
+        return queryIdx, indexes[queryIdx, 0], ratios
+
+    # Compute the ratio test score from the distances to the two nearest
+    # neighbours (an N x 2 array). Without a second neighbour (inf) the
+    # ratio test cannot be applied, which gives the neutral score 1, like
+    # two equally distant (zero distance) neighbours.
+    @staticmethod
+    def ratioScores(dists):
+        best, second = dists[:, 0], dists[:, 1]
+        ratios = np.ones(best.shape)
+        valid = (second != 0) & np.isfinite(second)
+        ratios[valid] = best[valid] / second[valid]
+        return ratios
+
+class HammingFeatureMatcher(FeatureMatcher):
+    '''
+    Matches binary descriptors packed into uint8 bytes (ORBFeatureDescriptor)
+    by their Hamming distance, see neighbors.HammingIndex.
+    '''
+    def __init__(self, ratioTest=False, crossCheck=False,
+                 maxChunkBytes=64 * 2**20):
+        '''
+        Input:
+            ratioTest -- if True, the match distance is the ratio of the
+                         Hamming distances to the two closest features, as in
+                         RatioFeatureMatcher
+            crossCheck -- if True, only matches between mutual nearest
+                          neighbours are returned
+            maxChunkBytes -- memory budget of one block of the distance matrix
+        '''
+        self.ratioTest = ratioTest
+        self.crossCheck = crossCheck
+        self.maxChunkBytes = maxChunkBytes
 
-        return matches
\ No newline at end of file
+    def matchFeatures(self, desc1, desc2):
+        '''
+        Input:
+            desc1 -- the packed uint8 feature descriptors of image 1,
+                dimensions: rows (number of key points) x
+                columns (number of descriptor bytes)
+            desc2 -- the packed uint8 feature descriptors of image 2,
+                dimensions: rows (number of key points) x
+                columns (number of descriptor bytes)
+        Output:
+            features matches: a list of cv2.DMatch objects
+                How to set attributes:
+                    queryIdx: The index of the feature in the first image
+                    trainIdx: The index of the feature in the second image
+                    distance: The Hamming distance between the two features,
+                              or the ratio test score if ratioTest is set
+        '''
+        return self.toDMatches(*self.matchIndices(desc1, desc2))
+
+    def matchIndices(self, desc1, desc2):
+        assert desc1.ndim == 2
+        assert desc2.ndim == 2
+        assert desc1.shape[1] == desc2.shape[1]
+        if desc1.shape[0] == 0 or desc2.shape[0] == 0:
+            return self.fromDMatches([])
+
+        index = neighbors.HammingIndex(maxChunkBytes=self.maxChunkBytes)
+        dists, indexes = index.fit(desc2).query(desc1,
+            k=2 if self.ratioTest else 1)
+        queryIdx = np.arange(desc1.shape[0])
+        trainIdx = indexes[:, 0]
+        if self.ratioTest:
+            distance = RatioFeatureMatcher.ratioScores(dists)
+        else:
+            distance = dists[:, 0]
+
+        if self.crossCheck:
+            mutual = self.crossCheckMask(index, desc1, desc2, queryIdx,
+                trainIdx)
+            queryIdx, trainIdx = queryIdx[mutual], trainIdx[mutual]
+            distance = distance[mutual]
+
+        return queryIdx, trainIdx, distance
\ No newline at end of file
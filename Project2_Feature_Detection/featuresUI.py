@@ -4,13 +4,18 @@ import tkinter.messagebox as tkMessageBox
 import tkinter.ttk as ttk
 import os
 import math
+import functools
 import json
 import numpy as np
 import cv2
 from PIL import Image, ImageTk, ImageDraw
 
 import benchmark
+import benchmarkreport
+import featurecache
+import featureio
 import features
+import matchfilter
 
 BUTTON_WIDTH = 14
 SLIDER_LENGTH = 250
@@ -24,18 +29,29 @@ AQUAMARINE = (212, 255, 127)
 
 # The list of feature-types to be presented to the user
 keypointClasses = [('Harris', features.HarrisKeypointDetector),
+                   ('Harris (OpenCV)', functools.partial(
+                       features.HarrisKeypointDetector, backend='opencv')),
                    ('ORB', features.ORBKeypointDetector),
                    ('Dummy', features.DummyKeypointDetector)]
 
 # The list of feature descriptors to be presented to the user
 descriptorClasses = [('MOPS', features.MOPSFeatureDescriptor),
+                     ('MOPS (OpenCV)', functools.partial(
+                         features.MOPSFeatureDescriptor, backend='opencv')),
                      ('ORB', features.ORBFeatureDescriptor),
                      ('Simple', features.SimpleFeatureDescriptor),
                      ('Custom', features.CustomFeatureDescriptor)]
 
 # The list of feature matching algorithms to be presented to the user
 matcherClasses = [('Ratio Test', features.RatioFeatureMatcher),
-                  ('SSD', features.SSDFeatureMatcher)]
+                  ('SSD', features.SSDFeatureMatcher),
+                  ('Hamming', features.HammingFeatureMatcher),
+                  ('Hamming Ratio', functools.partial(
+                      features.HammingFeatureMatcher, ratioTest=True))]
+
+# Keypoints and descriptors of the loaded images, so that changing only the
+# matcher or the thresholds does not detect the features again
+featureCache = featurecache.FeatureCache()
 
 # Supported filetypes
 supportedFiletypes = [('JPEG Image', '*.jpg'), ('PNG Image', '*.png'),
@@ -54,72 +70,39 @@ class CustomJSONEncoder(json.JSONEncoder):
         super(CustomJSONEncoder, self).__init__(indent=True)
 
     def default(self, o):
-        if hasattr(o, 'pt') and hasattr(o, 'size') and hasattr(o, 'angle') and \
-           hasattr(o, 'response') and hasattr(o, 'octave') and \
-           hasattr(o, 'class_id'):
-            return {'__type__'  : 'cv2.KeyPoint',
-                    'point'     : o.pt,
-                    'size'      : o.size,
-                    'angle'     : o.angle,
-                    'response'  : o.response,
-                    'octave'    : o.octave,
-                    'class_id'  : o.class_id}
-
-        elif hasattr(o, 'distance') and hasattr(o, 'trainIdx') and \
-             hasattr(o, 'queryIdx') and hasattr(o, 'imgIdx'):
-             return {'__type__' : 'cv2.DMatch',
-                    'distance'  : o.distance,
-                    'trainIdx'  : o.trainIdx,
-                    'queryIdx'  : o.queryIdx,
-                    'imgIdx'    : o.imgIdx}
-
-        elif isinstance(o, np.ndarray):
-            return {'__type__'  : 'numpy.ndarray',
-                    '__shape__' : o.shape,
-                    '__array__' : list(o.ravel())}
-        else:
-            json.JSONEncoder.default(self, o)
+        return featureio.encodeJSON(o)
 
 
 def customLoader(d):
     '''This function supports the deserialization of the custom types defined
-       above.'''
-    if '__type__' in d:
-        if d['__type__'] == 'cv2.KeyPoint':
-            k = cv2.KeyPoint()
-            k.pt = (float(d['point'][0]), float(d['point'][1]))
-            k.size = float(d['size'])
-            k.angle = float(d['angle'])
-            k.response = float(d['response'])
-            k.octave = int(d['octave'])
-            k.class_id = int(d['class_id'])
-            return k
-        elif d['__type__'] == 'cv2.DMatch':
-            dm = cv2.DMatch()
-            dm.distance = float(d['distance'])
-            dm.trainIdx = int(d['trainIdx'])
-            dm.queryIdx = int(d['queryIdx'])
-            dm.imgIdx = int(d['imgIdx'])
-            return dm
-        elif d['__type__'] == 'numpy.ndarray':
-            arr = np.array([float(x) for x in d['__array__']])
-            arr.reshape(tuple([int(x) for x in d['__shape__']]))
-            return arr
-        else:
-            return d
-    else:
-        return d
+       above, including arrays written as value lists by older versions.'''
+    return featureio.decodeJSON(d)
 
 
-# Load a feature set from a file.
+# Load a feature set from a file. .npz files are binary feature files (see
+# featureio.saveFeatures) and are read lazily; anything else is read as JSON,
+# one item at a time.
 def load(filepath):
-    return json.load(open(filepath, 'r'), object_hook=customLoader)
-
-
-# Save a feature set to file.
-def dump(filepath, obj):
-    with open(filepath, 'w') as f:
-        f.write(CustomJSONEncoder().encode(obj))
+    if filepath.endswith('.npz'):
+        return featureio.loadFeatures(filepath)
+    with open(filepath, 'r') as f:
+        return featureio.JSONFeatureReader(f, customLoader).read()
+
+
+# Save a feature set to file. For .npz files, obj is a dict with any of the
+# keys 'keypoints', 'descriptors' and 'matches'; JSON is meant for interop
+# with other tools only, as it is much larger and slower to read. Dicts are
+# written to JSON incrementally, see featureio.JSONFeatureWriter.
+def dump(filepath, obj, compress=False):
+    if filepath.endswith('.npz'):
+        featureio.saveFeatures(filepath, compress=compress, **obj)
+    elif isinstance(obj, dict):
+        with featureio.JSONFeatureWriter(open(filepath, 'w')) as writer:
+            for key, value in obj.items():
+                writer.write(key, value)
+    else:
+        with open(filepath, 'w') as f:
+            f.write(CustomJSONEncoder().encode(obj))
 
 
 class ImageWidget(tk.Canvas):
@@ -295,7 +278,7 @@ class KeypointDetectionFrame(BaseFrame):
         if self.image is not None:
             self.reloadImage()
             detector = self.getSelectedDetector()
-            self.keypoints = detector.detectKeypoints(self.image)
+            self.keypoints = featureCache.detectKeypoints(self.image, detector)
             self.drawKeypoints()
         else:
             error('Load image before computing keypoints!')
@@ -348,6 +331,18 @@ class FeatureMatchingFrame(BaseFrame):
             command=self.clearMatchings, width=BUTTON_WIDTH)
         self.clearMatchingsButton.grid(row=0, column=3, sticky=tk.W+tk.E)
 
+        self.filterFrame = tk.Frame(self)
+        self.filterFrame.grid(row=0, column=2, sticky=tk.W+tk.E)
+        self.crossCheckVar = tk.IntVar(self)
+        self.crossCheckButton = tk.Checkbutton(self.filterFrame,
+            text='Cross Check', variable=self.crossCheckVar,
+            command=self.computeMatches)
+        self.crossCheckButton.pack(side=tk.LEFT)
+        self.ransacVar = tk.IntVar(self)
+        self.ransacButton = tk.Checkbutton(self.filterFrame, text='RANSAC',
+            variable=self.ransacVar, command=self.computeMatches)
+        self.ransacButton.pack(side=tk.LEFT)
+
         self.screenshotButton = tk.Button(self, text='Screenshot',
             command=self.screenshot, width=BUTTON_WIDTH)
         self.screenshotButton.grid(row=0, column=4, sticky=tk.W+tk.E)
@@ -394,6 +389,7 @@ class FeatureMatchingFrame(BaseFrame):
         self.keypoints = [None, None]
         self.descriptors = [None, None]
         self.matches = None
+        self.matchInliers = None
 
     def thresholdChanged(self, val):
         self.computeMatches()
@@ -438,7 +434,8 @@ class FeatureMatchingFrame(BaseFrame):
             else:
                 matchImage = self.drawMatches(self.image[0],
                     self.thresholdedKeypoints[0], self.image[1],
-                    self.thresholdedKeypoints[1], matches)
+                    self.thresholdedKeypoints[1], matches,
+                    self.matchInliers[:matchCount])
                 self.imageCanvas.drawCVImage(matchImage)
 
     def thresholdAndMatch(self):
@@ -446,20 +443,38 @@ class FeatureMatchingFrame(BaseFrame):
 
         self.setStatus('Computing descriptors')
 
+        detector = self.getSelectedDetector()
         descriptor = self.getSelectedDescriptor()
         self.thresholdedKeypoints = [None] * len(self.image)
 
         for i in range(2):
-            self.thresholdedKeypoints[i] = self.thresholdKeyPoints(
-                self.keypoints[i], self.getSelectedKpThreshold())
-            self.descriptors[i] = descriptor.describeFeatures(self.image[i],
-                self.thresholdedKeypoints[i])
+            self.thresholdedKeypoints[i], self.descriptors[i] = \
+                featureCache.computeFeatures(self.image[i], detector,
+                    descriptor, threshold)
 
         self.setStatus('Finding matches')
 
         matcher = self.getSelectedMatcher()
-        matches = matcher.matchFeatures(self.descriptors[0],self.descriptors[1])
-        self.matches = sorted(matches, key = lambda x : x.distance)
+        if self.crossCheckVar.get() and hasattr(matcher, 'crossCheck'):
+            matcher.crossCheck = True
+        queryIdx, trainIdx, distance = matcher.matchIndices(
+            self.descriptors[0], self.descriptors[1])
+        order = np.argsort(distance, kind='stable')
+        queryIdx, trainIdx, distance = matchfilter.selectMatches(
+            (queryIdx, trainIdx, distance), order)
+
+        # Matches that are not consistent with the RANSAC homography are
+        # drawn as outliers
+        if self.ransacVar.get():
+            self.setStatus('Verifying matches')
+            _, self.matchInliers = matchfilter.verifyGeometry(
+                features.keypointCoordinates(self.thresholdedKeypoints[0]),
+                features.keypointCoordinates(self.thresholdedKeypoints[1]),
+                queryIdx, trainIdx, distances=distance)
+        else:
+            self.matchInliers = np.ones(len(queryIdx), np.bool_)
+
+        self.matches = matcher.toDMatches(queryIdx, trainIdx, distance)
 
     def concatImages(self, imgs):
         # Skip Nones
@@ -494,7 +509,8 @@ class FeatureMatchingFrame(BaseFrame):
             detector = self.getSelectedDetector()
             for i in range(2):
                 if self.keypoints[i] is None:
-                    self.keypoints[i] = detector.detectKeypoints(self.image[i])
+                    self.keypoints[i] = featureCache.detectKeypoints(
+                        self.image[i], detector)
 
             self.thresholdAndMatch()
 
@@ -502,14 +518,15 @@ class FeatureMatchingFrame(BaseFrame):
 
             self.updateMatchCount(self.percentMatches.get())
 
-    def drawMatches(self, img1, kp1, img2, kp2, matches):
+    def drawMatches(self, img1, kp1, img2, kp2, matches, status=None):
         h1, w1 = img1.shape[:2]
         h2, w2 = img2.shape[:2]
 
         vis = self.concatImages([img1, img2])
 
         kp_pairs = [[kp1[m.queryIdx], kp2[m.trainIdx]] for m in matches]
-        status = np.ones(len(kp_pairs), np.bool_)
+        if status is None:
+            status = np.ones(len(kp_pairs), np.bool_)
         p1 = np.int32([kpp[0].pt for kpp in kp_pairs])
         p2 = np.int32([kpp[1].pt for kpp in kp_pairs]) + (w1, 0)
 
@@ -544,6 +561,10 @@ class BenchmarkFrame(BaseFrame):
             sticky=tk.W+tk.E)
         self.thresholdSlider.bind("<ButtonRelease-1>", self.runBenchmark)
 
+        self.saveReportButton = tk.Button(self, text='Save Report',
+            command=self.saveReport, width=BUTTON_WIDTH)
+        self.saveReportButton.grid(row=0, column=3, sticky=tk.W+tk.E)
+
         self.screenshotButton = tk.Button(self, text='Screenshot',
             command=self.screenshot, width=BUTTON_WIDTH)
         self.screenshotButton.grid(row=0, column=4, sticky=tk.W+tk.E)
@@ -563,11 +584,23 @@ class BenchmarkFrame(BaseFrame):
         self.matcherOptions.grid(row=1, column=5, sticky=tk.W+tk.E)
         self.matcherTypeVar.trace("w", self.runBenchmark)
 
+        # Memory tracing slows down the Python-heavy stages, so it is only
+        # done on request and the times of such runs are not representative
+        self.trackMemoryVar = tk.IntVar(self)
+        self.trackMemoryButton = tk.Checkbutton(self, text='Track Memory',
+            variable=self.trackMemoryVar)
+        self.trackMemoryButton.grid(row=2, column=0, sticky=tk.N+tk.W)
+
+        # Per-stage time, memory and counts of the last run
+        self.reportLabel = tk.Label(self, font='TkFixedFont', justify=tk.LEFT)
+        self.reportLabel.grid(row=2, column=1, columnspan=5)
+
         self.imageCanvas.grid(row=3, columnspan=6, sticky=tk.N+tk.S+tk.E+tk.W)
 
         self.status.grid(row=4, columnspan=6)
 
         self.currentDirectory = None
+        self.report = None
 
     def runBenchmarkClick(self):
         dirpath = tkFileDialog.askdirectory(parent=self.root)
@@ -586,6 +619,17 @@ class BenchmarkFrame(BaseFrame):
                 self.imageCanvas.writeToFile(filename)
                 self.setStatus('Saved screenshot to ' + filename)
 
+    def saveReport(self):
+        if self.report is not None:
+            filename = tkFileDialog.asksaveasfilename(parent=self.root,
+                filetypes=[('CSV File', '*.csv'), ('JSON File', '*.json')],
+                defaultextension='.csv')
+            if filename:
+                self.report.save(filename)
+                self.setStatus('Saved report to ' + filename)
+        else:
+            error('Run a benchmark before saving its report!')
+
     def runBenchmark(self, *args):
         if self.currentDirectory:
             detector = self.getSelectedDetector()
@@ -594,8 +638,14 @@ class BenchmarkFrame(BaseFrame):
             kpThreshold = self.getSelectedKpThreshold()
             self.setStatus('Benchmarking...Please wait.')
             matchThreshold = 5
-            ds, aucs, roc_img = benchmark.benchmark_dir(self.currentDirectory,
-                detector, descriptor, matcher, kpThreshold, matchThreshold)
+            self.report = benchmarkreport.BenchmarkReport(
+                trackMemory=bool(self.trackMemoryVar.get()))
+            with self.report:
+                ds, aucs, roc_img = benchmark.benchmark_dir(
+                    self.currentDirectory, detector, descriptor, matcher,
+                    kpThreshold, matchThreshold, cache=featureCache,
+                    report=self.report)
+            self.reportLabel.configure(text=self.report.table())
             self.roc_img = roc_img
             self.imageCanvas.drawCVImage(roc_img)
             text = 'Average distance between true and actual matches: {}; \
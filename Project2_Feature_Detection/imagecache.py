@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import cv2
+import numpy as np
+
+
+## Decoded image cache #########################################################
+def grayscale(image):
+    '''
+    Grayscale float32 version of a uint8 BGR image, with values in [0, 1],
+    as computed by the detectors and descriptors in features.py.
+    '''
+    return cv2.cvtColor(image.astype(np.float32) / 255., cv2.COLOR_BGR2GRAY)
+
+
+def fileHash(path, blockSize=2**20):
+    '''SHA-1 of the contents of a file.'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ImageCache(object):
+    '''
+    Caches decoded images, so that repeated runs on the same datasets skip
+    PNG/JPEG decoding. Every image is stored as two raw .npy files, the BGR
+    image and its grayscale float32 version (see grayscale), which later
+    reads memory-map instead of decoding. The arrays are read-only.
+
+    An entry is valid while the size and modification time of its source
+    file are unchanged. If they changed, the source is hashed, and an entry
+    with the same contents is still used (e.g. after a checkout touched the
+    file). The least recently used entries are evicted when the cache grows
+    beyond maxBytes.
+    '''
+    def __init__(self, directory, maxBytes=2**30, checkHash=True):
+        '''
+        Input:
+            directory -- directory of the cache files
+            maxBytes -- size bound of the cache
+            checkHash -- if False, entries with a changed modification time
+                         are decoded again without hashing the source
+        '''
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.checkHash = checkHash
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def paths(self, source):
+        '''Paths of the metadata, BGR and grayscale files of a source.'''
+        key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + '.json', base + '.bgr.npy', base + '.gray.npy'
+
+    def lookup(self, source):
+        '''
+        Output:
+            the paths of a valid entry of source (see paths), or None
+        '''
+        metaPath, bgrPath, grayPath = self.paths(source)
+        try:
+            st = os.stat(source)
+            with open(metaPath) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta.get('source') != os.path.abspath(source):
+            return None
+
+        if (meta['size'], meta['mtime']) != (st.st_size, st.st_mtime_ns):
+            if not self.checkHash or fileHash(source) != meta['hash']:
+                return None
+            meta['size'], meta['mtime'] = st.st_size, st.st_mtime_ns
+            self.writeFile(metaPath, lambda f: f.write(
+                json.dumps(meta).encode()))
+        # Mark the entry as recently used for the eviction
+        os.utime(metaPath, None)
+        return metaPath, bgrPath, grayPath
+
+    def read(self, source, gray=False):
+        '''
+        Same as cv2.imread(source) (or grayscale of it, if gray is True),
+        from the cache if possible.
+        Output:
+            the image, or None if source cannot be read
+        '''
+        return self.readImages(source)[1 if gray else 0]
+
+    def readGray(self, source):
+        '''The grayscale float32 image of source, see read.'''
+        return self.read(source, gray=True)
+
+    def readImages(self, source):
+        '''
+        Reads the BGR and grayscale images of source with one lookup.
+        Output:
+            (image, gray) -- see read, (None, None) if source cannot be read
+        '''
+        paths = self.lookup(source)
+        if paths is not None:
+            try:
+                images = (np.load(paths[1], mmap_mode='r'),
+                          np.load(paths[2], mmap_mode='r'))
+                self.hits += 1
+                return images
+            except (IOError, OSError, ValueError):
+                pass
+
+        self.misses += 1
+        return self.put(source)
+
+    def writeFile(self, path, write):
+        '''Writes a file atomically, write(f) writes its contents.'''
+        # Concurrent readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+
+    def put(self, source):
+        '''
+        Decodes source and stores it in the cache.
+        Output:
+            (image, gray) -- the decoded BGR image and its grayscale
+                             version, (None, None) if it cannot be read
+        '''
+        st = os.stat(source)
+        image = cv2.imread(source)
+        if image is None:
+            return None, None
+        gray = grayscale(image)
+        metaPath, bgrPath, grayPath = self.paths(source)
+        self.writeFile(bgrPath, lambda f: np.save(f, image))
+        self.writeFile(grayPath, lambda f: np.save(f, gray))
+        # The metadata is written last, it validates the arrays
+        meta = {'source': os.path.abspath(source), 'size': st.st_size,
+                'mtime': st.st_mtime_ns, 'hash': fileHash(source)}
+        self.writeFile(metaPath, lambda f: f.write(json.dumps(meta).encode()))
+        self.evict()
+        return image, gray
+
+    def evict(self):
+        '''Removes the least recently used entries beyond maxBytes.'''
+        entries = {}
+        for fn in os.listdir(self.directory):
+            # Temporary files belong to writes in progress
+            if fn.endswith('.tmp'):
+                continue
+            key = fn.split('.')[0]
+            try:
+                st = os.stat(os.path.join(self.directory, fn))
+            except OSError:
+                continue
+            used, size = entries.get(key, (0, 0))
+            if fn.endswith('.json'):
+                used = st.st_mtime
+            entries[key] = (used, size + st.st_size)
+
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if total <= self.maxBytes:
+                break
+            # The metadata first, which invalidates the entry
+            for suffix in ('.json', '.bgr.npy', '.gray.npy'):
+                try:
+                    os.remove(os.path.join(self.directory, key + suffix))
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        for fn in os.listdir(self.directory):
+            if fn.endswith(('.json', '.npy')):
+                os.remove(os.path.join(self.directory, fn))
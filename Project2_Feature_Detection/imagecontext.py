@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+
+import imagefilters
+
+
+## Image context ###############################################################
+class ImageContext(object):
+    '''
+    The preprocessed versions of one image that the detectors and
+    descriptors need, computed on first use and shared afterwards. Pass the
+    same context to detectKeypoints and describeFeatures, and the image is
+    converted, blurred and differentiated once per image instead of once
+    per stage:
+        image      -- the uint8 BGR image
+        normalized -- float32 BGR image with values in [0, 1]
+        gray       -- float32 grayscale image with values in [0, 1]
+        blurred(sigma, backend)  -- Gaussian blur of gray
+        gradients(backend)       -- Sobel derivatives (x, y) of gray
+        pyramid(levels)          -- gray downsampled by cv2.pyrDown
+    Every detector and descriptor also accepts a plain image, see of.
+
+    The memoized arrays must not be modified.
+    '''
+    def __init__(self, image, gray=None):
+        '''
+        Input:
+            image -- uint8 BGR image with values between [0, 255]
+            gray -- its grayscale float32 version, if already known (e.g.
+                    from imagecache.ImageCache.readGray)
+        '''
+        self.image = image
+        self.memo = {}
+        if gray is not None:
+            self.memo['gray'] = gray
+
+    @staticmethod
+    def of(image):
+        '''The image itself if it is an ImageContext, else a new context.'''
+        return image if isinstance(image, ImageContext) else \
+            ImageContext(image)
+
+    @property
+    def shape(self):
+        return self.image.shape
+
+    def get(self, key, compute):
+        '''Memoized compute(), stored under key.'''
+        if key not in self.memo:
+            self.memo[key] = compute()
+        return self.memo[key]
+
+    @property
+    def normalized(self):
+        return self.get('normalized',
+            lambda: self.image.astype(np.float32) / 255.)
+
+    @property
+    def gray(self):
+        return self.get('gray',
+            lambda: cv2.cvtColor(self.normalized, cv2.COLOR_BGR2GRAY))
+
+    def blurred(self, sigma, backend='scipy'):
+        '''gray blurred with imagefilters' gaussian of the backend.'''
+        filters = imagefilters.getFilters(backend)
+        return self.get(('blurred', sigma, filters.name),
+            lambda: filters.gaussian(self.gray, sigma))
+
+    def gradients(self, backend='scipy'):
+        '''(x, y) Sobel derivatives of gray, see imagefilters.'''
+        filters = imagefilters.getFilters(backend)
+        return self.get(('gradients', filters.name),
+            lambda: (filters.sobel(self.gray, 1), filters.sobel(self.gray, 0)))
+
+    def pyramid(self, levels):
+        '''
+        List of levels + 1 images, gray followed by its levels successive
+        cv2.pyrDown halvings. Shorter pyramids share the levels of longer
+        ones.
+        '''
+        images = self.get('pyramid', lambda: [self.gray])
+        while len(images) <= levels:
+            images.append(cv2.pyrDown(images[-1]))
+        return images[:levels + 1]
@@ -0,0 +1,86 @@
+import cv2
+import numpy as np
+
+
+## Filter backends #############################################################
+# The Harris detector and the MOPS descriptor do their filtering through one
+# of these backends, selected with their backend argument. Both compute the
+# same filters with the same border handling (SciPy's 'reflect' is OpenCV's
+# BORDER_REFLECT) on float32 images:
+#     scipy  -- scipy.ndimage, the reference implementation
+#     opencv -- cv2.Sobel, cv2.GaussianBlur and cv2.dilate, which are SIMD
+#               optimized and multithreaded, 3-9x faster per filter
+# For grayscale images with values in [0, 1], the Sobel and Gaussian outputs
+# of the backends differ by at most 1e-6 (float32 rounding; the maxima are
+# identical). On the images in resources/ this gives Harris scores within
+# 1e-6 relative and MOPS descriptors within 1e-4 (they are normalized by
+# their standard deviation, which magnifies rounding in flat windows). Local
+# maxima are found by exact comparison, so a few keypoints on plateaus of
+# nearly equal scores differ (20 over all 23 images), and keypoint angles
+# differ by up to 0.03 degrees. See backendbench.py for the measurements and
+# speedups.
+
+class SciPyFilters(object):
+    '''Filters implemented with scipy.ndimage.'''
+    name = 'scipy'
+
+    @property
+    def ndimage(self):
+        # SciPy is only loaded when its filters are used
+        from scipy import ndimage
+        return ndimage
+
+    def sobel(self, image, axis):
+        '''
+        Sobel derivative of image along axis (1 for x, 0 for y), with the
+        same output dtype as image.
+        '''
+        return self.ndimage.sobel(image, axis=axis, mode='reflect')
+
+    def gaussian(self, image, sigma):
+        '''Gaussian blur with a kernel of radius int(4 * sigma + 0.5).'''
+        return self.ndimage.gaussian_filter(image, sigma, mode='reflect')
+
+    def maximum(self, image, size):
+        '''Maximum over the size x size window around every pixel.'''
+        return self.ndimage.maximum_filter(image, size=(size, size),
+            mode='reflect')
+
+
+class OpenCVFilters(object):
+    '''The filters of SciPyFilters, implemented with OpenCV.'''
+    name = 'opencv'
+
+    def sobel(self, image, axis):
+        depth = cv2.CV_64F if image.dtype == np.float64 else cv2.CV_32F
+        dx, dy = (1, 0) if axis == 1 else (0, 1)
+        return cv2.Sobel(image, depth, dx, dy, ksize=3,
+                         borderType=cv2.BORDER_REFLECT)
+
+    def gaussian(self, image, sigma):
+        # Same kernel size as scipy.ndimage with its default truncate=4
+        radius = int(4 * sigma + 0.5)
+        return cv2.GaussianBlur(image, (2 * radius + 1, 2 * radius + 1),
+                                sigma, borderType=cv2.BORDER_REFLECT)
+
+    def maximum(self, image, size):
+        return cv2.dilate(image, np.ones((size, size), np.uint8),
+                          borderType=cv2.BORDER_REFLECT)
+
+
+BACKENDS = {'scipy': SciPyFilters(), 'opencv': OpenCVFilters()}
+
+
+def getFilters(backend):
+    '''
+    Input:
+        backend -- 'scipy', 'opencv' or a filters object
+    Output:
+        the filters object of the backend
+    '''
+    if not isinstance(backend, str):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError('Unknown filter backend {!r}, expected one of '
+                         '{}'.format(backend, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[backend]
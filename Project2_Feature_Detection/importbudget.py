@@ -0,0 +1,74 @@
+'''
+Checks that the compute modules import quickly and without the UI and
+plotting libraries, so that headless jobs do not pay for them:
+
+    python importbudget.py [--repeat 5] [--scale 1.0]
+
+Every module is imported in a fresh interpreter. The fastest of --repeat
+imports is compared with its budget (times --scale, for slower machines).
+The exit status is 1 if a budget is exceeded or a forbidden module is
+loaded, so the check can run in CI.
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Module -> import time budget in seconds, including NumPy, SciPy and OpenCV
+BUDGETS = [('transformations', 0.3),
+           ('featureio', 0.5),
+           ('features', 0.75),
+           ('benchmark', 0.75)]
+
+# Modules that the compute core must not import
+FORBIDDEN = ('matplotlib', 'PIL', 'tkinter', 'pdb')
+
+SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [m for m in {forbidden!r} if m in sys.modules]]))
+'''
+
+
+def measure(module, repeat):
+    '''
+    Output:
+        the fastest import time of module in seconds, and the forbidden
+        modules it loaded
+    '''
+    here = os.path.dirname(os.path.abspath(__file__))
+    best, loaded = None, []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c',
+            SNIPPET.format(module=module, forbidden=FORBIDDEN)], cwd=here)
+        elapsed, loaded = json.loads(output.decode().strip().splitlines()[-1])
+        best = elapsed if best is None else min(best, elapsed)
+    return best, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check import times.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0,
+        help='multiply all budgets by this factor')
+    args = parser.parse_args(argv)
+
+    failed = False
+    print('{:<16}{:>10}{:>10}  {}'.format('module', 'time [s]', 'budget',
+        'forbidden imports'))
+    for module, budget in BUDGETS:
+        elapsed, loaded = measure(module, args.repeat)
+        budget *= args.scale
+        ok = elapsed <= budget and not loaded
+        failed = failed or not ok
+        print('{:<16}{:>10.3f}{:>10.3f}  {}{}'.format(module, elapsed, budget,
+            ', '.join(loaded) or '-', '' if ok else '  FAILED'))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
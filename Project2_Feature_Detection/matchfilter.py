@@ -0,0 +1,115 @@
+import numpy as np
+
+import ransac
+
+
+## Match filtering #############################################################
+# All functions work on match arrays as returned by
+# FeatureMatcher.matchIndices (queryIdx, trainIdx, distance), so filtering
+# any number of candidate matches is a few NumPy calls.
+
+def selectMatches(matches, mask):
+    '''
+    Input:
+        matches -- tuple of match arrays (queryIdx, trainIdx, distance)
+        mask -- boolean numpy array, or an index array
+    Output:
+        tuple of match arrays with only the selected matches
+    '''
+    return tuple(np.asarray(a)[mask] for a in matches)
+
+
+def thresholdMask(distance, maxDistance):
+    '''
+    Marks the matches whose distance (or ratio test score, for the ratio
+    matchers) is below maxDistance.
+    '''
+    return np.asarray(distance) < maxDistance
+
+
+def oneToOneMask(trainIdx, distance):
+    '''
+    Marks, for every feature of image 2 matched more than once, only its
+    match with the smallest distance, so that no two matches share a
+    feature. Many-to-one matches (e.g. in blurred or repetitive areas) can
+    otherwise all fit a degenerate homography.
+    '''
+    trainIdx = np.asarray(trainIdx)
+    order = np.lexsort((distance, trainIdx))
+    first = np.ones(len(order), bool)
+    first[1:] = trainIdx[order][1:] != trainIdx[order][:-1]
+    mask = np.zeros(len(order), bool)
+    mask[order[first]] = True
+    return mask
+
+
+def verifyGeometry(points1, points2, queryIdx, trainIdx, threshold=3.0,
+                   **ransacArgs):
+    '''
+    Input:
+        points1, points2 -- N1 x 2 and N2 x 2 numpy arrays of the keypoint
+                            coordinates of both images, see
+                            features.keypointCoordinates
+        queryIdx, trainIdx -- match arrays
+        threshold -- maximum reprojection error (in pixels) of an inlier
+        ransacArgs -- further arguments of ransac.findHomography, e.g.
+                      distances=distance to sample the best matches first
+    Output:
+        H -- the 3x3 homography from image 1 to image 2 with the most
+             inliers, None if there are fewer than 4 matches
+        inliers -- boolean numpy array marking the matches consistent with H
+    '''
+    src = np.asarray(points1).reshape(-1, 2)[queryIdx]
+    dst = np.asarray(points2).reshape(-1, 2)[trainIdx]
+    return ransac.findHomography(src, dst, threshold=threshold, **ransacArgs)
+
+
+class MatchFilter(object):
+    '''
+    Filters the output of FeatureMatcher.matchIndices. The stages are
+    applied in order and each is optional:
+        1. a distance (or ratio) threshold
+        2. geometric verification with a RANSAC homography
+    Mutual nearest neighbour filtering needs the reverse matching, so it is
+    a mode of the matchers themselves (crossCheck=True, see
+    features.FeatureMatcher.crossCheckMask).
+    '''
+    def __init__(self, maxDistance=None, verify=False, ransacThreshold=3.0,
+                 **ransacArgs):
+        '''
+        Input:
+            maxDistance -- keep matches with a distance below this value,
+                           None to keep all
+            verify -- if True, keep only the RANSAC homography inliers
+            ransacThreshold -- maximum reprojection error of an inlier
+            ransacArgs -- further arguments of ransac.findHomography
+        '''
+        self.maxDistance = maxDistance
+        self.verify = verify
+        self.ransacThreshold = ransacThreshold
+        self.ransacArgs = ransacArgs
+        self.homography = None
+
+    def filter(self, points1, points2, matches):
+        '''
+        Input:
+            points1, points2 -- keypoint coordinates of both images
+            matches -- tuple of match arrays (queryIdx, trainIdx, distance)
+        Output:
+            tuple of match arrays with the matches that pass every stage.
+            The homography found by the geometric verification is stored in
+            self.homography.
+        '''
+        if self.maxDistance is not None:
+            matches = selectMatches(matches,
+                thresholdMask(matches[2], self.maxDistance))
+
+        self.homography = None
+        if self.verify:
+            # Match distances let RANSAC try the best matches first (PROSAC)
+            self.homography, inliers = verifyGeometry(points1, points2,
+                matches[0], matches[1], self.ransacThreshold,
+                distances=matches[2], **self.ransacArgs)
+            matches = selectMatches(matches, inliers)
+
+        return matches
@@ -0,0 +1,460 @@
+import numpy as np
+
+
+## Nearest neighbour indices ###################################################
+class NearestNeighborIndex(object):
+    '''
+    Base class of the nearest neighbour backends used by the feature
+    matchers. An index is built once over the descriptors of one image with
+    fit() and then queried with the descriptors of another image.
+    '''
+    def fit(self, data):
+        '''
+        Input:
+            data -- N x D numpy array of the points to index
+        Output:
+            self, so that calls can be chained
+        '''
+        raise NotImplementedError
+
+    def query(self, queries, k=1):
+        '''
+        Input:
+            queries -- M x D numpy array of query points
+            k -- number of neighbours to return per query
+        Output:
+            dists -- M x k numpy array of Euclidean distances, sorted in
+                     increasing order along each row. Missing neighbours
+                     (fewer than k indexed points, or no candidates for an
+                     approximate index) have distance inf.
+            indices -- M x k numpy array of indices into the fitted data,
+                       -1 for missing neighbours
+        '''
+        raise NotImplementedError
+
+    def queryExcluding(self, queries, k, queryGroups, dataGroups,
+                       chunkSize=4096):
+        '''
+        Same as query, but skips the indexed points of the same group as
+        their query, e.g. the features of the query's own image.
+        Input:
+            queryGroups -- M non-negative integer group labels of queries
+            dataGroups -- N group labels of the fitted data
+        This default queries k plus the size of the largest group
+        neighbours for one chunk of queries at a time and drops the ones of
+        the same group. BruteForceIndex skips them while searching instead.
+        '''
+        queryGroups = np.asarray(queryGroups)
+        dataGroups = np.asarray(dataGroups)
+        dists, indices = emptyResult(queries.shape[0], k)
+        if dataGroups.size == 0:
+            return dists, indices
+        n = k + int(np.bincount(dataGroups).max())
+        for start in range(0, queries.shape[0], chunkSize):
+            rows = slice(start, start + chunkSize)
+            d, idx = self.query(queries[rows], n)
+            same = (idx >= 0) & (dataGroups[np.maximum(idx, 0)] ==
+                                 queryGroups[rows, np.newaxis])
+            d[same] = np.inf
+            idx[same] = -1
+            # The remaining neighbours in order, missing ones last
+            order = np.argsort(d, 1, kind='stable')[:, :k]
+            dists[rows, :order.shape[1]] = np.take_along_axis(d, order, 1)
+            indices[rows, :order.shape[1]] = np.take_along_axis(idx, order, 1)
+        return dists, indices
+
+
+def emptyResult(numQueries, k):
+    '''Result of query() with every neighbour missing.'''
+    return np.full((numQueries, k), np.inf), np.full((numQueries, k), -1, np.intp)
+
+
+def smallestK(values, k):
+    '''
+    Input:
+        values -- M x N numpy array
+        k -- number of smallest entries to select per row
+    Output:
+        The column indices of the k smallest entries in each row, sorted by
+        value, as an M x min(k, N) numpy array. Uses np.argpartition, so
+        only the selected entries are sorted.
+    '''
+    k = min(k, values.shape[1])
+    if k == 1:
+        return values.argmin(1)[:, np.newaxis]
+    if k < values.shape[1]:
+        part = np.argpartition(values, k - 1, axis=1)[:, :k]
+    else:
+        part = np.tile(np.arange(values.shape[1]), (values.shape[0], 1))
+    order = np.take_along_axis(values, part, 1).argsort(1, kind='stable')
+    return np.take_along_axis(part, order, 1)
+
+
+class BruteForceIndex(NearestNeighborIndex):
+    '''
+    Exact search. Squared distances are computed as |a|^2 + |b|^2 - 2ab with
+    one matrix product per chunk of queries, so only a chunk x N block of
+    the distance matrix exists at any time.
+
+    Compact data (float16 or int8, see compact.py) is indexed as it is and
+    converted to float32 one block of blockSize points at a time while
+    searching, since numpy has no fast float16 or integer matrix product.
+    float32 products of int8 descriptors are exact up to about 1000
+    dimensions. float64 data is searched in float64.
+    '''
+    def __init__(self, chunkSize=None, maxChunkBytes=64 * 2**20,
+                 blockSize=4096):
+        '''
+        Input:
+            chunkSize -- number of queries per block, if None it is derived
+                         from maxChunkBytes
+            maxChunkBytes -- memory budget of one block of the distance matrix
+            blockSize -- number of compact indexed points converted at a time
+        '''
+        self.chunkSize = chunkSize
+        self.maxChunkBytes = maxChunkBytes
+        self.blockSize = blockSize
+        self.data = None
+
+    def fit(self, data):
+        assert data.ndim == 2
+        # The type the distances are computed in
+        self.dtype = np.float64 if data.dtype == np.float64 else np.float32
+        self.data = np.ascontiguousarray(data)
+        self.sqNorms = np.zeros(data.shape[0], self.dtype)
+        for rows, block in self.blocks():
+            self.sqNorms[rows] = np.einsum('ij,ij->i', block, block)
+        return self
+
+    def blocks(self):
+        '''
+        Yields the slices of the blocks of indexed points and the points,
+        converted to the type of the distances (without a copy if they
+        have it already).
+        '''
+        n = self.data.shape[0]
+        blockSize = n if self.data.dtype == self.dtype else self.blockSize
+        for start in range(0, n, max(1, blockSize)):
+            rows = slice(start, min(start + blockSize, n))
+            yield rows, self.data[rows].astype(self.dtype, copy=False)
+
+    def chunks(self, numQueries):
+        '''Yields the slices of the query blocks.'''
+        chunkSize = self.chunkSize
+        if chunkSize is None:
+            rowBytes = max(1, self.data.shape[0]) * \
+                np.dtype(self.dtype).itemsize
+            chunkSize = max(1, int(self.maxChunkBytes // rowBytes))
+        for start in range(0, numQueries, chunkSize):
+            yield slice(start, min(start + chunkSize, numQueries))
+
+    def squaredDistances(self, queries):
+        '''
+        Input:
+            queries -- C x D numpy array, a single block of queries
+        Output:
+            C x N numpy array of squared Euclidean distances to the indexed
+            points
+        '''
+        queries = np.asarray(queries, dtype=self.dtype)
+        if self.data.dtype == self.dtype:
+            d2 = np.dot(queries, self.data.T)
+        else:
+            d2 = np.empty((queries.shape[0], self.data.shape[0]), self.dtype)
+            for rows, block in self.blocks():
+                d2[:, rows] = np.dot(queries, block.T)
+        d2 *= -2
+        d2 += np.einsum('ij,ij->i', queries, queries)[:, np.newaxis]
+        d2 += self.sqNorms[np.newaxis, :]
+        # Rounding can make distances of (near) identical points negative
+        return np.maximum(d2, 0, out=d2)
+
+    def query(self, queries, k=1):
+        return self.search(queries, k)
+
+    def queryExcluding(self, queries, k, queryGroups, dataGroups):
+        return self.search(queries, k, np.asarray(queryGroups),
+                           np.asarray(dataGroups))
+
+    def search(self, queries, k, queryGroups=None, dataGroups=None):
+        '''
+        query, or queryExcluding if the groups are given. The points of the
+        query's group get an infinite distance in its block of the distance
+        matrix, so they are never selected.
+        '''
+        assert queries.ndim == 2
+        dists, indices = emptyResult(queries.shape[0], k)
+        n = min(k, self.data.shape[0])
+        if n == 0:
+            return dists, indices
+
+        for rows in self.chunks(queries.shape[0]):
+            d2 = self.squaredDistances(queries[rows])
+            if queryGroups is not None:
+                d2[queryGroups[rows, np.newaxis] ==
+                   dataGroups[np.newaxis, :]] = np.inf
+            nearest = smallestK(d2, n)
+            nearestD2 = np.take_along_axis(d2, nearest, 1)
+            if queryGroups is not None:
+                # Fewer than n points outside of the group
+                nearest[np.isinf(nearestD2)] = -1
+            indices[rows, :n] = nearest
+            dists[rows, :n] = self.distances(nearestD2)
+
+        return dists, indices
+
+    def distances(self, squaredDistances):
+        '''Converts the output of squaredDistances to distances.'''
+        return np.sqrt(squaredDistances)
+
+
+class KDTreeIndex(NearestNeighborIndex):
+    '''
+    Exact (eps=0) or approximate search with scipy's cKDTree. Works best for
+    low dimensional descriptors; for 64-D MOPS descriptors the chunked
+    BruteForceIndex is usually faster.
+    '''
+    def __init__(self, leafSize=16, eps=0, workers=1):
+        '''
+        Input:
+            leafSize -- number of points at which the tree switches to brute
+                        force
+            eps -- approximation factor, returned neighbours are no further
+                   than (1 + eps) times the true ones
+            workers -- number of threads used by query (-1 for all cores)
+        '''
+        self.leafSize = leafSize
+        self.eps = eps
+        self.workers = workers
+        self.tree = None
+
+    def fit(self, data):
+        # SciPy's spatial module is only loaded when a k-d tree is used
+        from scipy import spatial
+        assert data.ndim == 2
+        self.tree = spatial.cKDTree(np.asarray(data, dtype=np.float64),
+            leafsize=self.leafSize)
+        return self
+
+    def query(self, queries, k=1):
+        assert queries.ndim == 2
+        dists, indices = emptyResult(queries.shape[0], k)
+        if self.tree.n == 0 or queries.shape[0] == 0:
+            return dists, indices
+
+        try:
+            d, idx = self.tree.query(queries, k=k, eps=self.eps,
+                workers=self.workers)
+        except TypeError:
+            # scipy < 1.6 calls the argument n_jobs
+            d, idx = self.tree.query(queries, k=k, eps=self.eps,
+                n_jobs=self.workers)
+        d = np.reshape(d, (queries.shape[0], k))
+        idx = np.reshape(idx, (queries.shape[0], k))
+        # cKDTree marks missing neighbours with index n
+        found = idx < self.tree.n
+        dists[found] = d[found]
+        indices[found] = idx[found]
+        return dists, indices
+
+
+class LSHIndex(NearestNeighborIndex):
+    '''
+    Approximate search with p-stable locality sensitive hashing. Each of
+    numTables hash tables quantizes numProjections random projections of a
+    point into buckets of width bucketWidth. Points sharing a bucket with a
+    query in any table are candidates, which are then ranked by their exact
+    distance.
+
+    Recall controls:
+        numTables -- more tables find more true neighbours (higher recall)
+                     at the cost of more candidates and memory
+        numProjections -- more projections per table make buckets more
+                          selective (fewer candidates, lower recall)
+        bucketWidth -- wider buckets give higher recall and more candidates
+        maxCandidates -- caps the number of candidates per query and table,
+                         bounding the worst case cost of huge buckets
+    '''
+    def __init__(self, numTables=12, numProjections=8, bucketWidth=None,
+                 maxCandidates=None, seed=0):
+        '''
+        Input:
+            bucketWidth -- if None, it is set to the median distance between
+                           random pairs of indexed points
+            seed -- seed of the random projections, for reproducible results
+        '''
+        self.numTables = numTables
+        self.numProjections = numProjections
+        self.bucketWidth = bucketWidth
+        self.maxCandidates = maxCandidates
+        self.seed = seed
+        self.data = None
+
+    def estimateBucketWidth(self, data, rng, samples=512):
+        if data.shape[0] < 2:
+            return 1.0
+        a = rng.randint(0, data.shape[0], samples)
+        b = rng.randint(0, data.shape[0], samples)
+        dists = np.sqrt(((data[a] - data[b])**2).sum(1))
+        dists = dists[a != b]
+        width = np.median(dists) if dists.size else 0
+        return width if width > 0 else 1.0
+
+    def hashKeys(self, points, table):
+        '''Computes the bucket key of every point in one table.'''
+        buckets = np.floor((np.dot(points, self.projections[table]) +
+            self.offsets[table]) / self.width).astype(np.int64)
+        # Combine the bucket coordinates into a single key
+        return np.dot(buckets, self.mixers[table])
+
+    def fit(self, data):
+        assert data.ndim == 2
+        rng = np.random.RandomState(self.seed)
+        self.data = np.ascontiguousarray(data, dtype=np.float32)
+        dim = data.shape[1]
+
+        self.width = self.bucketWidth
+        if self.width is None:
+            self.width = self.estimateBucketWidth(self.data, rng)
+        self.projections = rng.standard_normal(
+            (self.numTables, dim, self.numProjections)).astype(np.float32)
+        self.offsets = rng.uniform(0, self.width,
+            (self.numTables, self.numProjections))
+        self.mixers = rng.randint(1, 2**31 - 1,
+            (self.numTables, self.numProjections)).astype(np.int64)
+
+        # Each table is stored as the sorted keys and the point indices in
+        # that order, so a bucket is a contiguous range found by binary
+        # search.
+        self.tables = []
+        for t in range(self.numTables):
+            keys = self.hashKeys(self.data, t)
+            order = np.argsort(keys, kind='stable')
+            self.tables.append((keys[order], order))
+        return self
+
+    def candidates(self, queries):
+        '''
+        Input:
+            queries -- M x D numpy array
+        Output:
+            queryIdx, dataIdx -- numpy arrays listing the unique candidate
+                                 pairs of all tables
+        '''
+        n = self.data.shape[0]
+        pairs = []
+        for t, (keys, order) in enumerate(self.tables):
+            qkeys = self.hashKeys(queries, t)
+            lo = np.searchsorted(keys, qkeys, side='left')
+            hi = np.searchsorted(keys, qkeys, side='right')
+            counts = hi - lo
+            if self.maxCandidates is not None:
+                counts = np.minimum(counts, self.maxCandidates)
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Expand every [lo, lo + count) range without a Python loop
+            qidx = np.repeat(np.arange(queries.shape[0]), counts)
+            starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            pairs.append(qidx * n + order[starts + np.arange(total)])
+
+        if not pairs:
+            return np.zeros(0, np.intp), np.zeros(0, np.intp)
+        pairs = np.unique(np.concatenate(pairs))
+        return pairs // n, pairs % n
+
+    def query(self, queries, k=1, chunkSize=4096):
+        assert queries.ndim == 2
+        dists, indices = emptyResult(queries.shape[0], k)
+        if self.data.shape[0] == 0:
+            return dists, indices
+        queries = np.asarray(queries, dtype=np.float32)
+
+        for start in range(0, queries.shape[0], chunkSize):
+            block = queries[start:start + chunkSize]
+            qidx, didx = self.candidates(block)
+            if qidx.size == 0:
+                continue
+            d = np.sqrt(((block[qidx] - self.data[didx])**2).sum(1))
+            # Sort candidates by query, then by distance, and keep the
+            # first k of every query
+            order = np.lexsort((d, qidx))
+            qidx, didx, d = qidx[order], didx[order], d[order]
+            first = np.searchsorted(qidx, qidx, side='left')
+            rank = np.arange(qidx.size) - first
+            keep = rank < k
+            rows = start + qidx[keep]
+            dists[rows, rank[keep]] = d[keep]
+            indices[rows, rank[keep]] = didx[keep]
+
+        return dists, indices
+
+
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], np.uint8)
+# Number of set bits of every 16 bit value, to count two bytes per lookup
+POPCOUNT_TABLE16 = (POPCOUNT_TABLE[:, np.newaxis] +
+                    POPCOUNT_TABLE[np.newaxis, :]).ravel()
+
+
+class HammingIndex(BruteForceIndex):
+    '''
+    Exact search over binary descriptors packed into uint8 bytes, such as
+    the ones computed by ORB. Distances are Hamming distances (number of
+    differing bits), the bit counts of the XOR of the packed bytes from a
+    popcount lookup table, two bytes per lookup if the descriptors have an
+    even number of them. The descriptors stay packed: one chunk of queries
+    is compared with one block of indexed points at a time, so that the
+    C x b x bytes XOR block fits in the smaller of maxChunkBytes and 1 MB.
+    '''
+    def fit(self, data):
+        assert data.ndim == 2
+        assert data.dtype == np.uint8, 'Hamming distance needs packed uint8 descriptors'
+        # The type the distances are returned in, infinite when excluded
+        self.dtype = np.float32
+        self.data = np.ascontiguousarray(data)
+        return self
+
+    def squaredDistances(self, queries):
+        '''
+        Input:
+            queries -- C x B numpy array of packed uint8 descriptors, a
+                       single block of queries
+        Output:
+            C x N numpy array of Hamming distances to the indexed points.
+            Unlike the Euclidean case they are not squared.
+        '''
+        assert queries.dtype == np.uint8, 'Hamming distance needs packed uint8 descriptors'
+        data, table = self.data, POPCOUNT_TABLE
+        if data.shape[1] % 2 == 0:
+            data, table = data.view(np.uint16), POPCOUNT_TABLE16
+            queries = np.ascontiguousarray(queries).view(np.uint16)
+        n = data.shape[0]
+        dists = np.empty((queries.shape[0], n), self.dtype)
+        # Blocks that stay in the CPU cache are counted fastest
+        blockSize = max(1, int(min(self.maxChunkBytes, 2**20) //
+            max(1, queries.shape[0] * data.shape[1] * data.itemsize)))
+        for start in range(0, n, blockSize):
+            rows = slice(start, min(start + blockSize, n))
+            xor = np.bitwise_xor(queries[:, np.newaxis, :],
+                                 data[np.newaxis, rows, :])
+            dists[:, rows] = table[xor].sum(2, dtype=np.int32)
+        return dists
+
+    def distances(self, squaredDistances):
+        return squaredDistances
+
+
+def recall(approxIndices, exactIndices):
+    '''
+    Input:
+        approxIndices -- M x k indices returned by an approximate index
+        exactIndices -- M x k indices returned by an exact index
+    Output:
+        Fraction of the exact nearest neighbours (first column) that were
+        found by the approximate index. Useful to tune the recall controls
+        of LSHIndex.
+    '''
+    if exactIndices.shape[0] == 0:
+        return 1.0
+    return float(np.mean(approxIndices[:, 0] == exactIndices[:, 0]))
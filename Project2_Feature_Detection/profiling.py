@@ -0,0 +1,295 @@
+import collections
+import functools
+import io
+import os
+import sys
+import threading
+import time
+
+
+## Profiling hooks #############################################################
+# Every class created with the Profiled metaclass (the detector, descriptor
+# and matcher base classes in features.py, and so all their subclasses) has
+# its HOOKED_METHODS wrapped while profiling is enabled. Profiling is
+# configured with the environment variable FEATURES_PROFILE:
+#     time          -- wall and CPU time of every call
+#     cprofile      -- cProfile of the hooked calls (outermost calls only)
+#     sample[:dt]   -- samples the stack of the profiled thread every dt
+#                      seconds (default 0.001) while a hooked call runs
+# The summary table is written at exit to the file FEATURES_PROFILE_OUTPUT,
+# or to stderr. Worker processes (e.g. of benchmark.benchmark_parallel)
+# profile their own calls and write them to the file with their pid
+# inserted before the extension. When profiling is disabled the methods are
+# not wrapped at all, so there is no overhead.
+
+HOOKED_METHODS = ('detectKeypoints', 'describeFeatures', 'matchFeatures',
+                  'matchIndices')
+
+# All classes created with Profiled, so that profiling can be enabled after
+# they are defined
+registry = []
+
+profiler = None
+
+
+class Profiled(type):
+    '''Metaclass that registers classes for profiling, see enable.'''
+    def __init__(cls, name, bases, namespace):
+        super(Profiled, cls).__init__(name, bases, namespace)
+        registry.append(cls)
+        if profiler is not None:
+            wrapClass(cls)
+
+
+def wrapClass(cls):
+    for name in HOOKED_METHODS:
+        method = cls.__dict__.get(name)
+        if method is not None and not hasattr(method, 'unprofiled'):
+            setattr(cls, name, wrapMethod(method,
+                '{}.{}'.format(cls.__name__, name)))
+
+
+def unwrapClass(cls):
+    for name in HOOKED_METHODS:
+        method = cls.__dict__.get(name)
+        if method is not None and hasattr(method, 'unprofiled'):
+            setattr(cls, name, method.unprofiled)
+
+
+def wrapMethod(method, label):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        p = profiler
+        if p is None:
+            return method(*args, **kwargs)
+        token = p.start(label)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            p.stop(label, token)
+    wrapper.unprofiled = method
+    return wrapper
+
+
+class TimingProfiler(object):
+    '''Counts the calls and sums the wall and CPU time of every method.'''
+    def __init__(self):
+        self.stats = collections.OrderedDict()
+
+    def start(self, label):
+        return time.perf_counter(), time.process_time()
+
+    def stop(self, label, token):
+        wall = time.perf_counter() - token[0]
+        cpu = time.process_time() - token[1]
+        stats = self.stats.setdefault(label, [0, 0.0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += wall
+        stats[2] += cpu
+        stats[3] = max(stats[3], wall)
+
+    def summary(self):
+        lines = [('method', 'calls', 'wall [s]', 'cpu [s]', 'mean [ms]',
+                  'max [ms]')]
+        for label, (calls, wall, cpu, longest) in sorted(self.stats.items(),
+                key=lambda item: -item[1][1]):
+            lines.append((label, str(calls), '{:.3f}'.format(wall),
+                '{:.3f}'.format(cpu), '{:.2f}'.format(1000 * wall / calls),
+                '{:.2f}'.format(1000 * longest)))
+        return formatTable(lines)
+
+
+class CProfileProfiler(TimingProfiler):
+    '''
+    Runs cProfile during the outermost hooked calls (a matcher's
+    matchFeatures calling its matchIndices is profiled once). The nesting
+    depth is counted per thread, as cProfile profiles the thread that
+    enables it. The summary adds the most expensive functions by cumulative
+    time to the timings.
+    '''
+    def __init__(self, limit=25):
+        import cProfile
+        TimingProfiler.__init__(self)
+        self.profile = cProfile.Profile()
+        self.local = threading.local()
+        self.limit = limit
+
+    def depth(self):
+        '''Number of hooked calls running in the current thread.'''
+        return getattr(self.local, 'depth', 0)
+
+    def start(self, label):
+        self.local.depth = self.depth() + 1
+        if self.local.depth == 1:
+            self.profile.enable()
+        return TimingProfiler.start(self, label)
+
+    def stop(self, label, token):
+        TimingProfiler.stop(self, label, token)
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            self.profile.disable()
+
+    def summary(self):
+        import pstats
+        out = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        return TimingProfiler.summary(self) + '\n' + out.getvalue()
+
+
+class SamplingProfiler(TimingProfiler):
+    '''
+    Samples the innermost frame of the thread running a hooked call every
+    interval seconds, from a background thread. The summary adds the
+    functions with the most samples for every hooked method. The sampling
+    overhead does not grow with the number of Python calls, unlike cProfile.
+    '''
+    def __init__(self, interval=0.001, limit=10):
+        TimingProfiler.__init__(self)
+        self.interval = interval
+        self.limit = limit
+        self.active = {}
+        self.samples = collections.defaultdict(collections.Counter)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self, label):
+        ident = threading.current_thread().ident
+        with self.lock:
+            # Samples go to the outermost hooked call of the thread
+            if ident not in self.active:
+                self.active[ident] = label
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.sample)
+                self.thread.daemon = True
+                self.thread.start()
+        return TimingProfiler.start(self, label)
+
+    def stop(self, label, token):
+        TimingProfiler.stop(self, label, token)
+        ident = threading.current_thread().ident
+        with self.lock:
+            if self.active.get(ident) == label:
+                del self.active[ident]
+
+    def sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, label in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        code = frame.f_code
+                        self.samples[label]['{}:{} ({})'.format(
+                            os.path.basename(code.co_filename),
+                            frame.f_lineno, code.co_name)] += 1
+
+    def summary(self):
+        parts = [TimingProfiler.summary(self)]
+        with self.lock:
+            for label, counter in self.samples.items():
+                total = sum(counter.values())
+                lines = [('{} ({} samples)'.format(label, total), 'share')]
+                for where, count in counter.most_common(self.limit):
+                    lines.append((where,
+                        '{:.1f}%'.format(100.0 * count / total)))
+                parts.append(formatTable(lines))
+        return '\n\n'.join(parts)
+
+
+def formatTable(lines):
+    widths = [max(len(line[i]) for line in lines)
+              for i in range(len(lines[0]))]
+    return '\n'.join(line[0].ljust(widths[0]) + ''.join(
+        '  ' + s.rjust(w) for s, w in zip(line[1:], widths[1:]))
+        for line in lines)
+
+
+def makeProfiler(mode):
+    '''
+    Input:
+        mode -- 'time', 'cprofile' or 'sample[:interval]'
+    '''
+    name, _, arg = mode.partition(':')
+    if name == 'time':
+        return TimingProfiler()
+    elif name == 'cprofile':
+        return CProfileProfiler()
+    elif name == 'sample':
+        return SamplingProfiler(float(arg) if arg else 0.001)
+    raise ValueError('Unknown profiling mode {!r}, expected time, cprofile '
+                     'or sample[:interval]'.format(mode))
+
+
+def enable(mode='time'):
+    '''Starts profiling all registered and future classes.'''
+    global profiler
+    profiler = makeProfiler(mode)
+    for cls in registry:
+        wrapClass(cls)
+    return profiler
+
+
+def disable():
+    '''Stops profiling and removes the wrappers again.'''
+    global profiler
+    profiler = None
+    for cls in registry:
+        unwrapClass(cls)
+
+
+def summary():
+    '''The summary table of the current profiler, '' if disabled.'''
+    return profiler.summary() if profiler is not None else ''
+
+
+def outputPath():
+    '''
+    The file the summary is written to, None for stderr. In a worker
+    process, FEATURES_PROFILE_OUTPUT with the pid of the worker inserted
+    before the extension, so that the workers do not overwrite the summary
+    of the main process or each other's.
+    '''
+    import multiprocessing
+    path = os.environ.get('FEATURES_PROFILE_OUTPUT')
+    if path and multiprocessing.parent_process() is not None:
+        root, ext = os.path.splitext(path)
+        path = '{}.{}{}'.format(root, os.getpid(), ext)
+    return path or None
+
+
+def writeSummary():
+    text = summary()
+    if not text:
+        return
+    path = outputPath()
+    if path:
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stderr.write(text + '\n')
+
+
+def enableAtExit():
+    '''
+    Enables profiling with the mode FEATURES_PROFILE, and writes the
+    summary when the process exits. Worker processes of multiprocessing
+    exit without running atexit handlers, but run its finalizers.
+    '''
+    import multiprocessing.util
+    enable(os.environ['FEATURES_PROFILE'])
+    multiprocessing.util.Finalize(None, writeSummary, exitpriority=0)
+
+
+# multiprocessing is only loaded when profiling
+if os.environ.get('FEATURES_PROFILE'):
+    import multiprocessing.util
+    enableAtExit()
+    # A forked worker starts with a copy of the calls of its parent, and
+    # without its finalizers, so it starts over
+    multiprocessing.util.register_after_fork(enableAtExit,
+        lambda enable: enable())
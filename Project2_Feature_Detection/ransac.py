@@ -0,0 +1,290 @@
+import numpy as np
+
+
+## Homography estimation #######################################################
+def normalizationMatrix(points):
+    '''
+    Input:
+        points -- N x 2 numpy array
+    Output:
+        3x3 numpy array that moves the centroid of the points to the origin
+        and scales them to an average distance of sqrt(2) (Hartley
+        normalization), which keeps the DLT well conditioned for pixel
+        coordinates.
+    '''
+    centroid = points.mean(0)
+    meanDist = np.sqrt(((points - centroid)**2).sum(1)).mean()
+    s = np.sqrt(2) / meanDist if meanDist > 0 else 1.0
+    return np.array([[s, 0, -s * centroid[0]],
+                     [0, s, -s * centroid[1]],
+                     [0, 0, 1]])
+
+
+def transformPoints(T, points):
+    '''Applies the 3x3 transform T to the N x 2 array points.'''
+    return np.dot(points, T[:2, :2].T) + T[:2, 2]
+
+
+def solveHomographies(src, dst):
+    '''
+    Input:
+        src -- B x n x 2 numpy array, B sets of n >= 4 source points
+        dst -- B x n x 2 numpy array with the corresponding destinations
+    Output:
+        B x 3 x 3 numpy array with the homography of every set, solved by
+        the direct linear transform. All sets are solved with a single
+        stacked SVD. Each homography is scaled so that its last entry is 1
+        (if it is not zero).
+    '''
+    numSets, n = src.shape[:2]
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+
+    A = np.zeros((numSets, 2 * n, 9))
+    A[:, 0::2, 0] = x
+    A[:, 0::2, 1] = y
+    A[:, 0::2, 2] = 1
+    A[:, 0::2, 6] = -u * x
+    A[:, 0::2, 7] = -u * y
+    A[:, 0::2, 8] = -u
+    A[:, 1::2, 3] = x
+    A[:, 1::2, 4] = y
+    A[:, 1::2, 5] = 1
+    A[:, 1::2, 6] = -v * x
+    A[:, 1::2, 7] = -v * y
+    A[:, 1::2, 8] = -v
+
+    # The solution is the right singular vector of the smallest singular
+    # value. For n == 4, A is 8x9, so the full V is needed; for larger n
+    # the reduced SVD avoids the 2n x 2n U.
+    _, _, vt = np.linalg.svd(A, full_matrices=2 * n < 9)
+    H = vt[:, -1, :].reshape(numSets, 3, 3)
+
+    scale = H[:, 2, 2].copy()
+    scale[np.abs(scale) < 1e-12] = 1
+    return H / scale[:, np.newaxis, np.newaxis]
+
+
+def squaredErrors(H, src, dst):
+    '''
+    Input:
+        H -- B x 3 x 3 numpy array of homographies
+        src -- N x 2 numpy array of source points
+        dst -- N x 2 numpy array of destination points
+    Output:
+        B x N numpy array with the squared reprojection error of every point
+        under every homography, computed in one broadcasted operation.
+        Points mapped to infinity get an infinite error.
+    '''
+    # B x 3 x N projected homogeneous points
+    proj = np.matmul(H[:, :, :2], src.T)
+    proj += H[:, :, 2:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = 1 / proj[:, 2]
+        du = proj[:, 0] * w - dst[:, 0]
+        dv = proj[:, 1] * w - dst[:, 1]
+        errors = du * du + dv * dv
+    errors[~np.isfinite(errors)] = np.inf
+    return errors
+
+
+def denormalize(H, T1, T2):
+    '''Maps a homography estimated in normalized coordinates back.'''
+    H = np.dot(np.linalg.inv(T2), np.dot(H, T1))
+    return H / H[2, 2] if abs(H[2, 2]) > 1e-12 else H
+
+
+def sampleSets(rng, numPoints, numSets, sampleSize=4):
+    '''
+    Draws numSets random sets of sampleSize distinct point indices, as a
+    numSets x sampleSize numpy array. Sets with repeated indices are drawn
+    again.
+    '''
+    sets = rng.randint(0, numPoints, (numSets, sampleSize))
+    while True:
+        repeated = hasRepeats(sets)
+        if not repeated.any():
+            return sets
+        sets[repeated] = rng.randint(0, numPoints,
+            (repeated.sum(), sampleSize))
+
+
+def hasRepeats(sets):
+    '''Marks the rows of sets that contain an index more than once.'''
+    s = np.sort(sets, 1)
+    return (s[:, 1:] == s[:, :-1]).any(1)
+
+
+def prosacSubsetSizes(numPoints, maxIterations, sampleSize=4):
+    '''
+    Input:
+        numPoints -- number of correspondences, sorted from best to worst
+        maxIterations -- the number of hypotheses after which PROSAC is
+                         equivalent to RANSAC
+    Output:
+        numpy array whose entry t is the size of the subset of best
+        correspondences that hypothesis t is drawn from (the growth function
+        of Chum and Matas, "Matching with PROSAC", 2005).
+    '''
+    sizes = np.full(maxIterations, numPoints, np.intp)
+    # Expected number of samples drawn from the top n points, T_n
+    Tn = float(maxIterations)
+    for i in range(sampleSize):
+        Tn *= float(sampleSize - i) / (numPoints - i)
+
+    t, n = 0, sampleSize
+    while n < numPoints and t < maxIterations:
+        TnNext = Tn * (n + 1) / (n + 1 - sampleSize)
+        steps = max(1, int(np.ceil(TnNext - Tn)))
+        sizes[t:t + steps] = n
+        t, n, Tn = t + steps, n + 1, TnNext
+    return sizes
+
+
+def sampleProsacSets(rng, subsetSizes, sampleSize=4):
+    '''
+    Draws one set per entry of subsetSizes: the last point of the subset
+    plus sampleSize - 1 distinct points from the rest of the subset.
+    '''
+    numSets = subsetSizes.shape[0]
+    bounds = (subsetSizes - 1)[:, np.newaxis]
+    sets = np.empty((numSets, sampleSize), np.intp)
+    sets[:, -1] = subsetSizes - 1
+    rows = np.ones(numSets, bool)
+    while rows.any():
+        sets[rows, :-1] = (rng.random_sample((rows.sum(), sampleSize - 1)) *
+            bounds[rows]).astype(np.intp)
+        rows = hasRepeats(sets)
+    return sets
+
+
+def degenerateSets(points, sets):
+    '''
+    Marks the minimal sets with three (nearly) collinear points, which do not
+    determine a homography.
+    '''
+    p = points[sets]
+    degenerate = np.zeros(sets.shape[0], bool)
+    for a, b, c in ((0, 1, 2), (0, 1, 3), (0, 2, 3), (1, 2, 3)):
+        u, v = p[:, b] - p[:, a], p[:, c] - p[:, a]
+        area = np.abs(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0])
+        degenerate |= area < 1e-6
+    return degenerate
+
+
+def requiredIterations(inlierRatio, confidence, sampleSize=4):
+    '''
+    Number of random minimal sets needed to draw at least one outlier-free
+    set with the given confidence.
+    '''
+    good = inlierRatio**sampleSize
+    if good <= 0:
+        return np.inf
+    if good >= 1:
+        return 0
+    return np.log(1 - confidence) / np.log(1 - good)
+
+
+def refine(H, srcN, dstN, thresholdN, inliers, iterations):
+    '''
+    Re-estimates H by least squares (DLT) on all its inliers, and updates the
+    inliers, until they no longer change or iterations is reached.
+    '''
+    for _ in range(iterations):
+        if inliers.sum() < 4:
+            break
+        refined = solveHomographies(srcN[inliers][np.newaxis],
+            dstN[inliers][np.newaxis])
+        refinedInliers = squaredErrors(refined, srcN, dstN)[0] < thresholdN**2
+        # Keep the refinement only if it does not lose support
+        if refinedInliers.sum() < inliers.sum():
+            break
+        changed = np.any(refinedInliers != inliers)
+        H, inliers = refined[0], refinedInliers
+        if not changed:
+            break
+    return H, inliers
+
+
+def findHomography(src, dst, threshold=3.0, confidence=0.999,
+                   maxIterations=2000, distances=None, refineIterations=5,
+                   batchSize=None, maxBatchElements=2**22, seed=0):
+    '''
+    Input:
+        src -- N x 2 numpy array of points in the first image
+        dst -- N x 2 numpy array of the matching points in the second image
+        threshold -- maximum reprojection error (in pixels) of an inlier
+        confidence -- probability of having drawn an outlier-free minimal
+                      set at which sampling stops early
+        maxIterations -- maximum number of minimal sets (hypotheses) to try
+        distances -- optional match distances (or ratio scores) of the
+                     correspondences, lower is better. If given, sampling
+                     follows PROSAC and starts with the best matches, which
+                     usually terminates much earlier.
+        refineIterations -- rounds of least-squares re-estimation on all
+                            inliers of the best hypothesis, 0 to disable
+        batchSize -- number of hypotheses solved and scored together, if
+                     None it is derived from maxBatchElements
+        maxBatchElements -- bound on hypotheses x points per batch, which
+                            bounds the memory of the scoring step
+        seed -- seed of the random sampling, for reproducible results
+    Output:
+        H -- 3x3 numpy array with the homography mapping src to dst with the
+             most inliers, or None if there are fewer than 4 points
+        inliers -- boolean numpy array marking the inliers of H
+    '''
+    src = np.asarray(src, dtype=np.float64).reshape(-1, 2)
+    dst = np.asarray(dst, dtype=np.float64).reshape(-1, 2)
+    assert src.shape == dst.shape
+    n = src.shape[0]
+    if n < 4:
+        return None, np.zeros(n, bool)
+
+    # PROSAC works on the correspondences sorted from best to worst
+    order = None
+    if distances is not None:
+        order = np.argsort(np.asarray(distances).reshape(-1), kind='stable')
+        src, dst = src[order], dst[order]
+        subsetSizes = prosacSubsetSizes(n, maxIterations)
+
+    # Estimate in normalized coordinates and map back at the end
+    T1, T2 = normalizationMatrix(src), normalizationMatrix(dst)
+    srcN, dstN = transformPoints(T1, src), transformPoints(T2, dst)
+    thresholdN = threshold * T2[0, 0]
+
+    if batchSize is None:
+        batchSize = max(1, min(256, maxIterations, maxBatchElements // n))
+    rng = np.random.RandomState(seed)
+
+    bestH, bestCount = None, 0
+    tried, needed = 0, maxIterations
+    while tried < min(needed, maxIterations):
+        numSets = min(batchSize, maxIterations - tried)
+        if order is not None:
+            sets = sampleProsacSets(rng, subsetSizes[tried:tried + numSets])
+        else:
+            sets = sampleSets(rng, n, numSets)
+        tried += numSets
+
+        sets = sets[~degenerateSets(srcN, sets)]
+        if sets.shape[0] == 0:
+            continue
+        H = solveHomographies(srcN[sets], dstN[sets])
+        counts = (squaredErrors(H, srcN, dstN) < thresholdN**2).sum(1)
+        best = counts.argmax()
+        if counts[best] > bestCount:
+            bestH, bestCount = H[best], counts[best]
+            needed = requiredIterations(float(bestCount) / n, confidence)
+
+    if bestH is None:
+        return None, np.zeros(n, bool)
+
+    inliers = squaredErrors(bestH[np.newaxis], srcN, dstN)[0] < thresholdN**2
+    bestH, inliers = refine(bestH, srcN, dstN, thresholdN, inliers,
+        refineIterations)
+
+    if order is not None:
+        unsorted = np.empty_like(inliers)
+        unsorted[order] = inliers
+        inliers = unsorted
+    return denormalize(bestH, T1, T2), inliers
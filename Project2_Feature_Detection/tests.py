@@ -1,8 +1,30 @@
 import numpy as np
 import sys, os, imp
+import concurrent.futures
+import contextlib
 import cv2
 import transformations
 import features
+import benchmark
+import collection
+import compact
+import extract
+import featurecache
+import featureio
+import functools
+import imagecache
+import imagecontext
+import io
+import matchfilter
+import neighbors
+import profiling
+import ransac
+import tracking
+import vocabulary
+import scipy.spatial
+import shutil
+import tempfile
+import threading
 import traceback
 
 from PIL import Image
@@ -33,6 +55,15 @@ def compare_cv2_points(pnt1, pnt2):
     if not np.isclose(pnt1.response,pnt2.response,rtol=1e-3,atol=1e-5): return False
     return True
 
+def compare_equal(arr1, arr2):
+    return np.array_equal(arr1, arr2)
+
+def compare_close(arr1, arr2):
+    return np.allclose(arr1, arr2, rtol=1e-6, atol=1e-6)
+
+def compare_different(x1, x2):
+    return x1 != x2
+
 # Testing function
 def try_this(todo, run, truth, compare, *args, **kargs):
     '''
@@ -86,6 +117,7 @@ def compute_and_save():
 #compute_and_save()
 
 
+
 '''
 Load in the numpy arrays which hold results for triangle1.jpg.
 
@@ -127,3 +159,697 @@ try_this(4, SFD.describeFeatures, loaded['e'], compare_array, image, d)
 
 try_this('5 and/or 6', MFD.describeFeatures, loaded['f'], compare_array, image, d)
 
+
+'''
+Regression tests of the optimized matching, evaluation and storage code.
+They compare the results with straightforward reference implementations,
+such as the loops that were replaced, and do not use resources/arrays.npz.
+'''
+rng = np.random.RandomState(0)
+tempDir = tempfile.mkdtemp()
+
+desc1 = rng.standard_normal((40, 64))
+desc2 = rng.standard_normal((30, 64))
+
+# The batched transformations equal the stacked matrices of one point
+transformRng = np.random.RandomState(2)
+anglesX, anglesY, anglesZ = transformRng.uniform(-np.pi, np.pi, (3, 10))
+transVecs = transformRng.uniform(-100, 100, (10, 3))
+scalesX, scalesY, scalesZ = transformRng.uniform(0.1, 2, (3, 10))
+
+try_this('rotation batch', transformations.get_rot_mx_batch,
+         np.stack([transformations.get_rot_mx(*a) for a in
+                   zip(anglesX, anglesY, anglesZ)]), compare_close,
+         anglesX, anglesY, anglesZ)
+try_this('rotation batch around z', transformations.get_rot_mx_batch,
+         np.stack([transformations.get_rot_mx(0, 0, a) for a in anglesZ]),
+         compare_close, 0, 0, anglesZ)
+try_this('translation batch', transformations.get_trans_mx_batch,
+         np.stack([transformations.get_trans_mx(v) for v in transVecs]),
+         compare_equal, transVecs)
+try_this('scale batch', transformations.get_scale_mx_batch,
+         np.stack([transformations.get_scale_mx(*s) for s in
+                   zip(scalesX, scalesY, scalesZ)]), compare_equal,
+         scalesX, scalesY, scalesZ)
+try_this('scale batch in 2D', transformations.get_scale_mx_batch,
+         np.stack([transformations.get_scale_mx(s, s, 1) for s in scalesX]),
+         compare_equal, scalesX, scalesX, 1)
+
+# The original MOPS transform of a feature at (x, y) with angle in degrees
+def mops_transform(x, y, angle):
+    translation_1 = transformations.get_trans_mx(np.array([-x, -y, 0]))
+    rotation = transformations.get_rot_mx(0, 0, -angle/180*np.pi)
+    scale = transformations.get_scale_mx(0.2, 0.2, 1)
+    translation_2 = transformations.get_trans_mx(np.array([4, 4, 0]))
+    temp = np.dot(translation_2, np.dot(scale, np.dot(rotation,
+                  translation_1)))
+    return np.array([[temp[0][0], temp[0][1], temp[0][3]],
+                     [temp[1][0], temp[1][1], temp[1][3]]])
+
+featureX, featureY = transformRng.uniform(0, 500, (2, 10))
+featureAngles = transformRng.uniform(0, 360, 10)
+mopsTransforms = np.stack([mops_transform(*f) for f in
+                           zip(featureX, featureY, featureAngles)])
+
+try_this('similarity transforms', transformations.get_similarity_mx_2d,
+         mopsTransforms, compare_close, featureX, featureY,
+         np.radians(featureAngles), 0.2, (4, 4))
+try_this('batched MOPS transforms', lambda: transformations.get_affine_2d(
+         np.matmul(transformations.get_trans_mx(np.array([4, 4, 0])),
+         np.matmul(transformations.get_scale_mx(0.2, 0.2, 1),
+         np.matmul(transformations.get_rot_mx_batch(0, 0,
+         -np.radians(featureAngles)), transformations.get_trans_mx_batch(
+         np.stack([-featureX, -featureY, np.zeros(10)], 1)))))),
+         mopsTransforms, compare_close)
+
+# Nearest neighbours of the rows of desc1 in desc2 from the full scipy
+# cdist matrix, as found by the original SSD and ratio matchers
+def cdist_matches(desc1, desc2):
+    dist = scipy.spatial.distance.cdist(desc1, desc2, 'euclidean')
+    rows = np.arange(len(desc1))
+    trainIdx = dist.argmin(1)
+    best = dist[rows, trainIdx]
+    dist[rows, trainIdx] = 1000
+    second = dist[rows, dist.argmin(1)]
+    ratios = np.ones(len(desc1))
+    ratios[second != 0] = best[second != 0] / second[second != 0]
+    return rows, trainIdx, best, ratios
+
+rows, trainIdx, best, ratios = cdist_matches(desc1, desc2)
+
+try_this('SSD matching', features.SSDFeatureMatcher().matchIndices,
+         (rows, trainIdx, best), compare_close, desc1, desc2)
+try_this('SSD matching in chunks of 1', features.SSDFeatureMatcher(
+         neighbors.BruteForceIndex(1)).matchIndices, (rows, trainIdx, best),
+         compare_close, desc1, desc2)
+try_this('SSD matching in chunks of 7', features.SSDFeatureMatcher(
+         neighbors.BruteForceIndex(7)).matchIndices, (rows, trainIdx, best),
+         compare_close, desc1, desc2)
+try_this('SSD matching with a k-d tree', features.SSDFeatureMatcher(
+         neighbors.KDTreeIndex()).matchIndices, (rows, trainIdx, best),
+         compare_close, desc1, desc2)
+
+try_this('ratio matching', features.RatioFeatureMatcher().matchIndices,
+         (rows, trainIdx, ratios), compare_close, desc1, desc2)
+try_this('ratio matching in chunks of 7', features.RatioFeatureMatcher(
+         neighbors.BruteForceIndex(7)).matchIndices, (rows, trainIdx, ratios),
+         compare_close, desc1, desc2)
+# Without a second neighbour the ratio is the neutral 1, not the best 0
+try_this('ratio matching with one feature',
+         features.RatioFeatureMatcher().matchIndices,
+         (rows, np.zeros(len(desc1)), np.ones(len(desc1))), compare_equal,
+         desc1, desc2[:1])
+try_this('Hamming ratio matching with one feature',
+         features.HammingFeatureMatcher(ratioTest=True).matchIndices,
+         (rows, np.zeros(len(desc1)), np.ones(len(desc1))), compare_equal,
+         np.packbits(desc1 > 0, 1), np.packbits(desc2[:1] > 0, 1))
+
+# Cross checked matching keeps the mutual nearest neighbours, and leaves
+# the index of the matcher fitted to the second image
+mutual = cdist_matches(desc2, desc1)[1][trainIdx] == rows
+
+def cross_check(matcher, desc1, desc2):
+    matches = matcher.matchIndices(desc1, desc2)
+    if not hasattr(matcher, 'index'):
+        return matches
+    return matches + (matcher.index.query(desc1)[1][:, 0],)
+
+try_this('SSD cross check', cross_check, (rows[mutual], trainIdx[mutual],
+         best[mutual], trainIdx), compare_close,
+         features.SSDFeatureMatcher(crossCheck=True), desc1, desc2)
+try_this('SSD cross check with a k-d tree', cross_check, (rows[mutual],
+         trainIdx[mutual], best[mutual], trainIdx), compare_close,
+         features.SSDFeatureMatcher(neighbors.KDTreeIndex(), True), desc1,
+         desc2)
+try_this('ratio cross check', cross_check, (rows[mutual], trainIdx[mutual],
+         ratios[mutual], trainIdx), compare_close,
+         features.RatioFeatureMatcher(crossCheck=True), desc1, desc2)
+
+# Hamming distances of packed bits, from the unpacked bits
+bits1, bits2 = desc1 > 0, desc2 > 0
+hamming = (bits1[:, None, :] != bits2[None, :, :]).sum(2)
+hammingTrainIdx = hamming.argmin(1)
+hammingMutual = hamming.argmin(0)[hammingTrainIdx] == rows
+# Hamming search on the packed bytes, with an odd number of them (one byte
+# per popcount lookup) and in blocks of a few points. Random bits tie, so
+# the distances of the returned neighbours are checked instead of them.
+def hamming_search(index, bits1, bits2, reference):
+    dists, indices = index.fit(np.packbits(bits2, 1)).query(
+        np.packbits(bits1, 1), 3)
+    return dists, np.take_along_axis(reference, indices, 1), index.data.dtype
+
+for numBits, maxChunkBytes in ((64, 64 * 2**20), (64, 1000), (56, 1000)):
+    reference = (bits1[:, None, :numBits] != bits2[None, :, :numBits]).sum(2)
+    try_this('Hamming search', hamming_search, (np.sort(reference, 1)[:, :3],
+             np.sort(reference, 1)[:, :3], np.uint8), compare_equal,
+             neighbors.HammingIndex(maxChunkBytes=maxChunkBytes),
+             bits1[:, :numBits], bits2[:, :numBits], reference)
+
+try_this('Hamming cross check', cross_check, (rows[hammingMutual],
+         hammingTrainIdx[hammingMutual],
+         hamming[rows, hammingTrainIdx][hammingMutual]), compare_equal,
+         features.HammingFeatureMatcher(crossCheck=True),
+         np.packbits(bits1, 1), np.packbits(bits2, 1))
+
+# detectKeypoints still works with overrides of computeHarrisValues with the
+# one argument signature, like HKD2 above
+class HKD4(features.HarrisKeypointDetector):
+    def computeHarrisValues(self, image):
+        return features.HarrisKeypointDetector.computeHarrisValues(self, image)
+
+try_this('Harris with a one argument computeHarrisValues',
+         HKD4().detectKeypoints,
+         features.HarrisKeypointDetector().detectKeypoints(image),
+         compare_cv2_points, image)
+try_this('Harris with the gradients of an image context',
+         features.HarrisKeypointDetector().detectKeypoints,
+         features.HarrisKeypointDetector().detectKeypoints(image),
+         compare_cv2_points, imagecontext.ImageContext(image))
+
+# Points related by a homography, the first 20 of them moved off it
+H = np.array([[0.9, 0.1, 12.0], [-0.05, 1.1, -7.0], [1e-4, -2e-4, 1.0]])
+inliers = np.arange(60) >= 20
+points1 = rng.uniform(0, 500, (60, 2))
+points2 = features.FeatureMatcher.applyHomographies(points1, H)
+points2[~inliers] += rng.uniform(50, 100, (20, 2))
+
+try_this('RANSAC', ransac.findHomography, (H, inliers), compare_close,
+         points1, points2)
+try_this('RANSAC with PROSAC', functools.partial(ransac.findHomography,
+         distances=np.where(inliers, 1.0, 2.0)), (H, inliers), compare_close,
+         points1, points2)
+try_this('RANSAC in batches of 3', functools.partial(ransac.findHomography,
+         batchSize=3), (H, inliers), compare_close, points1, points2)
+
+# Match filtering by distance, then by the RANSAC homography
+filterMatches = (np.arange(60), np.arange(60), (np.arange(60) % 4) / 2.0)
+
+def filter_matches(matchFilter):
+    return matchFilter.filter(points1, points2, filterMatches) + \
+        (matchFilter.homography,)
+
+kept = filterMatches[2] < 1.2
+try_this('match filter distance', filter_matches, (np.flatnonzero(kept),
+         np.flatnonzero(kept), filterMatches[2][kept], None),
+         compare_equal, matchfilter.MatchFilter(1.2))
+kept &= inliers
+try_this('match filter', filter_matches, (np.flatnonzero(kept),
+         np.flatnonzero(kept), filterMatches[2][kept], H), compare_close,
+         matchfilter.MatchFilter(1.2, verify=True))
+
+keypoints1 = [cv2.KeyPoint(x, y, 10, a, r) for (x, y), a, r in
+              zip(points1, rng.uniform(0, 360, 60), rng.uniform(0, 1, 60))]
+keypoints2 = [cv2.KeyPoint(x, y, 10) for x, y in points2]
+# A third of the matches point to the wrong keypoint. The distances are
+# rounded, so that some of them tie.
+matches = [cv2.DMatch(i, (i * 7) % 60 if i % 3 == 0 else i, d) for i, d in
+           enumerate(np.round(rng.uniform(0, 2, 60), 1))]
+distances = np.array([m.distance for m in matches])
+
+# The original addROCData and computeROCCurve, looping over the matches
+def loop_roc_data(f1, f2, matches, h, threshold):
+    isMatch = []
+    maxD = 0
+    for m in matches:
+        ptOld = np.array(f2[m.trainIdx].pt)
+        ptNew = features.FeatureMatcher.applyHomography(f1[m.queryIdx].pt, h)
+        d = np.linalg.norm(ptNew - ptOld)
+        isMatch.append(1 if d <= threshold else 0)
+        maxD = max(maxD, m.distance)
+    return isMatch, maxD
+
+def loop_roc_curve(matches, isMatch, thresholds):
+    dataPoints = []
+    actualCorrect = sum(isMatch)
+    actualError = len(isMatch) - actualCorrect
+    for threshold in thresholds:
+        tp = sum(1 for m, c in zip(matches, isMatch)
+                 if c and m.distance < threshold)
+        fp = sum(1 for m, c in zip(matches, isMatch)
+                 if not c and m.distance < threshold)
+        trueRate = (float(tp) / actualCorrect) if actualCorrect != 0 else 0
+        falseRate = (float(fp) / actualError) if actualError != 0 else 0
+        dataPoints.append((falseRate, trueRate))
+    return dataPoints
+
+isMatch, maxD = loop_roc_data(keypoints1, keypoints2, matches, H.ravel(), 5)
+
+try_this('ROC data', benchmark.addROCData, (isMatch, maxD), compare_close,
+         keypoints1, keypoints2, matches, H.ravel(), 5)
+try_this('ROC curve at 500 thresholds', benchmark.computeROCCurve,
+         loop_roc_curve(matches, isMatch, np.linspace(0.0, maxD+1, num=500)),
+         compare_close, matches, isMatch, np.linspace(0.0, maxD+1, num=500))
+# The exact curve has one point per distinct distance, as if sampled just
+# above each of them, and starts at (0, 0)
+try_this('exact ROC curve', benchmark.computeROCCurve,
+         loop_roc_curve(matches, isMatch, np.r_[0, np.nextafter(
+         np.unique(distances), np.inf)]), compare_close, matches, isMatch)
+try_this('exact ROC curve of a distance array', benchmark.computeROCCurve,
+         benchmark.computeROCCurve(matches, isMatch), compare_close,
+         distances, isMatch)
+# The benchmarks sample the curve at 500 thresholds unless the exact one
+# is asked for
+try_this('benchmark ROC curve', lambda: benchmark.evaluate_matches(
+         keypoints1, keypoints2, matches, H.ravel(), 5)[2],
+         loop_roc_curve(matches, isMatch, np.linspace(0.0, maxD+1, num=500)),
+         compare_close)
+try_this('exact benchmark ROC curve', lambda: benchmark.evaluate_matches(
+         keypoints1, keypoints2, matches, H.ravel(), 5, None)[2],
+         benchmark.computeROCCurve(matches, isMatch), compare_close)
+
+# Feature cache keys change with the image, the configuration and the
+# version, and the entries on disk are found by later caches
+cache = featurecache.FeatureCache(os.path.join(tempDir, 'features'))
+key = cache.key(image, 'describe', HKD4(), MFD, 0.01)
+
+try_this('feature cache key', cache.key, key, compare_equal, image,
+         'describe', HKD4(), features.MOPSFeatureDescriptor(), 0.01)
+try_this('feature cache key of another image', cache.key, key,
+         compare_different, 255 - image, 'describe', HKD4(), MFD, 0.01)
+try_this('feature cache key of another backend', cache.key, key,
+         compare_different, image, 'describe', HKD4('opencv'), MFD, 0.01)
+try_this('feature cache key of another threshold', cache.key, key,
+         compare_different, image, 'describe', HKD4(), MFD, 0.02)
+try_this('feature cache key of another version', featurecache.FeatureCache(
+         version=2).key, key, compare_different, image, 'describe', HKD4(),
+         MFD, 0.01)
+
+kps, desc = cache.computeFeatures(image, HKD4(), MFD, 0.01)
+cache = featurecache.FeatureCache(os.path.join(tempDir, 'features'))
+try_this('feature cache on disk', lambda: cache.computeFeatures(image,
+         HKD4(), MFD, 0.01)[0], kps, compare_cv2_points)
+try_this('feature cache hits', lambda: (cache.hits, cache.misses), (1, 0),
+         compare_equal)
+
+# Feature files store keypoints, descriptors and matches losslessly
+path = os.path.join(tempDir, 'features.npz')
+packedColumns = (featureio.packKeypoints(keypoints1), desc1) + \
+    featureio.matchArrays(matches)
+
+for compress, mmap in ((False, True), (False, False), (True, True)):
+    featureio.saveFeatures(path, keypoints1, desc1, matches, compress)
+    with featureio.loadFeatures(path, mmap) as f:
+        try_this('feature file with compress={}, mmap={}'.format(compress,
+                 mmap), lambda: (f.keypointArray(), f['descriptors']) +
+                 f.matchArrays(), packedColumns, compare_equal)
+
+path = os.path.join(tempDir, 'features.json')
+with featureio.JSONFeatureWriter(open(path, 'w')) as writer:
+    writer.write('keypoints', keypoints1)
+    writer.write('descriptors', desc1)
+    writer.write('matches', matches)
+
+for blockSize in (2**20, 64):
+    with open(path) as f:
+        jsonFeatures = featureio.JSONFeatureReader(f,
+            blockSize=blockSize).read()
+    try_this('JSON feature file read in blocks of {}'.format(blockSize),
+             lambda: (featureio.packKeypoints(jsonFeatures['keypoints']),
+             jsonFeatures['descriptors']) +
+             featureio.matchArrays(jsonFeatures['matches']),
+             packedColumns, compare_equal)
+try_this('JSON keypoints in chunks', lambda: [featureio.packKeypoints(chunk)
+         for chunk in featureio.iterKeypoints(path, chunkSize=25)],
+         [packedColumns[0][:25], packedColumns[0][25:50],
+         packedColumns[0][50:]], compare_equal)
+
+# The parallel runner gives the results of benchmark_dir, in dataset and
+# pair order, with any number of workers. The datasets are shifted and
+# rotated crops of the Yosemite and Graffiti images.
+datasets = [os.path.join(tempDir, name) for name in ('dataset1', 'dataset2')]
+for dataset, source in zip(datasets, ('yosemite/yosemite1.jpg',
+                                      'graf/img1.png')):
+    os.mkdir(dataset)
+    sourceImage = cv2.imread(os.path.join('resources', source))[100:260,
+                                                               200:360]
+    cv2.imwrite(os.path.join(dataset, 'img1.png'), sourceImage)
+    for i, (angle, tx, ty) in enumerate([(0, 5, 3), (10, -4, 7), (-5, 2, 0)]):
+        h = np.dot(transformations.get_trans_mx(np.array([tx, ty, 0])),
+                   transformations.get_rot_mx(0, 0, np.radians(angle)))
+        h = h[[0, 1, 3]][:, [0, 1, 3]]
+        cv2.imwrite(os.path.join(dataset, 'img{}.png'.format(i + 2)),
+                    cv2.warpPerspective(sourceImage, h, (160, 160)))
+        np.savetxt(os.path.join(dataset, 'H1to{}p'.format(i + 2)), h)
+
+def benchmark_results(results):
+    return [np.r_[ds, aucs] for ds, aucs, _ in results] + \
+        [roc_img for _, _, roc_img in results]
+
+serialResults = benchmark_results([benchmark.benchmark_dir(dataset,
+    features.HarrisKeypointDetector(), features.MOPSFeatureDescriptor(),
+    features.RatioFeatureMatcher(), 0.01, 5) for dataset in datasets])
+
+try_this('benchmark in one process', lambda: benchmark_results(
+         benchmark.benchmark_parallel(datasets, 'HarrisKeypointDetector',
+         'MOPSFeatureDescriptor', 'RatioFeatureMatcher', 0.01, 5, workers=1)),
+         serialResults, compare_close)
+try_this('benchmark with 2 workers', lambda: benchmark_results(
+         benchmark.benchmark_parallel(datasets, 'HarrisKeypointDetector',
+         'MOPSFeatureDescriptor', 'RatioFeatureMatcher', 0.01, 5, workers=2)),
+         serialResults, compare_close)
+
+# KLT tracking of a view moving 2 pixels to the left per frame. In the
+# third frame, the top left cell of the 2 x 2 grid is covered by noise.
+view = cv2.imread(os.path.join('resources', 'yosemite', 'yosemite1.jpg'))
+frames = [view[150:310, 100 + 2 * k:260 + 2 * k].copy() for k in range(3)]
+frames[2][:80, :80] = np.random.RandomState(1).randint(0, 256, (80, 80, 3))
+
+# Movement of the tracks of keypoints1 that are still in keypoints2
+def track_shifts(keypoints1, keypoints2):
+    pts = dict((kp.class_id, kp.pt) for kp in keypoints1)
+    return np.array([np.subtract(kp.pt, pts[kp.class_id])
+                     for kp in keypoints2 if kp.class_id in pts])
+
+(kps0, _), (kps1, _) = tracking.trackSequence(frames[:2],
+    features.HarrisKeypointDetector(), MFD, gridShape=(2, 2))
+try_this('KLT track ids', lambda: (len(track_shifts(kps0, kps1)) >=
+         0.9 * len(kps0), np.abs(track_shifts(kps0, kps1) - (-2, 0)).max()
+         < 0.25), (True, True), compare_equal)
+
+tracker = tracking.KLTTracker(features.HarrisKeypointDetector(), MFD,
+                              gridShape=(2, 2))
+tracker.update(frames[0])
+kps1, _ = tracker.update(frames[1])
+# Points at least half a flow window inside the noise cannot be tracked
+points = features.keypointCoordinates(kps1)
+occluded = (points[:, 0] < 66) & (points[:, 1] < 66)
+try_this('KLT forward-backward check', lambda: tracker.trackPoints(
+         cv2.cvtColor(frames[2], cv2.COLOR_BGR2GRAY), points)[1][occluded],
+         np.zeros(occluded.sum(), bool), compare_equal)
+
+# Only the covered cell is detected again, its tracks are replaced by new
+# ones
+nextId = tracker.nextId
+kps2, _ = tracker.update(frames[2])
+inCell = np.array([kp.pt[0] < 80 and kp.pt[1] < 80 for kp in kps2])
+isNew = np.array([kp.class_id >= nextId for kp in kps2])
+try_this('KLT grid re-detection', lambda: (tracker.lastRedetected, isNew,
+         len(kps2) >= 0.9 * len(kps1)), (1, inCell, True), compare_equal)
+
+# extract.py only recomputes outputs that are out of date. Each run returns
+# the feature and match files it wrote.
+extractImages = os.path.join(tempDir, 'frames')
+extractOutput = os.path.join(tempDir, 'extracted')
+os.mkdir(extractImages)
+for i, frame in enumerate(frames):
+    cv2.imwrite(os.path.join(extractImages, 'img{}.png'.format(i + 1)), frame)
+
+def extract_outputs():
+    return dict((os.path.relpath(os.path.join(d, fn), extractOutput),
+                 os.stat(os.path.join(d, fn)).st_ino)
+                for d, _, filenames in os.walk(extractOutput)
+                for fn in filenames)
+
+def run_extract(*args):
+    before = extract_outputs()
+    with contextlib.redirect_stdout(io.StringIO()):
+        extract.main([extractImages, extractOutput, '--match', 'consecutive',
+                      '--workers', '1'] + list(args))
+    after = extract_outputs()
+    return sorted(path for path in after if before.get(path) != after[path])
+
+extracted = ['img1.png.npz', 'img2.png.npz', 'img3.png.npz',
+             'matches/img1.png--img2.png.npz',
+             'matches/img2.png--img3.png.npz']
+try_this('extract', run_extract, extracted, compare_equal)
+try_this('extract again', run_extract, [], compare_equal)
+newest = max(os.stat(os.path.join(extractOutput, path)).st_mtime_ns
+             for path in extracted)
+os.utime(os.path.join(extractImages, 'img2.png'), ns=(newest + 10**9,) * 2)
+try_this('extract after touching an image', run_extract, [extracted[1]] +
+         extracted[3:], compare_equal)
+try_this('extract with other detector arguments', run_extract, extracted,
+         compare_equal, '--detector-args', '{"backend": "opencv"}')
+
+# A collection of two overlapping views of each of three scenes, image i
+# overlaps image i + 3. The overlapping pairs get the most keypoint votes
+# and are the ones verified.
+views = [cv2.imread(os.path.join('resources', name))[100:260, x:x + 160]
+         for x in (200, 206) for name in ('yosemite/yosemite1.jpg',
+         'graf/img1.png', 'leuven/img1.png')]
+viewFeatures = [benchmark.compute_features(v, HKD4(), MFD, 0.01)
+                for v in views]
+viewKeypoints = [kps for kps, _ in viewFeatures]
+viewDescriptors = [desc for _, desc in viewFeatures]
+collectionMatcher = collection.CollectionMatcher(neighbors=1, workers=1)
+
+try_this('keypoint votes', lambda: collection.voteScores(
+         viewDescriptors).toarray().argmax(1), [3, 4, 5, 0, 1, 2],
+         compare_equal)
+try_this('top pairs', lambda: [(i, j) for i, j, _ in
+         collectionMatcher.rankPairs(viewDescriptors)],
+         [(0, 3), (1, 4), (2, 5)], compare_equal)
+
+graph = collectionMatcher.match(viewKeypoints, viewDescriptors,
+                                names=['a', 'b', 'c', 'd', 'e', 'f'])
+try_this('match graph', lambda: sorted(graph.edges),
+         [(0, 3), (1, 4), (2, 5)], compare_equal)
+
+# Edges of a graph with their inliers and scores, and their match arrays.
+# Match distances are stored as float32.
+def graph_edges(graph):
+    return [graph.numImages, graph.names] + [(i, j, graph.inliers(i, j),
+        graph.edges[(i, j)][2]) for i, j in sorted(graph.edges)]
+
+def graph_matches(graph):
+    return [a for key in sorted(graph.edges) for a in graph.matches(*key)]
+
+path = os.path.join(tempDir, 'graph.npz')
+graph.save(path)
+loadedGraph = collection.MatchGraph.load(path)
+try_this('match graph file', lambda: graph_edges(loadedGraph),
+         graph_edges(graph), compare_equal)
+try_this('match graph file', lambda: graph_matches(loadedGraph),
+         graph_matches(graph), compare_close)
+
+# Vocabulary tree retrieval over the same collection. Every indexed image
+# is its own best match.
+tree = vocabulary.VocabularyTree(branching=4, depth=3).train(
+    np.concatenate(viewDescriptors))
+vocabularyIndex = vocabulary.InvertedIndex(tree)
+for descriptors in viewDescriptors:
+    vocabularyIndex.add(descriptors)
+
+def best_images(index):
+    return [index.query(descriptors, k=1)[0][0]
+            for descriptors in viewDescriptors]
+
+def all_scores(index):
+    return [index.query(descriptors, k=len(viewDescriptors))
+            for descriptors in viewDescriptors]
+
+try_this('vocabulary query', best_images, list(range(len(views))),
+         compare_equal, vocabularyIndex)
+
+# Images added after a merge are kept in the recent matrix, and give the
+# same scores as an index built at once when merged.
+recentIndex = vocabulary.InvertedIndex(tree, mergeFraction=10)
+for descriptors in viewDescriptors[:3]:
+    recentIndex.add(descriptors)
+recentIndex.update()
+for descriptors in viewDescriptors[3:]:
+    recentIndex.add(descriptors)
+try_this('vocabulary recent', best_images, list(range(len(views))),
+         compare_equal, recentIndex)
+try_this('vocabulary recent', lambda: recentIndex.recent.shape[0], 3,
+         compare_equal)
+recentIndex.merge()
+try_this('vocabulary merge', all_scores, all_scores(vocabularyIndex),
+         compare_close, recentIndex)
+
+# A memory-mapped index gives the same scores
+path = os.path.join(tempDir, 'vocabulary.npz')
+vocabularyIndex.save(path)
+try_this('vocabulary file', all_scores, all_scores(vocabularyIndex),
+         compare_close, vocabulary.InvertedIndex.load(path, mmap=True))
+
+# Prefetching loader. Items come in order, an exception of load is raised
+# at its item, and leaving the loader early stops its thread.
+loadedItems = []
+
+def load_square(i):
+    loadedItems.append(i)
+    if i == 5:
+        raise ValueError('cannot load {}'.format(i))
+    return i * i
+
+def prefetch(depth, count):
+    results = []
+    try:
+        with benchmark.PrefetchLoader(range(count), load_square,
+                                      depth) as loader:
+            for result in loader:
+                results.append(result)
+    except ValueError as e:
+        results.append(str(e))
+    return results
+
+for depth in (0, 1, 3):
+    try_this('prefetch order', prefetch, [0, 1, 4, 9, 16], compare_equal,
+             depth, 5)
+    try_this('prefetch error', prefetch, [0, 1, 4, 9, 16, 'cannot load 5'],
+             compare_equal, depth, 10)
+
+def prefetch_abandoned(depth):
+    del loadedItems[:]
+    with benchmark.PrefetchLoader(range(1000), load_square, depth) as loader:
+        for result in loader:
+            if result == 4:
+                break
+    # Three items taken, depth queued and one waiting for room
+    return loader.thread.is_alive(), len(loadedItems) <= 3 + depth + 1
+
+try_this('prefetch close', prefetch_abandoned, (False, True), compare_equal,
+         2)
+
+# Descriptor compression, trained on the descriptors of the collection
+training = np.concatenate(viewDescriptors)
+int8Compressor = compact.DescriptorCompressor('int8').fit(training)
+try_this('int8 scale', lambda: int8Compressor.scale,
+         np.percentile(np.abs(training), 99.9) / 127, compare_close)
+try_this('int8 compress', lambda: int8Compressor.compress(training),
+         np.clip(np.rint(training / int8Compressor.scale), -127,
+                 127).astype(np.int8), compare_equal)
+
+# The PCA components are orthonormal, and the variances of the projected
+# descriptors are the largest eigenvalues of their covariance
+pcaCompressor = compact.DescriptorCompressor('float64', 8).fit(training)
+try_this('pca components', lambda: np.dot(pcaCompressor.components.T,
+         pcaCompressor.components), np.eye(8), compare_close)
+try_this('pca projection', lambda: pcaCompressor.project(training).var(0),
+         np.linalg.eigvalsh(np.cov(training.T, bias=True))[::-1][:8],
+         compare_close)
+
+compressor = compact.DescriptorCompressor('int8', 16).fit(training)
+path = os.path.join(tempDir, 'compressor.npz')
+compressor.save(path)
+loadedCompressor = compact.DescriptorCompressor.load(path)
+try_this('compressor file', lambda: [repr(loadedCompressor),
+         loadedCompressor.compress(desc1)], [repr(compressor),
+         compressor.compress(desc1)], compare_equal)
+
+try_this('compact descriptor', lambda: features.CompactFeatureDescriptor(
+         MFD, path).describeFeatures(views[0], viewKeypoints[0]),
+         compressor.compress(MFD.describeFeatures(views[0],
+                                                  viewKeypoints[0])),
+         compare_equal)
+
+# Compact descriptors find the same nearest neighbours as float32 ones,
+# at nearly the same distances. int8 distances are in units of the scale.
+def compact_neighbors(dtype):
+    compressor = compact.DescriptorCompressor(dtype).fit(training)
+    index = neighbors.BruteForceIndex().fit(
+        compressor.compress(viewDescriptors[3]))
+    dists, indices = index.query(compressor.compress(viewDescriptors[0]), 2)
+    return dists * compressor.scale, indices
+
+exactDists, exactIndices = neighbors.BruteForceIndex().fit(
+    viewDescriptors[3].astype(np.float32)).query(
+    viewDescriptors[0].astype(np.float32), 2)
+
+def compact_recall(dtype):
+    dists, indices = compact_neighbors(dtype)
+    return neighbors.recall(indices, exactIndices) >= 0.95
+
+def compact_distance_error(dtype):
+    dists, indices = compact_neighbors(dtype)
+    return np.median(np.abs(dists - exactDists)[indices == exactIndices])
+
+for dtype in ('float16', 'int8'):
+    try_this('compact recall', compact_recall, True, compare_equal, dtype)
+try_this('float16 distances', lambda: compact_neighbors('float16')[0],
+         exactDists, lambda d1, d2: np.allclose(d1, d2, atol=1e-2))
+try_this('int8 distances', compact_distance_error, 0,
+         lambda e, _: e < int8Compressor.scale, 'int8')
+
+# cProfile runs during the outermost hooked calls of every thread
+def cprofile_depths():
+    profiler = profiling.CProfileProfiler()
+    token = profiler.start('outer')
+    depths = []
+    def inner():
+        innerToken = profiler.start('inner')
+        depths.append(profiler.depth())
+        profiler.stop('inner', innerToken)
+        depths.append(profiler.depth())
+    thread = threading.Thread(target=inner)
+    thread.start()
+    thread.join()
+    depths.append(profiler.depth())
+    profiler.stop('outer', token)
+    return depths + [profiler.depth()]
+
+try_this('cProfile depth', cprofile_depths, [1, 0, 1, 0], compare_equal)
+
+# Worker processes write their profile next to the one of the main process
+profilePath = os.path.join(tempDir, 'profile.txt')
+os.environ['FEATURES_PROFILE_OUTPUT'] = profilePath
+with concurrent.futures.ProcessPoolExecutor(1) as pool:
+    workerPath = pool.submit(profiling.outputPath).result()
+    workerPid = pool.submit(os.getpid).result()
+try_this('profile output', profiling.outputPath, profilePath, compare_equal)
+try_this('worker profile output', lambda: workerPath, os.path.join(tempDir,
+         'profile.{}.txt'.format(workerPid)), compare_equal)
+del os.environ['FEATURES_PROFILE_OUTPUT']
+
+# Decoded image cache. The cached images come with the grayscale image that
+# ImageContext would compute.
+imagePath = os.path.join(tempDir, 'image.png')
+cv2.imwrite(imagePath, image)
+imageCache = imagecache.ImageCache(os.path.join(tempDir, 'images'))
+imageCache.read(imagePath)
+context = benchmark.read_image(imagePath, imageCache)
+
+try_this('cached image', lambda: context.image, image, compare_equal)
+try_this('cached grayscale image', lambda: context.gray,
+         imagecontext.ImageContext(image).gray, compare_equal)
+try_this('features of a cached image', lambda: benchmark.compute_features(
+         context, HKD4(), MFD, 0.01)[1], MFD.describeFeatures(image,
+         [kp for kp in HKD4().detectKeypoints(image) if kp.response >= 0.01]),
+         compare_equal)
+
+# Cache hits are read-only memory maps. Entries stay valid when only the
+# modification time of the source changes, unless checkHash is False, and
+# are decoded again when its contents change.
+imageCache = imagecache.ImageCache(os.path.join(tempDir, 'images2'))
+imageCache.read(imagePath)
+cached = imageCache.read(imagePath)
+
+try_this('image cache hit', lambda: (type(cached), cached.flags.writeable,
+         imageCache.hits, imageCache.misses), (np.memmap, False, 1, 1),
+         compare_equal)
+
+os.utime(imagePath, ns=(0, 0))
+try_this('image cache with a touched source without hashing', lambda:
+         imagecache.ImageCache(imageCache.directory, checkHash=False).lookup(
+         imagePath) is None, True, compare_equal)
+try_this('image cache with a touched source', lambda: (imageCache.read(
+         imagePath, gray=True), imageCache.hits, imageCache.misses),
+         (context.gray, 2, 1), compare_equal)
+
+cv2.imwrite(imagePath, 255 - image)
+os.utime(imagePath, ns=(0, 0))
+try_this('image cache with a changed source', lambda: (imageCache.read(
+         imagePath), imageCache.hits, imageCache.misses), (255 - image, 2, 2),
+         compare_equal)
+
+# Beyond maxBytes the least recently used entries are evicted, reads count
+# as uses
+imagePaths = [os.path.join(tempDir, 'image{}.png'.format(i)) for i in range(3)]
+for i, path in enumerate(imagePaths):
+    cv2.imwrite(path, image // (i + 1))
+imageCache = imagecache.ImageCache(os.path.join(tempDir, 'images3'))
+imageCache.read(imagePaths[0])
+imageCache.maxBytes = 2.5 * sum(os.path.getsize(path) for path in
+                                imageCache.paths(imagePaths[0]))
+imageCache.read(imagePaths[1])
+# Entry 1 was used after entry 0, until entry 0 is read again
+os.utime(imageCache.paths(imagePaths[0])[0], (1, 1))
+os.utime(imageCache.paths(imagePaths[1])[0], (2, 2))
+imageCache.read(imagePaths[0])
+imageCache.read(imagePaths[2])
+
+try_this('image cache eviction', lambda: [imageCache.lookup(path) is not None
+         for path in imagePaths], [True, False, True], compare_equal)
+
+shutil.rmtree(tempDir)
@@ -0,0 +1,243 @@
+import cv2
+import numpy as np
+
+import features
+import imagecontext
+
+
+## KLT tracking ################################################################
+class KLTTracker(object):
+    '''
+    Keypoints and descriptors for image sequences (such as video frames)
+    that only run the detector where it is needed. The first frame is
+    detected as usual. On every following frame the keypoints are tracked
+    with pyramidal Lucas-Kanade optical flow (cv2.calcOpticalFlowPyrLK,
+    checked forwards and backwards). The detector only runs again in the
+    cells of a grid over the image that have lost too many of their tracks.
+    This pays off for small motion between frames; when most cells lose
+    their tracks, the whole frame is detected again, and a change of the
+    frame size starts over.
+
+    update(image) returns keypoints and descriptors like
+    detectKeypoints/describeFeatures, so the result can be matched with any
+    FeatureMatcher. The class_id of every keypoint is the id of its track,
+    which is kept while the keypoint is tracked.
+    '''
+    def __init__(self, keypointDetector, featureDescriptor, kpThreshold=1e-2,
+                 gridShape=(4, 4), redetectRatio=0.5, retryInterval=10,
+                 margin=8, winSize=21, maxLevel=3, fbThreshold=1.0,
+                 keepDescriptors=False):
+        '''
+        Input:
+            keypointDetector, featureDescriptor -- used for the detection
+                and description of the keypoints
+            kpThreshold -- minimum response of detected keypoints
+            gridShape -- (rows, columns) of the re-detection grid
+            redetectRatio -- a cell is detected again when fewer than this
+                fraction of the tracks it had after its last detection are
+                left
+            retryInterval -- cells without any keypoints (e.g. textureless
+                areas) are detected again every retryInterval frames
+            margin -- border (in pixels) added around a cell for its
+                detection, which must cover the support of the detector's
+                filters
+            winSize, maxLevel -- window size and number of pyramid levels of
+                the optical flow
+            fbThreshold -- maximum distance (in pixels) between a point and
+                its position after tracking forwards and back again
+            keepDescriptors -- if True, tracked keypoints keep the
+                descriptor computed when they were detected, and only new
+                keypoints are described. Otherwise all keypoints are
+                described on every frame.
+        '''
+        self.keypointDetector = keypointDetector
+        self.featureDescriptor = featureDescriptor
+        self.kpThreshold = kpThreshold
+        self.gridShape = gridShape
+        self.redetectRatio = redetectRatio
+        self.retryInterval = retryInterval
+        self.margin = margin
+        self.winSize = winSize
+        self.maxLevel = maxLevel
+        self.fbThreshold = fbThreshold
+        self.keepDescriptors = keepDescriptors
+        # Track ids stay unique across resets
+        self.nextId = 0
+        self.reset()
+
+    def reset(self):
+        '''Forgets all tracks; the next frame is detected from scratch.'''
+        self.gray = None
+        self.shape = None
+        self.keypoints = []
+        self.descriptors = None
+        # Number of keypoints of every cell after its last detection
+        self.cellCounts = None
+        self.frame = 0
+        # Number of cells detected on the last frame
+        self.lastRedetected = 0
+
+    def cellsOf(self, points):
+        '''Grid cell index of every point of the N x 2 array points.'''
+        rows, cols = self.gridShape
+        height, width = self.shape
+        r = np.clip((points[:, 1] * rows / height).astype(int), 0, rows - 1)
+        c = np.clip((points[:, 0] * cols / width).astype(int), 0, cols - 1)
+        return r * cols + c
+
+    def cellBounds(self, cell):
+        '''(x0, y0, x1, y1) of the pixels of a grid cell.'''
+        rows, cols = self.gridShape
+        height, width = self.shape
+        r, c = divmod(cell, cols)
+        return (c * width // cols, r * height // rows,
+                (c + 1) * width // cols, (r + 1) * height // rows)
+
+    def trackPoints(self, gray, points):
+        '''
+        Tracks points (N x 2) from the previous frame to the grayscale
+        frame gray.
+        Output:
+            N x 2 array of the tracked points, boolean array marking the
+            points that were tracked reliably
+        '''
+        if len(points) == 0:
+            return points, np.zeros(0, bool)
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+        args = dict(winSize=(self.winSize, self.winSize),
+                    maxLevel=self.maxLevel, criteria=criteria)
+        prev = points.astype(np.float32).reshape(-1, 1, 2)
+        new, status, _ = cv2.calcOpticalFlowPyrLK(self.gray, gray, prev,
+            None, **args)
+        back, backStatus, _ = cv2.calcOpticalFlowPyrLK(gray, self.gray, new,
+            None, **args)
+
+        new = new.reshape(-1, 2)
+        height, width = self.shape
+        ok = (status.ravel() == 1) & (backStatus.ravel() == 1)
+        ok &= np.sqrt(((back.reshape(-1, 2) - points)**2).sum(1)) < \
+            self.fbThreshold
+        ok &= (new[:, 0] >= 0) & (new[:, 0] <= width - 1) & \
+            (new[:, 1] >= 0) & (new[:, 1] <= height - 1)
+        return new, ok
+
+    def detectIn(self, context, cells):
+        '''
+        Detects keypoints in the given grid cells only. Each cell is
+        detected on a crop with a margin, unless more than half of the cells
+        are requested, in which case the whole image is detected once, with
+        the imagecontext.ImageContext of the frame that the descriptor
+        reuses.
+        Output:
+            list of the new keypoints, with fresh track ids
+        '''
+        height, width = self.shape
+        numCells = self.gridShape[0] * self.gridShape[1]
+        if 2 * len(cells) > numCells:
+            regions = [(0, 0, width, height)]
+        else:
+            regions = [self.cellBounds(cell) for cell in cells]
+
+        wanted = np.zeros(numCells, bool)
+        wanted[list(cells)] = True
+        keypoints = []
+        for x0, y0, x1, y1 in regions:
+            cx, cy = max(0, x0 - self.margin), max(0, y0 - self.margin)
+            if (x1 - x0, y1 - y0) == (width, height):
+                crop = context
+            else:
+                crop = context.image[cy:min(height, y1 + self.margin),
+                                     cx:min(width, x1 + self.margin)]
+            found = [kp for kp in self.keypointDetector.detectKeypoints(crop)
+                     if kp.response >= self.kpThreshold]
+            if not found:
+                continue
+            points = features.keypointCoordinates(found) + (cx, cy)
+            inside = (points[:, 0] >= x0) & (points[:, 0] < x1) & \
+                (points[:, 1] >= y0) & (points[:, 1] < y1)
+            inside &= wanted[self.cellsOf(points)]
+            for i in np.flatnonzero(inside):
+                kp = found[i]
+                kp.pt = (float(points[i, 0]), float(points[i, 1]))
+                kp.class_id = self.nextId
+                self.nextId += 1
+                keypoints.append(kp)
+        return keypoints
+
+    def update(self, image):
+        '''
+        Input:
+            image -- the next BGR frame, uint8 with values in [0, 255]
+        Output:
+            keypoints -- list of cv2.KeyPoint objects of the frame
+            descriptors -- their descriptors
+        '''
+        gray = image if image.ndim == 2 else \
+            cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        numCells = self.gridShape[0] * self.gridShape[1]
+
+        if self.gray is None or image.shape[:2] != self.shape:
+            self.reset()
+            self.shape = image.shape[:2]
+            tracked, trackedDesc = [], None
+            lost = np.ones(numCells, bool)
+        else:
+            points = features.keypointCoordinates(self.keypoints)
+            new, ok = self.trackPoints(gray, points)
+            counts = np.bincount(self.cellsOf(new[ok]), minlength=numCells)
+            lost = counts < self.redetectRatio * self.cellCounts
+            if self.frame % self.retryInterval == 0:
+                lost |= self.cellCounts == 0
+
+            # Tracks in cells that are detected again are replaced
+            keep = ok.copy()
+            keep[ok] = ~lost[self.cellsOf(new[ok])]
+            # New KeyPoint objects, the ones of the previous frame may still
+            # be in use by the caller
+            tracked = []
+            for i in np.flatnonzero(keep):
+                kp = self.keypoints[i]
+                tracked.append(cv2.KeyPoint(float(new[i, 0]), float(new[i, 1]),
+                    kp.size, kp.angle, kp.response, kp.octave, kp.class_id))
+            trackedDesc = None
+            if self.keepDescriptors and self.descriptors is not None:
+                trackedDesc = np.asarray(self.descriptors)[keep]
+
+        context = imagecontext.ImageContext(image)
+        detected = self.detectIn(context, np.flatnonzero(lost))
+        if self.cellCounts is None:
+            self.cellCounts = np.zeros(numCells, int)
+        if len(detected):
+            newCounts = np.bincount(self.cellsOf(
+                features.keypointCoordinates(detected)), minlength=numCells)
+        else:
+            newCounts = np.zeros(numCells, int)
+        self.cellCounts[lost] = newCounts[lost]
+
+        keypoints = tracked + detected
+        if trackedDesc is not None and not detected:
+            descriptors = trackedDesc
+        elif trackedDesc is not None:
+            newDesc = self.featureDescriptor.describeFeatures(context,
+                detected)
+            descriptors = np.concatenate([trackedDesc, newDesc])
+        else:
+            descriptors = self.featureDescriptor.describeFeatures(context,
+                keypoints)
+
+        self.gray = gray
+        self.keypoints = keypoints
+        self.descriptors = descriptors
+        self.frame += 1
+        self.lastRedetected = int(lost.sum())
+        return keypoints, descriptors
+
+
+def trackSequence(images, keypointDetector, featureDescriptor, **trackerArgs):
+    '''
+    Yields (keypoints, descriptors) for every image of a sequence, see
+    KLTTracker for the arguments.
+    '''
+    tracker = KLTTracker(keypointDetector, featureDescriptor, **trackerArgs)
+    for image in images:
+        yield tracker.update(image)
@@ -67,3 +67,126 @@ def get_scale_mx(s_x, s_y, s_z):
 
     return scale_mx
 
+
+def get_rot_mx_batch(angles_x, angles_y, angles_z):
+    '''
+    Input:
+        angles_x -- Array of N rotations around the x axis in radians
+        angles_y -- Array of N rotations around the y axis in radians
+        angles_z -- Array of N rotations around the z axis in radians
+        Scalars are broadcast against the arrays.
+    Output:
+        A Nx4x4 numpy array, where entry i equals
+        get_rot_mx(angles_x[i], angles_y[i], angles_z[i]).
+    '''
+    angles_x, angles_y, angles_z = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(a, dtype=np.float64))
+          for a in (angles_x, angles_y, angles_z)])
+    n = angles_x.shape[0]
+
+    cx, sx = np.cos(angles_x), np.sin(angles_x)
+    cy, sy = np.cos(angles_y), np.sin(angles_y)
+    cz, sz = np.cos(angles_z), np.sin(angles_z)
+
+    # Closed form of rot_z * rot_y * rot_x, see get_rot_mx
+    rot_mx = np.zeros((n, 4, 4))
+    rot_mx[:, 0, 0] = cz * cy
+    rot_mx[:, 0, 1] = cz * sy * sx - sz * cx
+    rot_mx[:, 0, 2] = cz * sy * cx + sz * sx
+    rot_mx[:, 1, 0] = sz * cy
+    rot_mx[:, 1, 1] = sz * sy * sx + cz * cx
+    rot_mx[:, 1, 2] = sz * sy * cx - cz * sx
+    rot_mx[:, 2, 0] = -sy
+    rot_mx[:, 2, 1] = cy * sx
+    rot_mx[:, 2, 2] = cy * cx
+    rot_mx[:, 3, 3] = 1
+
+    return rot_mx
+
+
+def get_trans_mx_batch(trans_vecs):
+    '''
+    Input:
+        trans_vecs -- Translation vectors represented by a Nx3 numpy array
+    Output:
+        A Nx4x4 numpy array, where entry i equals get_trans_mx(trans_vecs[i]).
+    '''
+    trans_vecs = np.asarray(trans_vecs, dtype=np.float64)
+    assert trans_vecs.ndim == 2
+    assert trans_vecs.shape[1] == 3
+
+    trans_mx = np.tile(np.eye(4), (trans_vecs.shape[0], 1, 1))
+    trans_mx[:, :3, 3] = trans_vecs
+
+    return trans_mx
+
+
+def get_scale_mx_batch(s_x, s_y, s_z):
+    '''
+    Input:
+        s_x -- Array of N scalings along the x axis
+        s_y -- Array of N scalings along the y axis
+        s_z -- Array of N scalings along the z axis
+        Scalars are broadcast against the arrays.
+    Output:
+        A Nx4x4 numpy array, where entry i equals
+        get_scale_mx(s_x[i], s_y[i], s_z[i]).
+    '''
+    scales = np.broadcast_arrays(*[np.atleast_1d(np.asarray(s, dtype=np.float64))
+                                   for s in (s_x, s_y, s_z)])
+    n = scales[0].shape[0]
+
+    scale_mx = np.zeros((n, 4, 4))
+    for i, s in enumerate(scales):
+        scale_mx[:, i, i] = s
+    scale_mx[:, 3, 3] = 1
+
+    return scale_mx
+
+
+def get_affine_2d(mx):
+    '''
+    Input:
+        mx -- A 4x4 or Nx4x4 numpy array representing transformations that
+        only act in the xy-plane
+    Output:
+        A 2x3 or Nx2x3 numpy array with the corresponding 2D affine
+        transformations, as expected by cv2.warpAffine.
+    '''
+    return mx[..., :2, [0, 1, 3]]
+
+
+def get_similarity_mx_2d(x, y, angles, scales, offset=(0, 0)):
+    '''
+    Input:
+        x, y -- Arrays of N source points in pixels
+        angles -- Array of N rotations in radians
+        scales -- Array of N scalings
+        offset -- The point (in destination coordinates) that each source
+        point is mapped to
+        Scalars are broadcast against the arrays.
+    Output:
+        A Nx2x3 numpy array. Entry i is the 2D affine transformation that
+        translates (x[i], y[i]) to the origin, rotates by -angles[i], scales by
+        scales[i] and finally translates by offset, i.e. the 2x3 part of
+
+            T(offset) * S(scales[i]) * R_z(-angles[i]) * T(-x[i], -y[i])
+
+        computed in closed form without any matrix products.
+    '''
+    x, y, angles, scales = np.broadcast_arrays(
+        *[np.atleast_1d(np.asarray(a, dtype=np.float64))
+          for a in (x, y, angles, scales)])
+
+    c = scales * np.cos(angles)
+    s = scales * np.sin(angles)
+
+    mx = np.empty((x.shape[0], 2, 3))
+    mx[:, 0, 0] = c
+    mx[:, 0, 1] = s
+    mx[:, 0, 2] = offset[0] - c * x - s * y
+    mx[:, 1, 0] = -s
+    mx[:, 1, 1] = c
+    mx[:, 1, 2] = offset[1] + s * x - c * y
+
+    return mx
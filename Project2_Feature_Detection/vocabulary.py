@@ -0,0 +1,391 @@
+'''
+Image retrieval with a vocabulary tree (Nister and Stewenius, "Scalable
+Recognition with a Vocabulary Tree", CVPR 2006). The descriptors of an
+image are quantized into visual words by descending a tree built with
+hierarchical k-means, and the images are stored in an inverted file from
+words to the images containing them. A query only touches the inverted
+lists of its own words, so its cost depends on the number of images sharing
+words with it rather than on the size of the database.
+
+    tree = VocabularyTree(branching=10, depth=4).train(trainingDescriptors)
+    index = InvertedIndex(tree)
+    for descriptors in database:
+        index.add(descriptors)
+    imageIds, scores = index.query(queryDescriptors, k=10)
+    index.save('database.npz')
+
+Float descriptors (such as MOPS) are clustered with Euclidean k-means,
+binary uint8 descriptors (such as ORB) with Hamming k-majority.
+'''
+import numpy as np
+from scipy import sparse
+
+import featureio
+import neighbors
+
+
+## Vocabulary tree #############################################################
+def isBinary(descriptors):
+    '''Packed binary descriptors are compared with the Hamming distance.'''
+    return np.asarray(descriptors).dtype == np.uint8
+
+
+def clusterCenters(data, labels, k, binary):
+    '''Means (or bitwise majorities, for binary data) of the k clusters.'''
+    if binary:
+        bits = np.unpackbits(data, axis=1).astype(np.float32)
+        sums = np.zeros((k, bits.shape[1]), np.float32)
+        np.add.at(sums, labels, bits)
+        counts = np.bincount(labels, minlength=k)[:, np.newaxis]
+        return np.packbits(2 * sums > np.maximum(counts, 1), axis=1)
+    sums = np.zeros((k, data.shape[1]), np.float64)
+    np.add.at(sums, labels, data)
+    counts = np.bincount(labels, minlength=k)[:, np.newaxis]
+    return (sums / np.maximum(counts, 1)).astype(np.float32)
+
+
+def kmeans(data, k, iterations, rng):
+    '''
+    Input:
+        data -- N x D numpy array, float or packed binary (uint8)
+        k -- number of clusters, at most N
+        iterations -- number of Lloyd iterations
+        rng -- numpy RandomState of the initialization
+    Output:
+        centers -- k' x D numpy array, without the clusters that ended up
+                   empty (k' <= k)
+        labels -- cluster index of every row of data
+    '''
+    binary = isBinary(data)
+    if not binary:
+        data = np.asarray(data, dtype=np.float32)
+    centers = data[rng.choice(data.shape[0], k, replace=False)]
+    labels = None
+    for _ in range(iterations):
+        index = neighbors.HammingIndex() if binary else \
+            neighbors.BruteForceIndex()
+        newLabels = index.fit(centers).query(data, 1)[1][:, 0]
+        if labels is not None and (newLabels == labels).all():
+            break
+        labels = newLabels
+        centers = clusterCenters(data, labels, k, binary)
+
+    used = np.bincount(labels, minlength=k) > 0
+    remap = np.cumsum(used) - 1
+    return centers[used], remap[labels]
+
+
+class VocabularyTree(object):
+    '''
+    Hierarchical k-means tree over descriptors. Every node has up to
+    `branching` children and the leaves are the visual words. The tree is
+    stored in flat arrays:
+        centers  -- center of every node (the root's is unused)
+        children -- numNodes x branching array of child nodes, -1 if missing
+        words    -- word id of every leaf node, -1 for inner nodes
+    '''
+    def __init__(self, branching=10, depth=4, iterations=10, seed=0):
+        '''
+        Input:
+            branching -- number of clusters per node
+            depth -- number of levels, which gives up to branching**depth
+                     words
+            iterations -- Lloyd iterations of every k-means
+            seed -- seed of the k-means initialization
+        '''
+        self.branching = branching
+        self.depth = depth
+        self.iterations = iterations
+        self.seed = seed
+        self.centers = None
+        self.children = None
+        self.words = None
+
+    @property
+    def numWords(self):
+        return int(self.words.max()) + 1 if self.words is not None else 0
+
+    def train(self, descriptors, maxDescriptors=None):
+        '''
+        Input:
+            descriptors -- N x D numpy array, or a list of the descriptor
+                           arrays of several images
+            maxDescriptors -- if given, the tree is trained on a random
+                              subset of this size
+        Output:
+            self, so that calls can be chained
+        '''
+        if isinstance(descriptors, (list, tuple)):
+            descriptors = np.concatenate(descriptors)
+        rng = np.random.RandomState(self.seed)
+        if maxDescriptors is not None and len(descriptors) > maxDescriptors:
+            descriptors = descriptors[rng.choice(len(descriptors),
+                maxDescriptors, replace=False)]
+        if not isBinary(descriptors):
+            descriptors = np.asarray(descriptors, dtype=np.float32)
+
+        centers = [np.zeros(descriptors.shape[1], descriptors.dtype)]
+        children = [[-1] * self.branching]
+        # Breadth first, so the nodes of every level are contiguous
+        queue = [(0, np.arange(len(descriptors)), 0)]
+        for node, rows, level in queue:
+            if level == self.depth or len(rows) <= self.branching:
+                continue
+            childCenters, labels = kmeans(descriptors[rows], self.branching,
+                self.iterations, rng)
+            if len(childCenters) < 2:
+                continue
+            for c, center in enumerate(childCenters):
+                children[node][c] = len(centers)
+                queue.append((len(centers), rows[labels == c], level + 1))
+                centers.append(center)
+                children.append([-1] * self.branching)
+
+        self.centers = np.array(centers)
+        self.children = np.array(children, np.int32)
+        leaves = self.children[:, 0] < 0
+        self.words = np.full(len(centers), -1, np.int32)
+        self.words[leaves] = np.arange(leaves.sum())
+        return self
+
+    def childDistances(self, descriptors, childCenters):
+        '''
+        Input:
+            descriptors -- M x D numpy array
+            childCenters -- M x B x D numpy array, the centers of the
+                            children of the node of every descriptor
+        Output:
+            M x B numpy array of (squared Euclidean or Hamming) distances
+        '''
+        if isBinary(descriptors):
+            xor = np.bitwise_xor(descriptors[:, np.newaxis, :], childCenters)
+            return neighbors.POPCOUNT_TABLE[xor].sum(2, dtype=np.int32)
+        diff = childCenters - descriptors[:, np.newaxis, :]
+        return np.einsum('mbd,mbd->mb', diff, diff)
+
+    def quantize(self, descriptors, chunkSize=4096):
+        '''
+        Input:
+            descriptors -- N x D numpy array
+        Output:
+            numpy array with the word id of every descriptor
+        '''
+        descriptors = np.asarray(descriptors)
+        if not isBinary(descriptors):
+            descriptors = descriptors.astype(np.float32, copy=False)
+        words = np.empty(len(descriptors), np.int32)
+        for start in range(0, len(descriptors), chunkSize):
+            block = descriptors[start:start + chunkSize]
+            nodes = np.zeros(len(block), np.int32)
+            # All descriptors descend one level per step
+            for _ in range(self.depth):
+                ch = self.children[nodes]
+                inner = ch[:, 0] >= 0
+                if not inner.any():
+                    break
+                ch = ch[inner]
+                d = self.childDistances(block[inner],
+                    self.centers[np.maximum(ch, 0)]).astype(np.float64)
+                d[ch < 0] = np.inf
+                nodes[inner] = ch[np.arange(len(ch)), d.argmin(1)]
+            words[start:start + chunkSize] = self.words[nodes]
+        return words
+
+    def arrays(self, prefix='tree/'):
+        '''The tree as a dict of numpy arrays, see InvertedIndex.save.'''
+        return {prefix + 'centers': self.centers,
+                prefix + 'children': self.children,
+                prefix + 'words': self.words,
+                prefix + 'params': np.array([self.branching, self.depth,
+                    self.iterations, self.seed])}
+
+    @staticmethod
+    def fromArrays(arrays, prefix='tree/'):
+        branching, depth, iterations, seed = \
+            np.asarray(arrays[prefix + 'params']).tolist()
+        tree = VocabularyTree(branching, depth, iterations, seed)
+        tree.centers = np.asarray(arrays[prefix + 'centers'])
+        tree.children = np.asarray(arrays[prefix + 'children'])
+        tree.words = np.asarray(arrays[prefix + 'words'])
+        return tree
+
+
+## Inverted file ###############################################################
+class InvertedIndex(object):
+    '''
+    Inverted file over the visual words of a VocabularyTree, with TF-IDF
+    scoring. Images are scored by the cosine similarity of their TF-IDF
+    vectors, where a word's weight is its count in the image times
+    idf = log(numImages / number of images containing the word).
+
+    The word counts are kept in a sparse numImages x numWords matrix (CSC,
+    so the column of a word is its inverted list). Rebuilding it costs time
+    proportional to its size, so images added later go to a second, small
+    matrix of recent images, which is merged into the main one when it
+    holds more than mergeFraction of its images. The IDF weights are
+    recomputed at merges only: until then, they are those of the images
+    merged so far.
+    '''
+    def __init__(self, tree, mergeFraction=0.1):
+        self.tree = tree
+        self.mergeFraction = mergeFraction
+        self.inverted = self.bagsMatrix([]).tocsc()
+        self.recent = self.inverted
+        # Bags of words of the images not merged yet
+        self.recentBags = []
+        self.names = []
+        self.idf = np.zeros(tree.numWords)
+        self.norms = np.zeros(0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def bagOfWords(self, descriptors):
+        '''Output: the distinct words of descriptors and their counts.'''
+        if len(descriptors) == 0:
+            return np.zeros(0, np.int32), np.zeros(0, np.float32)
+        words, counts = np.unique(self.tree.quantize(descriptors),
+            return_counts=True)
+        return words, counts.astype(np.float32)
+
+    def add(self, descriptors, name=None):
+        '''
+        Input:
+            descriptors -- N x D numpy array of the descriptors of an image
+            name -- optional name of the image, its id by default
+        Output:
+            the id of the image, its row of the inverted file
+        '''
+        return self.addWords(*self.bagOfWords(descriptors), name=name)
+
+    def addWords(self, words, counts, name=None):
+        '''
+        Adds an image given by its words, which must be distinct, and their
+        counts (see bagOfWords).
+        '''
+        imageId = len(self.names)
+        self.names.append(str(imageId) if name is None else name)
+        self.recentBags.append((np.asarray(words), np.asarray(counts)))
+        return imageId
+
+    def bagsMatrix(self, bags, documents=None):
+        '''
+        Output:
+            numImages x numWords scipy.sparse.csr_matrix of the word counts
+            of the bags of words, appended to the rows of documents if given
+        '''
+        if documents is None:
+            documents = sparse.csr_matrix((0, self.tree.numWords),
+                dtype=np.float32)
+        lengths = np.array([len(w) for w, _ in bags], np.int64)
+        indptr = np.concatenate([documents.indptr,
+            documents.indptr[-1] + np.cumsum(lengths)])
+        indices = np.concatenate([documents.indices] +
+            [w for w, _ in bags]).astype(np.int32, copy=False)
+        data = np.concatenate([documents.data] +
+            [c for _, c in bags]).astype(np.float32, copy=False)
+        return sparse.csr_matrix((data, indices, indptr),
+            shape=(len(indptr) - 1, self.tree.numWords))
+
+    def imageNorms(self, documents):
+        '''Norms of the TF-IDF vectors of the rows of documents (CSR).'''
+        weights = documents.data * self.idf[documents.indices]
+        squares = sparse.csr_matrix((weights * weights, documents.indices,
+            documents.indptr), shape=documents.shape)
+        return np.sqrt(np.asarray(squares.sum(1)).ravel())
+
+    def merge(self):
+        '''Merges the recent images into the main matrix.'''
+        # Appending images is cheap in image-major order (CSR), queries
+        # need word-major order (CSC)
+        documents = self.bagsMatrix(self.recentBags, self.inverted.tocsr())
+        self.inverted = documents.tocsc()
+        self.recent = self.bagsMatrix([]).tocsc()
+        self.recentBags = []
+
+        df = np.diff(self.inverted.indptr)
+        self.idf = np.log(documents.shape[0] / np.maximum(df, 1))
+        self.norms = self.imageNorms(documents)
+
+    def update(self):
+        '''Brings the matrices up to date with the added images.'''
+        numMerged = self.inverted.shape[0]
+        if numMerged + self.recent.shape[0] == len(self.names):
+            return
+        if len(self.recentBags) > self.mergeFraction * numMerged:
+            self.merge()
+        else:
+            documents = self.bagsMatrix(self.recentBags)
+            self.recent = documents.tocsc()
+            self.norms = np.concatenate([self.norms[:numMerged],
+                self.imageNorms(documents)])
+
+    def queryWords(self, words, counts, k=10):
+        '''
+        Input:
+            words, counts -- the distinct words of the query and their counts
+            k -- number of images to return
+        Output:
+            imageIds -- numpy array of the (up to) k best scoring images,
+                        best first
+            scores -- their cosine similarity to the query, in [0, 1]
+        '''
+        self.update()
+        numImages = len(self.names)
+        if numImages == 0 or len(words) == 0:
+            return np.zeros(0, np.intp), np.zeros(0)
+        idf = self.idf[words]
+        queryNorm = np.sqrt(((counts * idf)**2).sum())
+        # Only the inverted lists of the query's words are read. Words in
+        # every image (idf 0) do not contribute and are skipped.
+        used = idf > 0
+        words, weights = words[used], (counts * idf * idf)[used]
+        scores = np.concatenate([self.inverted[:, words].dot(weights),
+                                 self.recent[:, words].dot(weights)])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = np.where(self.norms > 0, scores / (self.norms *
+                max(queryNorm, 1e-12)), 0)
+
+        k = min(k, numImages)
+        best = np.argpartition(-scores, k - 1)[:k] if k < numImages else \
+            np.arange(numImages)
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return best, scores[best]
+
+    def query(self, descriptors, k=10):
+        '''Queries with the descriptors of an image, see queryWords.'''
+        return self.queryWords(*self.bagOfWords(descriptors), k=k)
+
+    def save(self, path):
+        '''
+        Saves the tree and the inverted file as a feature file (see
+        featureio.saveFeatures). It is memory-mapped by load, so large
+        databases open quickly.
+        '''
+        if self.recentBags:
+            self.merge()
+        arrays = self.tree.arrays()
+        arrays.update({'index/data': self.inverted.data,
+                       'index/indices': self.inverted.indices,
+                       'index/indptr': self.inverted.indptr,
+                       'index/idf': self.idf,
+                       'index/norms': self.norms,
+                       'names': np.array(self.names, dtype=str)})
+        featureio.saveFeatures(path, **arrays)
+
+    @staticmethod
+    def load(path, mmap=True, mergeFraction=0.1):
+        '''
+        Opens an index saved by save. With mmap, the inverted file is read
+        from disk on demand until the next merge.
+        '''
+        with featureio.loadFeatures(path, mmap) as f:
+            index = InvertedIndex(VocabularyTree.fromArrays(f),
+                mergeFraction)
+            index.names = f['names'].tolist()
+            index.inverted = sparse.csc_matrix((f['index/data'],
+                f['index/indices'], f['index/indptr']),
+                shape=(len(index.names), index.tree.numWords))
+            index.idf = f['index/idf']
+            index.norms = f['index/norms']
+        return index